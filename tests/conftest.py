@@ -0,0 +1,8 @@
+import os
+import sys
+
+
+# The modules of the API import each other from the package directory, like
+# uvicorn does when started by the systemd unit.
+API_DIR = os.path.join(os.path.dirname(__file__), '..', 'usr', 'lib', 'python3', 'dist-packages', 'linuxmusterApi')
+sys.path.insert(0, os.path.abspath(API_DIR))
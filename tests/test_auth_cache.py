@@ -0,0 +1,60 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+import jwt
+
+from security import header
+from utils.changes import ChangeEvent
+from utils.config import api_config
+
+
+SECRET = b'test-secret'
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    calls = []
+
+    def getvalues(url, attributes):
+        calls.append(url)
+        return {'sophomorixRole': 'teacher', 'sophomorixSchoolname': 'default-school'}
+
+    monkeypatch.setattr(api_config, '_secret', SECRET)
+    monkeypatch.setattr(header.lr, 'getvalues', getvalues)
+    header.authenticated_users.configure(maxsize=16, ttl=60)
+    yield calls
+    header.authenticated_users.clear()
+
+
+def authenticate(user):
+    token = jwt.encode({'user': user}, SECRET, algorithm='HS512')
+    return asyncio.run(header.check_authentication_header(SimpleNamespace(scope={}), token))
+
+
+def test_verified_user_is_cached(lookups):
+    assert authenticate('MrsDoe').role == 'teacher'
+    assert authenticate('MrsDoe').user == 'MrsDoe'
+    assert len(lookups) == 1
+
+
+def test_change_event_invalidates_mixed_case_user(lookups):
+    authenticate('MrsDoe')
+
+    # Change events carry the cn as found in LDAP, keys are lowercase
+    header._invalidate_changed_users([ChangeEvent('user', 'MrsDoe', 'CN=MrsDoe,OU=Teachers')])
+    authenticate('MrsDoe')
+
+    assert len(lookups) == 2
+
+
+def test_invalidate_authenticated_user_is_case_insensitive(lookups):
+    authenticate('mrsdoe')
+    header.invalidate_authenticated_user('MRSDOE')
+    authenticate('mrsdoe')
+
+    assert len(lookups) == 2
@@ -0,0 +1,93 @@
+import asyncio
+import csv
+import io
+import threading
+from time import sleep
+
+import pytest
+from pydantic import ValidationError
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from routers_v1 import users as users_router
+from routers_v1.body_schemas import BulkPasswords
+from security import AuthenticatedUser
+
+
+ADMIN = AuthenticatedUser(user='admin', role='globaladministrator', school='global')
+TEACHER = AuthenticatedUser(user='doe', role='teacher', school='default-school')
+
+
+@pytest.fixture
+def directory(monkeypatch):
+    roles = {'s1': 'student', 's2': 'student', 's3': 'student', 's4': 'student', 'smith': 'teacher'}
+    written = []
+    running = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+
+    def targets(config, who):
+        users = list(dict.fromkeys([*config.users, *config.passwords]))
+        return users, {user: roles[user] for user in users if user in roles}
+
+    def set_passwords(user, password, set_first, set_current):
+        with lock:
+            running['now'] += 1
+            running['max'] = max(running['max'], running['now'])
+        sleep(0.05)
+        with lock:
+            running['now'] -= 1
+            written.append((user, password))
+
+    monkeypatch.setattr(users_router, '_bulk_password_targets', targets)
+    monkeypatch.setattr(users_router, '_set_passwords', set_passwords)
+    return written, running
+
+def bulk(who, **config):
+    return asyncio.run(users_router.set_bulk_passwords(BulkPasswords(**config), who=who))
+
+
+def test_statuses(directory):
+    written, running = directory
+
+    results = bulk(TEACHER, users=['s1', 'smith', 'unknown'], policy='fixed', password='Muster!123')
+
+    assert [(r['user'], r['status']) for r in results] == [('s1', 'ok'), ('smith', 'forbidden'), ('unknown', 'not_found')]
+    assert written == [('s1', 'Muster!123')]
+
+def test_per_user_passwords(directory):
+    written, running = directory
+
+    results = bulk(ADMIN, users=['s2'], policy='per_user', passwords={'s1': 'Muster!123', 's2': ''})
+
+    assert {r['user']: r['status'] for r in results} == {'s2': 'error', 's1': 'ok'}
+    assert written == [('s1', 'Muster!123')]
+
+def test_random_passwords(directory):
+    results = bulk(ADMIN, users=['s1', 's2'], policy='random', length=16)
+
+    passwords = [r['password'] for r in results]
+    assert len(set(passwords)) == 2
+    assert all(len(p) == 16 and any(c.isdigit() for c in p) and any(c.isupper() for c in p) for p in passwords)
+
+def test_concurrency_is_limited(directory, monkeypatch):
+    written, running = directory
+    section = users_router.api_config.section
+    monkeypatch.setattr(users_router.api_config, 'section', lambda name: {'workers': 2} if name == 'bulk' else section(name))
+
+    bulk(ADMIN, users=['s1', 's2', 's3', 's4'], policy='fixed', password='Muster!123')
+
+    assert len(written) == 4
+    assert running['max'] == 2
+
+def test_csv(directory):
+    response = bulk(ADMIN, users=['s1'], policy='fixed', password='Muster!123', format='csv')
+
+    rows = list(csv.DictReader(io.StringIO(response.body.decode())))
+    assert rows == [{'user': 's1', 'status': 'ok', 'password': '', 'detail': ''}]
+
+def test_invalid_policy_and_format():
+    with pytest.raises(ValidationError):
+        BulkPasswords(users=['s1'], policy='none')
+    with pytest.raises(ValidationError):
+        BulkPasswords(users=['s1'], format='xml')
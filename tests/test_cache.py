@@ -0,0 +1,142 @@
+import multiprocessing
+import threading
+from time import sleep
+
+import pytest
+
+from utils import store
+from utils.cache import TTLCache
+
+
+@pytest.fixture
+def shared(monkeypatch, tmp_path):
+    monkeypatch.setattr(store.shared_store, 'enabled', True)
+    monkeypatch.setattr(store.shared_store, 'path', str(tmp_path / 'state.db'))
+    monkeypatch.setattr(store.shared_store, '_local', threading.local())
+    # Synced explicitly by the tests, no background read while forking
+    monkeypatch.setattr(TTLCache, 'SYNC_INTERVAL', float('inf'))
+
+
+def in_other_worker(func):
+    # A forked process, like the other uvicorn workers
+    process = multiprocessing.get_context('fork').Process(target=func)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def synced(cache):
+    # The first read only gives the position in the log
+    cache._read_invalidations()
+    return cache
+
+
+def test_lru():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert ('a' in cache, 'b' in cache, 'c' in cache) == (True, False, True)
+
+
+def test_expiry():
+    cache = TTLCache(ttl=0.05)
+    cache.set('a', 1)
+    sleep(0.1)
+
+    assert cache.get('a', 'expired') == 'expired'
+
+
+def test_pop_in_other_worker_drops_only_this_key(shared):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+    cache.set(('b', 'school'), 2)
+
+    in_other_worker(lambda: TTLCache(namespace='users').pop('a'))
+
+    synced(cache)
+    assert cache.get('a') is None
+    assert cache.get(('b', 'school')) == 2
+
+
+def test_clear_in_other_worker_drops_all(shared):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+
+    in_other_worker(lambda: TTLCache(namespace='users').clear())
+
+    assert synced(cache).get('a') is None
+
+
+def test_other_namespaces_are_kept(shared):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+
+    in_other_worker(lambda: TTLCache(namespace='sessions').clear())
+
+    assert synced(cache).get('a') == 1
+
+
+def test_unpublished_invalidations(shared):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    def invalidate():
+        other = TTLCache(namespace='users')
+        other.pop('a', publish=False)
+        other.clear(publish=False)
+
+    in_other_worker(invalidate)
+
+    assert synced(cache).get('a') == 1
+
+
+def test_own_invalidations_are_not_applied_again(shared):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+    cache.pop('a')
+    cache.set('a', 2)
+
+    assert synced(cache).get('a') == 2
+
+
+def test_expired_log_drops_all(shared):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+
+    def invalidate():
+        # Removed from the log at once, as if the worker missed it
+        store.SharedStore.RETENTION = -1
+        TTLCache(namespace='users').pop('other')
+
+    in_other_worker(invalidate)
+
+    assert synced(cache).get('a') is None
+
+
+def test_sync_does_not_read_in_the_caller(shared, monkeypatch):
+    cache = synced(TTLCache(namespace='users'))
+    cache.set('a', 1)
+    in_other_worker(lambda: TTLCache(namespace='users').pop('a'))
+
+    caller = threading.current_thread()
+    readers = []
+    invalidations = store.shared_store.invalidations
+
+    def read(*args):
+        readers.append(threading.current_thread())
+        return invalidations(*args)
+
+    monkeypatch.setattr(store.shared_store, 'invalidations', read)
+    monkeypatch.setattr(cache, 'SYNC_INTERVAL', 0)
+    cache.get('a')
+
+    for _ in range(100):
+        if not cache._syncing:
+            break
+        sleep(0.01)
+    assert readers and caller not in readers
+    assert cache.get('a') is None
@@ -0,0 +1,124 @@
+from contextlib import contextmanager
+
+import pytest
+
+pytest.importorskip('ldap')
+
+from utils import changes
+from utils.changes import ChangeBus, ChangeEvent, ChangePoller
+from utils.store import SharedStore
+
+
+class FakeConnection:
+    def __init__(self, results):
+        self.results = results
+
+    def search(self, ldap_filter, attributes, serverctrls=None):
+        results, self.results = self.results, []
+        return results, []
+
+
+@pytest.fixture
+def bus(monkeypatch):
+    bus = ChangeBus()
+    published = []
+    bus.subscribe(published.extend)
+    monkeypatch.setattr(changes, 'change_bus', bus)
+    return published
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    store = SharedStore()
+    store.enabled = True
+    store.path = str(tmp_path / 'state.db')
+    monkeypatch.setattr(changes, 'shared_store', store)
+    return store
+
+def poll_results(monkeypatch, results):
+    @contextmanager
+    def connection():
+        yield FakeConnection(results)
+    monkeypatch.setattr(changes.ldap_pool, 'connection', connection)
+
+def teacher(cn, sessions, usn):
+    return (
+        f'CN={cn},OU=Teachers,OU=default-school,OU=SCHOOLS,DC=linuxmuster,DC=lan',
+        {
+            'cn': [cn.encode()],
+            'sophomorixRole': [b'teacher'],
+            'sophomorixSchoolname': [b'default-school'],
+            'sophomorixSessions': sessions,
+            'uSNChanged': [str(usn).encode()],
+        },
+    )
+
+def tombstone(cn, usn):
+    return (
+        f'CN={cn}\\0ADEL:1234,CN=Deleted Objects,DC=linuxmuster,DC=lan',
+        {'cn': [f'{cn}\nDEL:1234'.encode()], 'isDeleted': [b'TRUE'], 'uSNChanged': [str(usn).encode()]},
+    )
+
+
+def test_session_events(monkeypatch, bus, store):
+    poller = ChangePoller()
+    poller.usn = 10
+
+    poll_results(monkeypatch, [teacher('doe', [b'1;Math;a,b;'], 11)])
+    poller.poll()
+    poll_results(monkeypatch, [teacher('doe', [b'1;Math;a,b;'], 12)])
+    poller.poll()
+
+    assert [event.kind for event in bus] == ['user', 'session', 'user']
+    assert poller.usn == 12
+
+def test_deleted_users_pruned(monkeypatch, bus, store):
+    poller = ChangePoller()
+    poller.usn = 10
+
+    poll_results(monkeypatch, [teacher('doe', [b'1;Math;a,b;'], 11)])
+    poller.poll()
+    poll_results(monkeypatch, [tombstone('doe', 12)])
+    poller.poll()
+
+    assert poller._sessions == {}
+    assert bus[-1] == ChangeEvent('deleted', 'doe', tombstone('doe', 12)[0])
+
+def test_only_the_leader_polls(monkeypatch, bus, store):
+    leader, follower = ChangePoller(), ChangePoller()
+    polled = []
+    for poller in [leader, follower]:
+        monkeypatch.setattr(poller, 'poll', lambda poller=poller: polled.append(poller) or 0)
+
+    leader._poll_if_leader()
+    # The follower runs in another worker
+    monkeypatch.setattr('utils.store.os.getpid', lambda: -1)
+    follower._poll_if_leader()
+
+    assert polled == [leader]
+    assert (leader.leader, follower.leader) == (True, False)
+
+def test_followers_publish_the_changes(monkeypatch, bus, store):
+    follower = ChangePoller()
+    follower.follow()
+
+    # Found by the leader, in another worker
+    with monkeypatch.context() as m:
+        m.setattr('utils.store.os.getpid', lambda: -1)
+        store.add_changes([('user', 'doe', 'CN=doe', 'default-school', 'teacher')])
+
+    assert follower.follow() == 1
+    assert bus == [ChangeEvent('user', 'doe', 'CN=doe', 'default-school', 'teacher')]
+
+def test_new_leader_continues_from_the_stored_usn(monkeypatch, bus, store):
+    monkeypatch.setattr('utils.store.os.getpid', lambda: -1)
+    store.acquire_lease(changes.POLLER_LEASE, 30)
+    store.set_lease_value(changes.POLLER_LEASE, '42')
+    store.release_lease(changes.POLLER_LEASE)
+    monkeypatch.setattr('utils.store.os.getpid', lambda: -2)
+
+    poller = ChangePoller()
+    monkeypatch.setattr(poller, 'poll', lambda: 0)
+    poller._poll_if_leader()
+
+    assert poller.usn == 42
+    assert poller.leader
@@ -0,0 +1,93 @@
+import os
+import signal
+
+from utils.config import ApiConfig
+
+
+def write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+    # Make sure the mtime changes, even on filesystems with coarse timestamps
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime + 1))
+
+
+def test_load(tmp_path):
+    path = tmp_path / 'config.yml'
+    write(path, 'secret: c2VjcmV0\nexecutors:\n  ldap_workers: 4\n')
+
+    config = ApiConfig(str(path))
+
+    assert config.secret == b'secret'
+    assert config.section('executors') == {'ldap_workers': 4}
+    assert config.section('missing') == {}
+
+
+def test_invalid_file_keeps_previous_configuration(tmp_path):
+    path = tmp_path / 'config.yml'
+    write(path, 'rooms:\n  interval: 3\n')
+    config = ApiConfig(str(path))
+
+    write(path, 'rooms: [unclosed\n')
+    config.load()
+
+    assert config.section('rooms') == {'interval': 3}
+
+
+def test_sighup_reloads_at_next_read(tmp_path):
+    path = tmp_path / 'config.yml'
+    write(path, 'rooms:\n  interval: 3\n')
+    config = ApiConfig(str(path))
+    reloads = []
+
+    def callback(c):
+        reloads.append(c)
+        if len(reloads) == 1:
+            # Received while loading: the handler must not load again itself
+            os.kill(os.getpid(), signal.SIGHUP)
+
+    config.on_reload(callback)
+    previous = signal.getsignal(signal.SIGHUP)
+    try:
+        config.install_sighup_handler()
+        config.load()
+        assert len(reloads) == 1
+
+        assert config.section('rooms') == {'interval': 3}
+        assert len(reloads) == 2
+    finally:
+        signal.signal(signal.SIGHUP, previous)
+
+
+def test_reload_from_callback(tmp_path):
+    path = tmp_path / 'config.yml'
+    write(path, 'rooms:\n  interval: 3\n')
+    config = ApiConfig(str(path))
+    calls = []
+
+    def callback(c):
+        calls.append(c)
+        if len(calls) == 1:
+            c.load()
+
+    config.on_reload(callback)
+    config.load()
+
+    assert len(calls) == 2
+
+
+def test_missing_file_keeps_previous_configuration(tmp_path):
+    path = tmp_path / 'config.yml'
+    write(path, 'secret: c2VjcmV0\nrooms:\n  interval: 3\n')
+    config = ApiConfig(str(path))
+
+    os.remove(path)
+    config.load()
+
+    assert config.secret == b'secret'
+    assert config.section('rooms') == {'interval': 3}
+
+    write(path, 'secret: c2VjcmV0\nrooms:\n  interval: 5\n')
+    config._last_check = 0
+
+    assert config.section('rooms') == {'interval': 5}
@@ -0,0 +1,37 @@
+import asyncio
+
+from utils.config import ApiConfig
+from utils.executors import BackendExecutor
+
+
+def config(tmp_path, content):
+    tmp_path.mkdir(exist_ok=True)
+    path = tmp_path / 'config.yml'
+    path.write_text(content)
+    return ApiConfig(str(path))
+
+
+def test_reload_keeps_the_pool(tmp_path):
+    executor = BackendExecutor('test', 'test_workers', 2)
+    pool = executor.executor
+
+    executor.configure(config(tmp_path, 'executors:\n  test_workers: 2\n  ldap_workers: 8\n'))
+    assert executor.executor is pool
+
+    executor.configure(config(tmp_path, 'executors:\n  test_workers: 3\n'))
+    assert executor.executor is not pool
+    executor.shutdown()
+
+def test_run_during_reloads(tmp_path):
+    executor = BackendExecutor('test', 'test_workers', 2)
+    configs = [config(tmp_path / str(size), f'executors:\n  test_workers: {size}\n') for size in [2, 3]]
+
+    async def run():
+        calls = [executor.run(sum, [i, 1]) for i in range(50)]
+        for i in range(20):
+            executor.configure(configs[i % 2])
+            await asyncio.sleep(0)
+        return await asyncio.gather(*calls)
+
+    assert asyncio.run(run()) == [i + 1 for i in range(50)]
+    executor.shutdown()
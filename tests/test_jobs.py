@@ -0,0 +1,127 @@
+import asyncio
+import multiprocessing
+import os
+import sqlite3
+
+import pytest
+from fastapi import HTTPException
+
+from utils.config import ApiConfig
+from utils.jobs import JobQueue, job_file_path, worker_id
+
+
+def config(tmp_path, content):
+    path = tmp_path / 'config.yml'
+    path.write_text(content)
+    return ApiConfig(str(path))
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue()
+    queue.store.path = str(tmp_path / 'jobs.db')
+    return queue
+
+def in_other_worker(func):
+    # A forked process, like the other uvicorn workers
+    process = multiprocessing.get_context('fork').Process(target=func)
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+
+def test_worker_id():
+    assert worker_id().startswith(f'{os.getpid()}:')
+    assert worker_id() == worker_id(os.getpid())
+
+def test_jobs_of_gone_workers_are_interrupted(queue):
+    def gone_worker():
+        queue.store._local.conn = None
+        queue.store.create('doe', 'exam-start')
+
+    in_other_worker(gone_worker)
+    running = queue.store.create('smith', 'exam-start')
+
+    assert queue.store.interrupt() == 1
+    jobs = {job['owner']: job for job in queue.store.list()}
+    assert (jobs['doe']['status'], jobs['doe']['error']) == ('failed', 'Interrupted by a restart of the API')
+    # Still running in this worker
+    assert jobs['smith']['status'] == 'queued'
+    assert jobs['smith']['id'] == running
+
+def test_jobs_without_worker_are_interrupted(queue, tmp_path):
+    # Database of a version which did not record the workers
+    conn = sqlite3.connect(queue.store.path)
+    conn.execute(
+        'CREATE TABLE jobs (id TEXT PRIMARY KEY, owner TEXT NOT NULL, kind TEXT NOT NULL, status TEXT NOT NULL, '
+        'progress REAL NOT NULL, created REAL NOT NULL, started REAL, finished REAL, result TEXT, error TEXT)'
+    )
+    conn.execute("INSERT INTO jobs (id, owner, kind, status, progress, created) VALUES ('old', 'doe', 'exam-start', 'running', 0, 0)")
+    conn.commit()
+    conn.close()
+
+    assert queue.store.interrupt() == 1
+    assert queue.store.get('old')['status'] == 'failed'
+
+def test_job_result(queue):
+    async def job():
+        return {'ok': True}
+
+    async def run():
+        job_id = await queue.submit('doe', 'test', job)
+        await asyncio.gather(*queue._tasks)
+        return queue.store.get(job_id)
+
+    stored = asyncio.run(run())
+    assert (stored['status'], stored['progress'], stored['result']) == ('done', 1, {'ok': True})
+
+def test_job_error(queue):
+    async def job():
+        raise HTTPException(status_code=400, detail='Invalid project')
+
+    async def run():
+        job_id = await queue.submit('doe', 'test', job)
+        await asyncio.gather(*queue._tasks)
+        return queue.store.get(job_id)
+
+    stored = asyncio.run(run())
+    assert (stored['status'], stored['error']) == ('failed', 'Invalid project')
+
+def test_jobs_get_their_own_files(queue, monkeypatch):
+    monkeypatch.setattr('utils.jobs.job_queue', queue)
+
+    async def job():
+        path = job_file_path('add-doe.pdf')
+        with open(path, 'w') as f:
+            f.write(path)
+        return path
+
+    async def run():
+        job_ids = [await queue.submit('doe', 'print-passwords', job) for _ in range(2)]
+        await asyncio.gather(*queue._tasks)
+        return [queue.store.get(job_id) for job_id in job_ids]
+
+    paths = [job['result'] for job in asyncio.run(run())]
+    assert paths[0] != paths[1]
+    assert [open(path).read() for path in paths] == paths
+    assert job_file_path('add-doe.pdf') is None
+
+def test_purge_removes_files(queue):
+    job_id = queue.store.create('doe', 'print-passwords')
+    path = queue.store.file_path(job_id, 'add-doe.pdf')
+    open(path, 'w').close()
+    queue.store.update(job_id, status='done', finished=0)
+
+    queue.store.purge()
+
+    assert queue.store.get(job_id) is None
+    assert not os.path.exists(path)
+
+def test_reload_keeps_semaphore(queue, tmp_path):
+    queue.configure(config(tmp_path, 'jobs:\n  workers: 2\n'))
+    semaphore = queue.semaphore
+
+    queue.configure(config(tmp_path, 'jobs:\n  workers: 2\n  retention: 60\n'))
+    assert queue.semaphore is semaphore
+
+    queue.configure(config(tmp_path, 'jobs:\n  workers: 3\n'))
+    assert queue.semaphore is not semaphore
@@ -0,0 +1,82 @@
+import base64
+import dataclasses
+import glob
+import json
+import os
+
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from fastapi.encoders import jsonable_encoder
+from linuxmusterTools.ldapconnector import LMNLdapReader
+from linuxmusterTools.ldapconnector.models import LMNUser
+
+from utils.ldap import get_users, to_model
+
+
+# Recordings of scripts/lmnapi-record-ldap-users.py
+RECORDINGS = os.environ.get('LMNAPI_LDAP_RECORDINGS', os.path.join(os.path.dirname(__file__), 'ldap_users'))
+
+# Comma separated cns of users to compare with a live LDAP, e.g. on a test server
+LIVE_USERS = [cn for cn in os.environ.get('LMNAPI_LDAP_USERS', '').split(',') if cn]
+
+
+@dataclasses.dataclass
+class Model:
+    cn: str
+    dn: str
+    memberOf: list
+    sophomorixExamMode: list[str]
+    sophomorixIntrinsic1: bool
+    sophomorixQuota: int
+    upper: str = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        self.upper = self.cn.upper()
+
+
+def test_field_types():
+    entry = {
+        'cn': [b'doe'],
+        'memberOf': [b'CN=a', b'CN=b'],
+        'sophomorixIntrinsic1': [b'TRUE'],
+        'sophomorixQuota': [b'12'],
+    }
+
+    model = to_model(Model, 'CN=doe,OU=Students', entry)
+
+    assert model == Model('doe', 'CN=doe,OU=Students', ['CN=a', 'CN=b'], [], True, 12)
+    assert model.upper == 'DOE'
+
+
+def test_missing_values():
+    model = to_model(Model, 'CN=doe', {'cn': [b'doe'], 'sophomorixQuota': [b'unlimited']})
+
+    assert (model.memberOf, model.sophomorixIntrinsic1, model.sophomorixQuota) == ([], False, 0)
+
+
+def recordings():
+    return sorted(glob.glob(os.path.join(RECORDINGS, '*.json')))
+
+@pytest.mark.skipif(not recordings(), reason=f'no recorded users in {RECORDINGS}')
+@pytest.mark.parametrize('path', recordings())
+def test_same_as_linuxmustertools_recorded(path):
+    with open(path) as f:
+        recording = json.load(f)
+
+    attributes = {
+        key: [base64.b64decode(value) for value in values]
+        for key, values in recording['attributes'].items()
+    }
+
+    user = to_model(LMNUser, recording['dn'], attributes)
+
+    assert jsonable_encoder(user.asdict()) == recording['expected']
+
+@pytest.mark.skipif(not LIVE_USERS, reason='LMNAPI_LDAP_USERS not set')
+def test_same_as_linuxmustertools_live():
+    expected = [jsonable_encoder(LMNLdapReader.get(f'/users/{cn}')) for cn in LIVE_USERS]
+
+    assert jsonable_encoder(get_users(LIVE_USERS)) == expected
@@ -0,0 +1,152 @@
+import threading
+
+import pytest
+
+ldap = pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from ldap.controls import SimplePagedResultsControl
+
+from utils import ldap as ldap_utils
+
+
+class FakeConnection:
+    """
+    Bound connection answering every search with one entry.
+    """
+
+    def __init__(self, fail=None):
+        self.fail = fail
+        self.options = {}
+        self.closed = False
+
+    def set_option(self, option, value):
+        self.options[option] = value
+
+    def simple_bind_s(self, binddn, bindpw):
+        pass
+
+    def search_ext(self, base, scope, ldap_filter, attributes, serverctrls=None):
+        if self.fail is not None:
+            raise self.fail
+        return 1
+
+    def result3(self, msgid):
+        return None, [('CN=doe', {'cn': [b'doe']})], msgid, []
+
+    def whoami_s(self):
+        return 'u:doe'
+
+    def unbind_s(self):
+        self.closed = True
+
+
+class Connections(list):
+    """
+    Opened connections, and errors raised by the searches of the next ones.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.failures = []
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    opened = Connections()
+    failures = opened.failures
+
+    def connect():
+        conn = FakeConnection(failures.pop(0) if failures else None)
+        opened.append(conn)
+        return conn, 'DC=linuxmuster,DC=lan'
+
+    monkeypatch.setattr(ldap_utils, 'connect', connect)
+    return opened
+
+
+@pytest.fixture
+def pool(connections):
+    pool = ldap_utils.LdapPool()
+    pool.min_size, pool.max_size, pool.checkout_timeout = 0, 2, 0.2
+    # No keepalive thread in the tests
+    pool._keepalive = threading.Thread()
+    return pool
+
+
+def test_connections_are_reused(pool, connections):
+    pool.search('(cn=doe)')
+    pool.search('(cn=doe)')
+
+    assert len(connections) == 1
+
+
+def test_pool_size_is_limited(pool, connections):
+    first = pool.acquire()
+    pool.acquire()
+
+    with pytest.raises(ldap.TIMEOUT):
+        pool.acquire()
+
+    pool.release(first)
+    assert pool.acquire() is first
+    assert len(connections) == 2
+
+
+def test_dead_connection_is_replaced(pool, connections):
+    connections.failures.append(ldap.SERVER_DOWN({'desc': "Can't contact LDAP server"}))
+
+    results, controls = pool.search('(cn=doe)')
+
+    assert results == [('CN=doe', {'cn': [b'doe']})]
+    assert len(connections) == 2
+    assert connections[0].closed
+    assert pool._opened == 1
+
+
+def test_connect_verifies_certificates(monkeypatch):
+    conn = FakeConnection()
+    config = {'host': 'server.linuxmuster.lan', 'binddn': 'CN=bind', 'bindpw': 'secret', 'searchdn': 'DC=lan'}
+    monkeypatch.setattr(ldap_utils.ldap, 'initialize', lambda uri: conn)
+    monkeypatch.setattr(ldap_utils, 'get_ldap_config', lambda: dict(config))
+
+    ldap_utils.connect()
+    assert conn.options[ldap.OPT_X_TLS_REQUIRE_CERT] == ldap.OPT_X_TLS_DEMAND
+
+    config.update(tls_verify=False, ca_file='/etc/ssl/ca.pem')
+    ldap_utils.connect()
+    assert conn.options[ldap.OPT_X_TLS_REQUIRE_CERT] == ldap.OPT_X_TLS_NEVER
+    assert conn.options[ldap.OPT_X_TLS_CACERTFILE] == '/etc/ssl/ca.pem'
+
+
+def test_connect_uses_linuxmuster_ca(monkeypatch, tmp_path):
+    conn = FakeConnection()
+    ca_file = tmp_path / 'cacert.pem'
+    ca_file.write_text('')
+    config = {'host': 'server.linuxmuster.lan', 'binddn': 'CN=bind', 'bindpw': 'secret', 'searchdn': 'DC=lan'}
+    monkeypatch.setattr(ldap_utils.ldap, 'initialize', lambda uri: conn)
+    monkeypatch.setattr(ldap_utils, 'get_ldap_config', lambda: dict(config))
+    monkeypatch.setattr(ldap_utils, 'LINUXMUSTER_CA_FILE', str(ca_file))
+
+    ldap_utils.connect()
+
+    assert conn.options[ldap.OPT_X_TLS_CACERTFILE] == str(ca_file)
+
+
+def test_first_page_releases_the_paging_state(pool, connections, monkeypatch):
+    searches = []
+
+    def search_ext(base, scope, ldap_filter, attributes, serverctrls=None):
+        searches.append([control.size for control in serverctrls if isinstance(control, SimplePagedResultsControl)])
+        return len(searches)
+
+    def result3(msgid):
+        response = SimplePagedResultsControl(True, size=0, cookie=b'next' if msgid == 1 else b'')
+        return None, [('CN=doe', {'cn': [b'doe']})], msgid, [response]
+
+    monkeypatch.setattr(FakeConnection, 'search_ext', lambda self, *args, **kwargs: search_ext(*args, **kwargs))
+    monkeypatch.setattr(FakeConnection, 'result3', lambda self, msgid: result3(msgid))
+
+    pool.search('(cn=*)', serverctrls=[SimplePagedResultsControl(True, size=2, cookie=b'')], first_page=True)
+
+    assert searches == [[2], [0]]
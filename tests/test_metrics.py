@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('prometheus_client')
+
+
+API_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../usr/lib/python3/dist-packages/linuxmusterApi'))
+
+
+def run_worker(metrics_dir, code):
+    # A new interpreter like a uvicorn worker: prometheus_client only uses
+    # the multiprocess mode if the directory is set before its import
+    env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(metrics_dir))
+    result = subprocess.run(
+        [sys.executable, '-c', f'from utils import metrics\n{code}'],
+        cwd=API_DIR, env=env, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+def workers_gauge(output):
+    for line in output.splitlines():
+        if line.startswith('lmnapi_executor_workers{executor="ldap"}'):
+            return float(line.split()[-1])
+
+
+def test_prepare_multiprocess_dir(tmp_path, monkeypatch):
+    from utils import metrics
+
+    monkeypatch.delenv(metrics.MULTIPROC_DIR_ENV, raising=False)
+    metrics_dir = tmp_path / 'metrics'
+    metrics_dir.mkdir()
+    (metrics_dir / 'counter_1234.db').write_bytes(b'old run')
+
+    metrics.prepare_multiprocess_dir(str(metrics_dir))
+
+    assert os.listdir(metrics_dir) == []
+    assert os.environ[metrics.MULTIPROC_DIR_ENV] == str(metrics_dir)
+
+def test_exited_workers_are_not_summed(tmp_path):
+    # Exits cleanly
+    run_worker(tmp_path, "metrics.EXECUTOR_WORKERS.labels('ldap').set(4)\nmetrics.mark_worker_dead()")
+    # Killed, without calling mark_worker_dead
+    run_worker(tmp_path, "metrics.EXECUTOR_WORKERS.labels('ldap').set(8)")
+
+    output = run_worker(tmp_path, "metrics.EXECUTOR_WORKERS.labels('ldap').set(2)\nprint(metrics.render()[0].decode())")
+
+    assert workers_gauge(output) == 2
+    # Only the file of the last worker is left
+    assert len([name for name in os.listdir(tmp_path) if name.startswith('gauge_livesum')]) == 1
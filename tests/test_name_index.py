@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from utils import checks
+from utils.changes import ChangeEvent
+
+
+@pytest.fixture
+def index(monkeypatch):
+    classes = {'default-school': ['5a', '5b']}
+    monkeypatch.setattr(checks.lr, 'get', lambda url, attributes, school: [{'cn': cn} for cn in classes[school]])
+    created = {'6a'}
+    return checks.NameIndex('/schoolclasses', lambda name, school: name in created)
+
+
+def test_names_is_a_list(index):
+    assert index.names('default-school') == ['5a', '5b']
+
+
+def test_created_name_confirmed_by_lookup(index):
+    assert index.exists('6a', 'default-school')
+    assert not index.exists('7a', 'default-school')
+    assert index.names('default-school') == ['5a', '5b', '6a']
+
+
+def test_names_are_copies(index):
+    index.names('default-school').append('7a')
+    assert not index.exists('7a', 'default-school')
+
+
+def test_discard(index):
+    index.exists('5a', 'default-school')
+    index.discard(['5a'])
+
+    assert index.names('default-school') == ['5b']
+
+
+def test_deleted_events_discard_names(monkeypatch):
+    monkeypatch.setattr(checks.lr, 'get', lambda url, attributes, school: [{'cn': '5a'}, {'cn': 'doe'}])
+    monkeypatch.setattr(checks.schoolclasses_index, 'lookup', lambda name, school: False)
+    monkeypatch.setattr(checks.teachers_index, 'lookup', lambda name, school: False)
+    checks.schoolclasses_index.invalidate()
+    checks.teachers_index.invalidate()
+
+    assert checks.schoolclasses_index.exists('5a', 'default-school')
+    assert checks.teachers_index.exists('doe', 'default-school')
+
+    checks._invalidate_changed_names([
+        ChangeEvent('deleted', '5a', 'CN=5a\\0ADEL:1234,CN=Deleted Objects'),
+        ChangeEvent('user', 'doe', 'CN=doe,OU=Students', school='default-school', role='student'),
+    ])
+
+    assert not checks.schoolclasses_index.exists('5a', 'default-school')
+    assert not checks.teachers_index.exists('doe', 'default-school')
@@ -0,0 +1,32 @@
+import os
+import threading
+from time import sleep
+
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from routers_v1.print_passwords import print_lock
+
+
+def test_print_lock(tmp_path):
+    file_path = str(tmp_path / 'add-doe.pdf')
+    inside = []
+    overlaps = []
+
+    def run():
+        with print_lock(file_path):
+            inside.append(1)
+            overlaps.append(len(inside))
+            sleep(0.02)
+            inside.pop()
+
+    threads = [threading.Thread(target=run) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert overlaps == [1] * 5
+    assert not os.path.exists(f'{file_path}.lock')
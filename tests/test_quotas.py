@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+from time import sleep
+
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from security import AuthenticatedUser, permissions
+from utils import quotas
+from utils.config import ApiConfig
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    calls = []
+    lock = threading.Lock()
+
+    def get_user_quotas(user):
+        with lock:
+            calls.append(user)
+        sleep(0.1)
+        return {'user': user}
+
+    monkeypatch.setattr(quotas.linuxmusterTools.quotas, 'get_user_quotas', get_user_quotas)
+    collector = quotas.QuotaCollector()
+    collector.calls = calls
+    return collector
+
+
+def test_concurrent_requests_share_one_collection(collector):
+    async def run():
+        return await asyncio.gather(*(collector.get('doe') for _ in range(5)))
+
+    results = asyncio.run(run())
+
+    assert collector.calls == ['doe']
+    assert all(result == results[0] for result in results)
+
+
+def test_collected_quotas_are_served_from_memory(collector):
+    first = asyncio.run(collector.get('doe'))
+    assert asyncio.run(collector.get('doe')) == first
+    asyncio.run(collector.get('doe', fresh=True))
+
+    assert collector.calls == ['doe', 'doe']
+
+
+def test_errors_are_reported_per_user(collector, monkeypatch):
+    def get_user_quotas(user):
+        if user == 'broken':
+            raise RuntimeError('no quota')
+        return {'user': user}
+
+    monkeypatch.setattr(quotas.linuxmusterTools.quotas, 'get_user_quotas', get_user_quotas)
+
+    result = asyncio.run(collector.get_many(['doe', 'broken']))
+
+    assert result['doe']['quotas'] == {'user': 'doe'}
+    assert result['broken'] == {'updated': None, 'error': 'no quota'}
+
+
+def test_reload_keeps_semaphore(collector, tmp_path):
+    path = tmp_path / 'config.yml'
+    path.write_text('quotas:\n  workers: 2\n')
+    collector.configure(ApiConfig(str(path)))
+    semaphore = collector.semaphore
+
+    path.write_text('quotas:\n  workers: 2\n  ttl: 10\n')
+    collector.configure(ApiConfig(str(path)))
+
+    assert collector.semaphore is semaphore
+
+
+def test_only_user_accounts_are_collected(collector, monkeypatch):
+    accounts = [
+        {'cn': 'doe', 'sophomorixRole': 'student'},
+        {'cn': 'smith', 'sophomorixRole': 'teacher'},
+        {'cn': 'r100-pc01$', 'sophomorixRole': 'classroom-studentcomputer'},
+    ]
+    monkeypatch.setattr(quotas, 'iter_users', lambda attributes: iter(accounts))
+
+    assert collector._all_users() == ['doe', 'smith']
+
+
+def test_collection_of_other_worker_is_loaded(collector, monkeypatch):
+    shared = {'updated': 100, 'quotas': {'doe': [100, {'user': 'doe'}], 'smith': [100, {'user': 'smith'}]}}
+    monkeypatch.setattr(quotas.shared_store, 'acquire_lease', lambda name, ttl: (False, json.dumps(shared)))
+    collector._data['smith'] = (200, {'user': 'smith', 'newer': True})
+
+    asyncio.run(collector.refresh())
+
+    assert not collector.leader
+    assert collector.calls == []
+    assert collector._data['doe'] == (100, {'user': 'doe'})
+    assert collector._data['smith'][1]['newer']
+
+
+def test_members_visible_to_teachers(monkeypatch):
+    roles = {'s1': 'student', 'smith': 'teacher', 'admin': 'schooladministrator', 'doe': 'teacher'}
+    monkeypatch.setattr(permissions, 'get_roles', lambda users: {user: roles.get(user) for user in users})
+    teacher = AuthenticatedUser(user='doe', role='teacher', school='default-school')
+
+    assert permissions.filter_readable_users(teacher, ['s1', 'smith', 'admin', 'doe', 'unknown']) == ['s1', 'doe']
@@ -0,0 +1,88 @@
+import asyncio
+import json
+from time import time
+
+import pytest
+
+from utils import rooms
+from utils.rooms import RoomIndex, parse_sessions
+
+
+@pytest.fixture
+def index():
+    index = RoomIndex()
+    index.rooms = {
+        ('default-school', 'r100'): {
+            'doe': {'ROOM': 'r100', 'HOSTNAME': 'r100-pc01', 'IP': '10.0.0.1'},
+            'smith': {'ROOM': 'r100', 'HOSTNAME': 'r100-pc02', 'IP': '10.0.0.2'},
+        },
+        ('other-school', 'r100'): {
+            'miller': {'ROOM': 'r100', 'HOSTNAME': 'r100-pc01', 'IP': '10.1.0.1'},
+        },
+    }
+    index.users = {'doe': ('default-school', 'r100'), 'smith': ('default-school', 'r100'), 'miller': ('other-school', 'r100')}
+    index.updated = time()
+    return index
+
+
+def test_user_in_room(index):
+    room, others = index.user_in_room('DOE', school='default-school')
+
+    assert room == 'r100'
+    assert list(others) == ['smith']
+
+def test_user_in_room_of_other_school(index):
+    assert index.user_in_room('miller', school='default-school') == ('', {})
+    assert index.user_in_room('miller', school=None)[0] == 'r100'
+
+def test_list_rooms_of_school(index):
+    assert index.list_rooms(school='default-school') == [{'school': 'default-school', 'room': 'r100', 'users': ['doe', 'smith']}]
+    assert len(index.list_rooms(school=None)) == 2
+
+def test_outdated_snapshot(index):
+    index.updated = time() - 10 * index.interval
+
+    assert index.user_in_room('doe') is None
+
+
+SMBSTATUS = r"""
+Samba version 4.15.13-Ubuntu
+PID     Username                  Group                     Machine                                   Protocol Version  Encryption           Signing              
+----------------------------------------------------------------------------------------------------------------------------------------------------------------
+4123    LINUXMUSTER\doe           LINUXMUSTER\domain users  10.0.0.1 (ipv4:10.0.0.1:49710)            SMB3_11           -                    partial(AES-128-CMAC)
+4187    LINUXMUSTER\Smith         LINUXMUSTER\domain users  r100-pc02 (ipv4:10.0.0.2:50122)           SMB3_11           -                    partial(AES-128-CMAC)
+4201    LINUXMUSTER\miller        LINUXMUSTER\teachers      ::ffff:10.0.0.3 (ipv6:::ffff:10.0.0.3:50200) SMB3_11        -                    partial(AES-128-CMAC)
+4230    nobody                    nogroup                   fe80::1 (ipv6:fe80::1:445)                SMB3_11           -                    -
+"""
+
+def test_parse_sessions():
+    assert list(parse_sessions(SMBSTATUS)) == [
+        ('doe', '10.0.0.1'),
+        ('smith', '10.0.0.2'),
+        ('miller', '10.0.0.3'),
+        ('nobody', 'fe80::1'),
+    ]
+
+def test_collect(monkeypatch):
+    index = RoomIndex()
+    monkeypatch.setattr(index, '_load_devices', lambda: None)
+    index._devices = {'10.0.0.1': ('default-school', 'r100', 'r100-pc01'), '10.0.0.2': ('default-school', 'r100', 'r100-pc02')}
+
+    async def smbstatus(command, timeout=None):
+        return 0, SMBSTATUS.encode(), b''
+    monkeypatch.setattr(rooms.sophomorix_runner, 'run', smbstatus)
+
+    asyncio.run(index.collect())
+
+    assert index.user_in_room('doe') == ('r100', {'smith': {'ROOM': 'r100', 'HOSTNAME': 'r100-pc02', 'IP': '10.0.0.2'}})
+    assert index.user_in_room('miller') == ('', {})
+
+def test_snapshot_of_other_worker(index, monkeypatch):
+    snapshot = {'updated': time(), 'sessions': [['miller', 'other-school', 'r200', 'r200-pc01', '10.1.0.2']]}
+    monkeypatch.setattr(rooms.shared_store, 'acquire_lease', lambda name, ttl: (False, json.dumps(snapshot)))
+
+    asyncio.run(index.update())
+
+    assert not index.leader
+    assert index.users == {'miller': ('other-school', 'r200')}
+    assert index.user_in_room('miller')[0] == 'r200'
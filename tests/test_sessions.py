@@ -0,0 +1,123 @@
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from fastapi import HTTPException
+
+from utils import sessions as sessions_utils
+from utils.sessions import Session, SessionConflict, SessionStore
+
+
+DN = 'CN=doe,OU=Teachers,OU=default-school,OU=SCHOOLS,DC=linuxmuster,DC=lan'
+
+
+class FakeDirectory:
+    """
+    Sessions of one user, changed by another client before the first
+    conflicts writes.
+    """
+
+    def __init__(self, sessions, conflicts=0):
+        self.sessions = list(sessions)
+        self.conflicts = conflicts
+        self.reads = 0
+        self.writes = []
+
+    def read(self, user):
+        self.reads += 1
+        return DN, 'default-school', tuple(self.sessions)
+
+    def write(self, user, dn, old, new):
+        if self.conflicts:
+            self.conflicts -= 1
+            # Another client removed the session in the meantime
+            self.sessions = [session for session in self.sessions if session != old]
+            self.sessions.append(Session(old.sid, old.name, old.members + ('other',)))
+            raise SessionConflict()
+
+        self.writes.append((old, new))
+        if old is not None:
+            self.sessions.remove(old)
+        if new is not None:
+            self.sessions.append(new)
+
+
+@pytest.fixture
+def store():
+    store = SessionStore()
+    store.retries = 3
+    return store
+
+def use(store, monkeypatch, directory):
+    monkeypatch.setattr(store, '_read', directory.read)
+    monkeypatch.setattr(store, '_write', directory.write)
+    return directory
+
+
+def test_conflict_is_retried_on_fresh_sessions(store, monkeypatch):
+    directory = use(store, monkeypatch, FakeDirectory([Session('1', 'Math', ('a',))], conflicts=1))
+
+    store.update_members('doe', 'default-school', '1', add=['b'])
+
+    assert directory.reads == 2
+    # The member added by the other client is kept
+    assert [set(session.members) for session in directory.sessions] == [{'a', 'other', 'b'}]
+
+def test_too_many_conflicts(store, monkeypatch):
+    use(store, monkeypatch, FakeDirectory([Session('1', 'Math', ('a',))], conflicts=10))
+
+    with pytest.raises(HTTPException) as e:
+        store.update_members('doe', 'default-school', '1', add=['b'])
+    assert e.value.status_code == 409
+
+def test_duplicate_sid(store, monkeypatch):
+    directory = use(store, monkeypatch, FakeDirectory([Session('1', 'Math', ())]))
+
+    with pytest.raises(HTTPException) as e:
+        store.add('doe', 'default-school', Session('1', 'Physics', ()))
+    assert e.value.status_code == 409
+    assert directory.writes == []
+
+def test_unchanged_session_is_not_written(store, monkeypatch):
+    directory = use(store, monkeypatch, FakeDirectory([Session('1', 'Math', ('c', 'a', 'b', 'd'))]))
+
+    store.update_members('doe', 'default-school', '1', add=['a', 'd'])
+    store.update_members('doe', 'default-school', '1', remove=['e'])
+
+    assert directory.writes == []
+
+def test_members_keep_their_order(store, monkeypatch):
+    directory = use(store, monkeypatch, FakeDirectory([Session('1', 'Math', ('c', 'a', 'b'))]))
+
+    store.update_members('doe', 'default-school', '1', add=['e', 'a'], remove=['b'])
+
+    assert directory.sessions[0].members == ('c', 'a', 'e')
+
+def test_write_is_published(store, monkeypatch):
+    use(store, monkeypatch, FakeDirectory([]))
+    published = []
+    monkeypatch.setattr(store.cache, '_publish', lambda key=None: published.append(key))
+
+    session = store.add('doe', 'default-school', Session('1', 'Math', ()))
+
+    assert published == ['doe']
+    assert store.cache.get('doe')[2] == (session,)
+
+def test_fallback_without_samdb(store, monkeypatch):
+    def no_samdb(self):
+        raise PermissionError('sam.ldb')
+
+    monkeypatch.setattr(SessionStore, 'samdb', property(no_samdb))
+    calls = []
+    monkeypatch.setattr(sessions_utils.lw, 'delattr_user', lambda user, data: calls.append(('del', user, data)), raising=False)
+    monkeypatch.setattr(sessions_utils.lw, 'setattr_user', lambda user, data, add=False: calls.append(('add', user, data)), raising=False)
+
+    store.use_samdb = True
+    store._write('doe', DN, Session('1', 'Math', ()), Session('1', 'Math', ('a',)))
+
+    assert not store.use_samdb
+    assert calls == [
+        ('del', 'doe', {'sophomorixSessions': '1;Math;;'}),
+        ('add', 'doe', {'sophomorixSessions': '1;Math;a;'}),
+    ]
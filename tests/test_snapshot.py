@@ -0,0 +1,105 @@
+import pytest
+
+pytest.importorskip('ldap')
+pytest.importorskip('linuxmusterTools')
+
+from utils import ldap as ldap_utils
+from utils import snapshot
+from utils.snapshot import GroupRecord, Snapshot, UserRecord
+
+
+def user(cn, school='default-school', role='student'):
+    return (
+        f'CN={cn},OU=Students,OU={school},OU=SCHOOLS,DC=linuxmuster,DC=lan',
+        {
+            'cn': [cn.encode()],
+            'sophomorixRole': [role.encode()],
+            'sophomorixSchoolname': [school.encode()],
+            'jpegPhoto': [b'\xff' * 1024],
+        },
+    )
+
+def project(cn, members, school='default-school'):
+    return (
+        f'CN={cn},OU=Projects,OU={school},OU=SCHOOLS,DC=linuxmuster,DC=lan',
+        {
+            'cn': [cn.encode()],
+            'sophomorixSchoolname': [school.encode()],
+            'sophomorixType': [b'project'],
+            'member': [user(member)[0].encode() for member in members],
+        },
+    )
+
+@pytest.fixture
+def directory(monkeypatch):
+    users = {cn: user(cn) for cn in ['doe', 'smith']}
+    groups = {'p_math': project('p_math', ['doe'])}
+
+    monkeypatch.setattr(snapshot, 'search_users', lambda cns, attributes=None: {cn: users[cn] for cn in cns if cn in users})
+
+    def search(ldap_filter, attributes=None, base=None, serverctrls=None):
+        return [group for cn, group in groups.items() if f'(cn={cn})' in ldap_filter], []
+    monkeypatch.setattr(snapshot.ldap_pool, 'search', search)
+
+    return users, groups
+
+@pytest.fixture
+def loaded(directory):
+    users, groups = directory
+    snap = Snapshot()
+    snap.schools = []
+    for entry in users.values():
+        snap._add_user(UserRecord(*entry))
+    for entry in groups.values():
+        snap._add_group(GroupRecord('project', *entry))
+    snap.ready = True
+    return snap
+
+
+def test_records_keep_only_served_attributes():
+    record = UserRecord(*user('doe'))
+
+    assert 'jpegPhoto' not in record.attrs
+    assert (record.cn, record.role, record.school) == ('doe', 'student', 'default-school')
+
+def test_refresh_user(directory, loaded):
+    users, groups = directory
+    users['doe'] = user('doe', role='teacher')
+
+    loaded.refresh('user', 'DOE')
+
+    assert loaded.users['doe'].role == 'teacher'
+    assert loaded.by_role['teacher'] == {'doe'}
+
+def test_refresh_group_and_members(directory, loaded):
+    users, groups = directory
+    groups['p_math'] = project('p_math', ['smith'])
+
+    loaded.refresh('project', 'p_math')
+
+    assert loaded.groups['project']['p_math'].members == {'smith'}
+    assert loaded.memberships('smith') == {('project', 'p_math')}
+    assert loaded.memberships('doe') == set()
+
+def test_refresh_deleted_group(directory, loaded):
+    users, groups = directory
+    del groups['p_math']
+
+    loaded.refresh('project', 'p_math')
+
+    assert 'p_math' not in loaded.groups['project']
+    assert loaded.memberships('doe') == set()
+
+def test_writer_refreshes_the_snapshot(monkeypatch):
+    refreshed = []
+
+    class FakeSnapshot:
+        def refresh(self, kind, cn, members=()):
+            refreshed.append((kind, cn, list(members)))
+
+    monkeypatch.setattr(ldap_utils.LMNLdapWriter, 'setattr_managementgroup', lambda cn, data, add=False: None, raising=False)
+    monkeypatch.setattr(ldap_utils.lw, 'snapshot', FakeSnapshot())
+
+    ldap_utils.lw.setattr_managementgroup('wifi', data={'member': 'CN=doe,OU=Students'}, add=True)
+
+    assert refreshed == [('managementgroup', 'wifi', ['CN=doe,OU=Students'])]
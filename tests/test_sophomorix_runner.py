@@ -0,0 +1,112 @@
+import asyncio
+from time import monotonic
+
+import pytest
+
+from utils.config import ApiConfig
+from utils.sophomorix import SophomorixRunner
+
+
+def config(tmp_path, content):
+    path = tmp_path / 'config.yml'
+    path.write_text(content)
+    return ApiConfig(str(path))
+
+
+def test_run_returns_output():
+    runner = SophomorixRunner()
+
+    returncode, stdout, stderr = asyncio.run(runner.run(['sh', '-c', 'echo out; echo err >&2; exit 3']))
+
+    assert (returncode, stdout, stderr) == (3, b'out\n', b'err\n')
+
+
+def test_concurrency_is_limited(tmp_path):
+    runner = SophomorixRunner()
+    runner.configure(config(tmp_path, 'sophomorix:\n  max_concurrency: 2\n'))
+
+    async def run_all():
+        start = monotonic()
+        await asyncio.gather(*(runner.run(['sleep', '0.3']) for _ in range(4)))
+        return monotonic() - start
+
+    # Two rounds of two commands
+    assert asyncio.run(run_all()) >= 0.6
+
+
+def test_timeout_kills_command():
+    runner = SophomorixRunner()
+
+    async def run():
+        start = monotonic()
+        with pytest.raises(asyncio.TimeoutError):
+            await runner.run(['sleep', '10'], timeout=0.2)
+        return monotonic() - start
+
+    assert asyncio.run(run()) < 5
+
+
+def test_reload_keeps_semaphore(tmp_path):
+    runner = SophomorixRunner()
+    runner.configure(config(tmp_path, 'sophomorix:\n  max_concurrency: 2\n'))
+    semaphore = runner.semaphore
+
+    runner.configure(config(tmp_path, 'sophomorix:\n  max_concurrency: 2\n  timeout: 10\n'))
+    assert runner.semaphore is semaphore
+
+    runner.configure(config(tmp_path, 'sophomorix:\n  max_concurrency: 3\n'))
+    assert runner.semaphore is not semaphore
+    assert runner.max_concurrency == 3
+
+
+def test_identical_calls_share_one_run():
+    runner = SophomorixRunner()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return {'USERS': {}}
+
+    async def run_all():
+        return await asyncio.gather(*(runner.shared(('sophomorix-query',), compute) for _ in range(5)))
+
+    results = asyncio.run(run_all())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+
+def test_cancelled_caller_does_not_cancel_the_others():
+    runner = SophomorixRunner()
+
+    async def compute():
+        await asyncio.sleep(0.2)
+        return 'done'
+
+    async def run():
+        first = asyncio.ensure_future(runner.shared('key', compute))
+        second = asyncio.ensure_future(runner.shared('key', compute))
+        await asyncio.sleep(0.05)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == 'done'
+
+def test_failed_call_is_not_kept(tmp_path):
+    runner = SophomorixRunner()
+    runner.configure(config(tmp_path, 'sophomorix:\n  query_ttl: 60\n'))
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('sophomorix-query failed')
+        return 'done'
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await runner.shared('key', compute)
+        return await runner.shared('key', compute), await runner.shared('key', compute)
+
+    # The second result comes from query_ttl
+    assert asyncio.run(run()) == ('done', 'done')
+    assert len(calls) == 2
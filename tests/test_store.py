@@ -0,0 +1,83 @@
+import multiprocessing
+import threading
+
+import pytest
+
+from utils.store import SharedStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SharedStore()
+    store.enabled = True
+    store.path = str(tmp_path / 'state.db')
+    return store
+
+
+def in_other_worker(func):
+    # A forked process, like the other uvicorn workers
+    queue = multiprocessing.get_context('fork').SimpleQueue()
+    process = multiprocessing.get_context('fork').Process(target=lambda: queue.put(func()))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+    return queue.get()
+
+def fresh(store):
+    # The forked process must not use the connection of its parent
+    store._local = threading.local()
+    return store
+
+
+def test_lease_held_by_one_worker(store):
+    assert store.acquire_lease('task', 30) == (True, None)
+    store.set_lease_value('task', '42')
+
+    assert in_other_worker(lambda: fresh(store).acquire_lease('task', 30)) == (False, '42')
+    # Renewed by the holder
+    assert store.acquire_lease('task', 30) == (True, '42')
+
+def test_released_lease_taken_with_its_value(store):
+    store.acquire_lease('task', 30)
+    store.set_lease_value('task', '42')
+    store.release_lease('task')
+
+    assert in_other_worker(lambda: fresh(store).acquire_lease('task', 30)) == (True, '42')
+    assert store.acquire_lease('task', 30) == (False, '42')
+
+def test_expired_lease_taken(store):
+    store.acquire_lease('task', -1)
+
+    assert in_other_worker(lambda: fresh(store).acquire_lease('task', 30)) == (True, None)
+
+def test_changes_sent_to_other_workers(store):
+    since, changes, expired = store.changes()
+    assert changes == []
+
+    def poller():
+        fresh(store).add_changes([('user', 'doe', 'CN=doe', 'default-school', 'teacher'), ('deleted', 'smith', 'CN=smith', None, None)])
+
+    in_other_worker(poller)
+    # Own changes are not read again
+    store.add_changes([('project', 'p_test', 'CN=p_test', 'default-school', None)])
+
+    since, changes, expired = store.changes(since)
+    assert changes == [('user', 'doe', 'CN=doe', 'default-school', 'teacher'), ('deleted', 'smith', 'CN=smith', None, None)]
+    assert not expired
+    assert store.changes(since) == (since, [], False)
+
+def test_removed_changes_reported(store, monkeypatch):
+    since, changes, expired = store.changes()
+    in_other_worker(lambda: fresh(store).add_changes([('user', 'doe', 'CN=doe', 'default-school', 'student')]))
+    monkeypatch.setattr(store, 'RETENTION', -1)
+    store.add_changes([('user', 'smith', 'CN=smith', 'default-school', 'student')])
+
+    since, changes, expired = store.changes(since)
+    assert (changes, expired) == ([], True)
+
+def test_disabled_store():
+    store = SharedStore()
+    store.enabled = False
+
+    assert store.acquire_lease('task', 30) == (True, None)
+    assert store.changes(3) == (3, [], False)
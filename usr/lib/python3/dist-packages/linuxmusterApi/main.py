@@ -2,22 +2,24 @@
 
 import time
 import uvicorn
-import yaml
-import os
 import sys
-import base64
-import binascii
-from fastapi import FastAPI, Depends, Request
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi import FastAPI, Depends, HTTPException, Request
+from fastapi.responses import HTMLResponse, FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
+from utils.changes import change_poller
+from utils.config import api_config
+from utils.executors import ldap_executor, sophomorix_executor, store_executor
+from utils.jobs import job_queue
+from utils.metrics import REQUEST_DURATION, REQUESTS, mark_worker_dead, prepare_multiprocess_dir, remove_dead_workers, render
+from utils.quotas import quota_collector
+from utils.rooms import room_index
+from utils.snapshot import directory_snapshot
+from utils.tracing import current_trace, finish_trace, start_trace
 
-config = {}
-config_path = '/etc/linuxmuster/api/config.yml'
-if os.path.isfile(config_path):
-    with open(config_path, 'r') as config_file:
-        config = yaml.load(config_file, Loader=yaml.SafeLoader)
+
+config = api_config.data
 
 description = """
 
@@ -59,8 +61,10 @@ if config.get("cors", {}):
 # V1
 from routers_v1 import (
     auth,
+    batch,
     exam,
     groups,
+    jobs,
     query,
     managementgroups,
     print_passwords,
@@ -74,18 +78,89 @@ from routers_v1 import (
     users,
 )
 
+@app.on_event("startup")
+def reload_config_on_sighup():
+    """
+    Let systemd reload config.yml without restarting the service.
+    """
+
+    api_config.install_sighup_handler()
+
+@app.on_event("startup")
+async def start_background_tasks():
+    """
+    Follow the changes of the directory to invalidate the caches, load the
+    directory snapshot, collect the quotas of all users and the users in
+    rooms in the background, if configured. Clean up the jobs of the previous
+    run.
+    """
+
+    remove_dead_workers()
+    change_poller.start()
+    directory_snapshot.start()
+    quota_collector.start()
+    room_index.start()
+    await job_queue.start()
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    """
+    Stop the background tasks and the running jobs, and release the threads
+    of the LDAP, sophomorix and store executors. The metrics of the worker
+    are not summed anymore.
+    """
+
+    job_queue.stop()
+    change_poller.stop()
+    directory_snapshot.stop()
+    quota_collector.stop()
+    room_index.stop()
+    ldap_executor.shutdown()
+    sophomorix_executor.shutdown()
+    store_executor.shutdown()
+    mark_worker_dead()
+
 @app.middleware("http")
 async def add_process_time_logging(request: Request, call_next):
     """
-    Middleware to check process time of a request.
+    Middleware to check process time of a request, and to trace its backend
+    calls.
     """
 
+    trace, token = start_trace(request.method, request.url.path)
     start_time = time.time()
-    response = await call_next(request)
+    try:
+        response = await call_next(request)
+    finally:
+        current_trace.reset(token)
     process_time = time.time() - start_time
     response.headers["X-Process-Time"] = str(process_time)
+    finish_trace(trace, response)
+
+    # Route template (e.g. /v1/users/{user}) to keep a bounded number of labels
+    route = getattr(request.scope.get('route', None), 'path', 'unmatched')
+    REQUESTS.labels(request.method, route, response.status_code).inc()
+    REQUEST_DURATION.labels(request.method, route).observe(process_time)
+
     return response
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics(request: Request):
+    """
+    Prometheus metrics, only available from the addresses listed in
+    metrics.allow.
+    """
+
+    metrics_config = api_config.section('metrics')
+    if not metrics_config.get('enabled', True):
+        raise HTTPException(status_code=404, detail="Not Found")
+
+    if request.client is None or request.client.host not in metrics_config.get('allow', ['127.0.0.1', '::1']):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    body, content_type = render()
+    return Response(content=body, media_type=content_type)
+
 @app.get("/", response_class=HTMLResponse, tags=["Home"])
 def home():
     """
@@ -118,23 +193,21 @@ app.include_router(exam.router, prefix="/v1")
 app.include_router(samba.router, prefix="/v1")
 app.include_router(print_passwords.router, prefix="/v1")
 app.include_router(printers.router, prefix="/v1")
+app.include_router(batch.router, prefix="/v1")
+app.include_router(jobs.router, prefix="/v1")
 
 if __name__ == "__main__":
-    secret = config.get('secret', None)
-    if not secret:
+    if not config.get('secret', None):
         print('Linuxmuster-api can not work without secret key, please configure it first.')
         sys.exit(1)
 
-    try:
-        secret_decoded = base64.b64decode(secret)
-        if len(secret_decoded) < 64:
-            print('Secret key should at least be 512 bits long for an optimal security.')
-            sys.exit(1)
-    except binascii.Error as e:
-        print(f'Invalid secret key in config.yml: {e}')
+    if api_config.secret is None:
+        print('Invalid secret key in config.yml.')
         sys.exit(1)
 
-    secret = ''
+    if len(api_config.secret) < 64:
+        print('Secret key should at least be 512 bits long for an optimal security.')
+        sys.exit(1)
 
     # Ensure config data
     config.setdefault('uvicorn', {})
@@ -147,4 +220,14 @@ if __name__ == "__main__":
     config['uvicorn'].setdefault('log_level', 'info')
     config['uvicorn'].setdefault('log_config', '/etc/linuxmuster/api/uvicorn_log_conf.yml')
 
+    # With many workers, uvicorn runs as process manager and restarts the
+    # workers gracefully on SIGHUP. The workers share their state through
+    # utils.store.
+    config['uvicorn'].setdefault('workers', 1)
+
+    # Each worker writes its metrics in a shared directory, aggregated on
+    # /metrics. Emptied before uvicorn starts the workers.
+    if config['uvicorn']['workers'] > 1:
+        prepare_multiprocess_dir(api_config.section('metrics').get('multiproc_dir', '/run/linuxmuster-api/metrics'))
+
     uvicorn.run("main:app", **config['uvicorn'])
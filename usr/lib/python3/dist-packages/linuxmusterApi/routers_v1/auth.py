@@ -10,7 +10,7 @@ router = APIRouter(
 )
 
 @router.get("/", name="Basic auth to get a valid JWT")
-def get_json_web_token(auth: bool = Depends(BasicAuthChecker())):
+async def get_json_web_token(auth: bool = Depends(BasicAuthChecker())):
     """
     ## Check user's password and respond with a valid jwt.
 
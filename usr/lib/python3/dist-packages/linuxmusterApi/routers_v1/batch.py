@@ -0,0 +1,151 @@
+import asyncio
+import json
+import logging
+from fastapi import APIRouter, Depends, HTTPException, Request
+from urllib.parse import urlsplit
+
+from security import AUTHENTICATED_USER_SCOPE_KEY, AuthenticatedUser, check_authentication_header
+from utils.config import api_config
+from utils.ldap import ReadMemo, read_memo
+from .body_schemas import BatchRequest
+
+
+router = APIRouter(
+    prefix="/batch",
+    tags=["Batch"],
+    responses={404: {"description": "Not found"}},
+)
+
+# Headers of the batch request which are not forwarded to the sub-requests
+DROPPED_HEADERS = {b'accept', b'content-length', b'content-type', b'if-none-match', b'transfer-encoding'}
+
+
+async def _dispatch(request: Request, who: AuthenticatedUser, path: str):
+    """
+    Run a GET request through the whole application (middlewares, routing,
+    permission checks), without HTTP round trip.
+
+    :return: Status code, content type and body
+    :rtype: tuple
+    """
+
+    url = urlsplit(path)
+    headers = [(key, value) for key, value in request.scope['headers'] if key not in DROPPED_HEADERS]
+    headers.append((b'accept', b'application/json'))
+
+    scope = {
+        'type': 'http',
+        'asgi': request.scope.get('asgi', {'version': '3.0'}),
+        'http_version': request.scope.get('http_version', '1.1'),
+        'method': 'GET',
+        'scheme': request.scope.get('scheme', 'https'),
+        'path': url.path,
+        'raw_path': url.path.encode(),
+        'root_path': request.scope.get('root_path', ''),
+        'query_string': url.query.encode(),
+        'headers': headers,
+        'client': request.scope.get('client', None),
+        'server': request.scope.get('server', None),
+        AUTHENTICATED_USER_SCOPE_KEY: who,
+    }
+    if 'state' in request.scope:
+        scope['state'] = request.scope['state']
+
+    done = asyncio.Event()
+    messages = []
+
+    async def receive():
+        if not messages:
+            messages.append(None)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # No client to disconnect, wait until the response is complete
+        await done.wait()
+        return {'type': 'http.disconnect'}
+
+    start = {}
+    body = []
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            start.update(message)
+        elif message['type'] == 'http.response.body':
+            body.append(message.get('body', b''))
+
+    try:
+        await request.app(scope, receive, send)
+    except Exception as e:
+        # The error response (500) was already sent by the application
+        logging.error(f"Batch sub-request {path} failed: {e}")
+    finally:
+        done.set()
+
+    content_type = ''
+    for key, value in start.get('headers', []):
+        if key.lower() == b'content-type':
+            content_type = value.decode('latin-1')
+
+    return start.get('status', 500), content_type, b''.join(body)
+
+async def _run(request: Request, who: AuthenticatedUser, index, sub_request):
+    result = {'id': sub_request.id if sub_request.id is not None else str(index), 'path': sub_request.path}
+
+    if sub_request.method.upper() != 'GET':
+        return {**result, 'status': 405, 'body': {'detail': 'Only GET requests can be batched'}}
+
+    if not sub_request.path.startswith('/v1/') or sub_request.path.startswith('/v1/batch'):
+        return {**result, 'status': 400, 'body': {'detail': 'Only /v1 endpoints, except /v1/batch, can be batched'}}
+
+    status, content_type, body = await _dispatch(request, who, sub_request.path)
+
+    if content_type.startswith('application/json'):
+        content = json.loads(body) if body else None
+    else:
+        content = body.decode('utf8', errors='replace')
+
+    return {**result, 'status': status, 'body': content}
+
+@router.post("/", name="Run many read requests at once")
+async def run_batch(request: Request, batch: BatchRequest, who: AuthenticatedUser = Depends(check_authentication_header)):
+    """
+    ## Run many GET requests in one round trip.
+
+    The body contains a list of `requests`, each with a `path` (e.g.
+    `/v1/users/doe?check_first_pw=true`), an optional `id` (default: its
+    position in the list) and an optional `method`, which must be GET.
+
+    The sub-requests are authenticated once with the token of the batch
+    request, run concurrently with the usual permission checks, and share
+    the results of identical LDAP reads. The response contains, in the same
+    order, the `id`, `path`, `status` and `body` of each sub-request.
+
+    The max number of sub-requests is set with `batch.max_requests` in
+    config.yml (default 20).
+
+    ### Access
+    - all users, each sub-request checks its own permissions
+
+    \f
+    :param batch: List of the requests to run
+    :type batch: BatchRequest
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: Responses of the sub-requests
+    :rtype: dict
+    """
+
+
+    max_requests = api_config.section('batch').get('max_requests', 20)
+    if len(batch.requests) > max_requests:
+        raise HTTPException(status_code=400, detail=f"A batch can not contain more than {max_requests} requests")
+
+    # Shared by all sub-requests through the context, until the end of the batch
+    token = read_memo.set(ReadMemo())
+    try:
+        responses = await asyncio.gather(*[
+            _run(request, who, index, sub_request)
+            for index, sub_request in enumerate(batch.requests)
+        ])
+    finally:
+        read_memo.reset(token)
+
+    return {'responses': responses}
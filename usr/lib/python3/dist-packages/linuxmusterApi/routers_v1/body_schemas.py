@@ -2,6 +2,8 @@
 The purpose of this file is to gather all classes used as model for post data.
 """
 
+from typing import Literal
+
 from pydantic import BaseModel, Field
 
 class UserList(BaseModel):
@@ -95,6 +97,26 @@ class SetCurrentPassword(BaseModel):
     password: str
     set_first: bool= Field(default= False)
 
+class BulkPasswords(BaseModel):
+    """
+    Set the passwords of many users at once: all members of the schoolclasses and projects, and the users.
+    The policy may be fixed (same password for all), random (one random password of the given length per user) or
+    per_user (passwords is a dict user -> password, its users are added to the list).
+    The flags set_first and set_current indicate which passwords must be overwritten.
+    format may be json or csv.
+    """
+
+    schoolclasses: list = []
+    projects: list = []
+    users: list = []
+    policy: Literal['fixed', 'random', 'per_user'] = 'fixed'
+    password: str | None = None
+    passwords: dict = {}
+    length: int = Field(default=12, ge=8, le=64)
+    set_first: bool = Field(default=True)
+    set_current: bool = Field(default=True)
+    format: Literal['json', 'csv'] = 'json'
+
 class StopExam(BaseModel):
     """
     users is a list of samaccountname from whom stop the exam. The attribute group_type (like "schoolclass") and
@@ -143,3 +165,20 @@ class PrintPasswordsUsersParameter(BaseModel):
     pdflatex: bool | None = False
     school: str | None = ''
     users: list
+
+class BatchSubRequest(BaseModel):
+    """
+    One read request of a batch. path is the url of the endpoint, with its
+    query parameters, e.g. /v1/users/doe?check_first_pw=true
+    """
+
+    id: str | None = None
+    method: str = 'GET'
+    path: str
+
+class BatchRequest(BaseModel):
+    """
+    List of read requests to run at once.
+    """
+
+    requests: list[BatchSubRequest]
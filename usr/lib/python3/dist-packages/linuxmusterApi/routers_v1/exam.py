@@ -3,7 +3,8 @@ from time import localtime, strftime
 
 from security import UserListChecker, AuthenticatedUser
 from .body_schemas import UserList, StopExam
-from utils.sophomorix import lmn_getSophomorixValue
+from utils.jobs import run_or_submit
+from utils.sophomorix import lmn_getSophomorixValueAsync
 
 
 router = APIRouter(
@@ -13,10 +14,14 @@ router = APIRouter(
 )
 
 @router.post("/start", name="Start exam")
-def start_exam_mode(userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def start_exam_mode(userlist: UserList, background: bool = False, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Start exam for the authenticated user
 
+    With the query parameter `background=true`, the command runs as a job:
+    the response is a `202` with the id of the job, whose status and result
+    are available on `/v1/jobs/{id}`.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -29,6 +34,8 @@ def start_exam_mode(userlist: UserList, who: AuthenticatedUser = Depends(UserLis
     :type who: AuthenticatedUser
     :param userlist: List of samaccountname for whom start the exam
     :type userlist: UserList
+    :param background: Run the command as a job
+    :type background: bool
     :return: Session details
     :rtype: dict
     """
@@ -38,24 +45,35 @@ def start_exam_mode(userlist: UserList, who: AuthenticatedUser = Depends(UserLis
         # Nothing to do
         raise HTTPException(status_code=400, detail=f"Missing userlist of members to handle")
 
-    try:
-        sophomorixCommand = [
-            'sophomorix-exam-mode',
-            '--set',
-            '--supervisor', who.user,
-            '-j',
-            '--participants', ','.join(userlist.users)
-        ]
-        lmn_getSophomorixValue(sophomorixCommand, 'COMMENT_EN')
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error starting exam mode: {str(e)}")
+    async def start():
+        try:
+            sophomorixCommand = [
+                'sophomorix-exam-mode',
+                '--set',
+                '--supervisor', who.user,
+                '-j',
+                '--participants', ','.join(userlist.users)
+            ]
+            await lmn_getSophomorixValueAsync(sophomorixCommand, 'COMMENT_EN', null_as_string=False)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error starting exam mode: {str(e)}")
+
+    return await run_or_submit(background, who, 'exam-start', start)
 
 
 @router.post("/stop", name="Stop exam")
-def stop_exam_mode(stopexam: StopExam, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def stop_exam_mode(stopexam: StopExam, background: bool = False, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Stop exam of the authenticated user
 
+    Stopping an exam collects the files of all participants, which may take a
+    while.
+    With the query parameter `background=true`, the command runs as a job:
+    the response is a `202` with the id of the job, whose status and result
+    are available on `/v1/jobs/{id}`.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -68,6 +86,8 @@ def stop_exam_mode(stopexam: StopExam, who: AuthenticatedUser = Depends(UserList
     :type who: AuthenticatedUser
     :param userlist: List of samaccountname for whom stop the exam
     :type userlist: UserList
+    :param background: Run the command as a job
+    :type background: bool
     :return: Session details
     :rtype: dict
     """
@@ -80,14 +100,19 @@ def stop_exam_mode(stopexam: StopExam, who: AuthenticatedUser = Depends(UserList
     now = strftime("%Y-%m-%d_%Hh%Mm%S", localtime())
     target = f'EXAM_{stopexam.group_type}_{stopexam.group_name}_{now}'
 
-    try:
-        sophomorixCommand = [
-            'sophomorix-exam-mode',
-            '--unset',
-            '--subdir', f'transfer/collected/{target}',
-            '-j',
-            '--participants', ','.join(stopexam.users)
-        ]
-        lmn_getSophomorixValue(sophomorixCommand, 'COMMENT_EN')
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error stoping exam mode: {str(e)}")
+    async def stop():
+        try:
+            sophomorixCommand = [
+                'sophomorix-exam-mode',
+                '--unset',
+                '--subdir', f'transfer/collected/{target}',
+                '-j',
+                '--participants', ','.join(stopexam.users)
+            ]
+            await lmn_getSophomorixValueAsync(sophomorixCommand, 'COMMENT_EN', null_as_string=False)
+        except HTTPException:
+            raise
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error stoping exam mode: {str(e)}")
+
+    return await run_or_submit(background, who, 'exam-stop', stop)
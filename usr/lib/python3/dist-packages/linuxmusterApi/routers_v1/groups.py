@@ -1,9 +1,11 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 from security import RoleChecker, UserListChecker, AuthenticatedUser
 from .body_schemas import UserList, Project as NewGroup
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr, LMNLdapWriter as lw
+from utils.ldap import lr, lw
 from linuxmusterTools.common import Validator, STRING_RULES
+from utils.executors import run_ldap
+from utils.responses import cached_response
 
 
 router = APIRouter(
@@ -13,11 +15,13 @@ router = APIRouter(
 )
 
 @router.get("/", name="List all groups")
-def get_groups_list(who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def get_groups_list(request: Request, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## List all details of all groups.
 
     For global-administrators, the search will be done in all schools.
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
 
     ### Access
     - global-administrators
@@ -32,10 +36,10 @@ def get_groups_list(who: AuthenticatedUser = Depends(RoleChecker("GS"))):
 
 
     # School specific request. For global-admins, it will return all groups from all schools
-    return lr.get('/groups', school=who.school)
+    return await cached_response(request, 'groups', (who.school,), lambda: lr.get('/groups', school=who.school))
 
 @router.get("/{group}", name="Get all details from a specific group")
-def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Get all details of a specific group.
 
@@ -56,7 +60,7 @@ def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("
 
 
     # School specific request. For global-admins, it will search in all groups from all schools
-    group_details = lr.get(f'/groups/{group}', school=who.school)
+    group_details = await run_ldap(lr.get, f'/groups/{group}', school=who.school)
 
     if not group_details:
         raise HTTPException(status_code=404, detail=f"Group {group} not found.")
@@ -64,7 +68,7 @@ def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("
     return group_details
 
 @router.delete("/{group}", status_code=204, name="TODO Delete a specific group")
-def delete_group(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def delete_group(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Delete a specific group
 
@@ -83,7 +87,7 @@ def delete_group(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))
 
 
     # School specific request. For global-admins, it will search in all groups from all schools
-    group_details = lr.get(f'/groups/{group}', school=who.school)
+    group_details = await run_ldap(lr.get, f'/groups/{group}', school=who.school)
 
     if not group_details:
        raise HTTPException(status_code=404, detail=f"Group {group} not found.")
@@ -91,7 +95,7 @@ def delete_group(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))
     # TODO: add delete_unit in linuxmuster-tools
 
 @router.post("/{group}", name="TODO Create a new group")
-def create_group(group: str, group_details: NewGroup, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def create_group(group: str, group_details: NewGroup, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Create a new group
 
@@ -115,7 +119,7 @@ def create_group(group: str, group_details: NewGroup, who: AuthenticatedUser = D
         raise HTTPException(status_code=422, detail=f"{group} is not a valid name. Valid chars are {STRING_RULES['group']}")
 
     # School specific request. For global-admins, it will return all groups from all schools
-    groups = lr.get('/groups', attributes=['cn'], school=who.school)
+    groups = await run_ldap(lr.get, '/groups', attributes=['cn'], school=who.school)
     if {'cn': group} in groups or {'cn': f"p_{group}"} in groups:
         raise HTTPException(status_code=400, detail=f"Group {group} already exists on this server.")
 
@@ -144,7 +148,7 @@ def create_group(group: str, group_details: NewGroup, who: AuthenticatedUser = D
     # TODO: add add_unit to linuxmuster-tools
 
 @router.patch("/{group}", name="TODO Update the parameters of a specific group")
-def modify_group(group: str, group_details: NewGroup, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def modify_group(group: str, group_details: NewGroup, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Update the parameters of a specific group
 
@@ -168,7 +172,7 @@ def modify_group(group: str, group_details: NewGroup, who: AuthenticatedUser = D
 
 
     # School specific request. For global-admins, it will search in all groups from all schools
-    group_details = lr.get(f'/groups/{group}', school=who.school)
+    group_details = await run_ldap(lr.get, f'/groups/{group}', school=who.school)
 
     if not group_details:
        raise HTTPException(status_code=404, detail=f"Group {group} not found.")
@@ -0,0 +1,106 @@
+import os
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import FileResponse
+
+from security import AuthenticatedUser, check_authentication_header
+from utils.executors import run_store
+from utils.jobs import job_queue
+
+
+router = APIRouter(
+    prefix="/jobs",
+    tags=["Jobs"],
+    responses={404: {"description": "Not found"}},
+)
+
+async def _get_job_or_404(job_id, who):
+    job = await run_store(job_queue.store.get, job_id)
+
+    # Don't tell other users that the job exists
+    if job is None or (job['owner'] != who.user and who.role != "globaladministrator"):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+
+    return job
+
+@router.get("/", name="List the jobs of the authenticated user")
+async def get_jobs(who: AuthenticatedUser = Depends(check_authentication_header)):
+    """
+    ## List the jobs started by the authenticated user, newest first.
+
+    Jobs are started by the endpoints accepting the query parameter
+    `background=true`. Finished jobs are kept `jobs.retention` seconds (see
+    config.yml).
+
+    ### Access
+    - all users (own jobs)
+    - global-administrators (all jobs)
+
+    \f
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: List of jobs details (dict)
+    :rtype: list
+    """
+
+
+    owner = None if who.role == "globaladministrator" else who.user
+    return await run_store(job_queue.store.list, owner=owner)
+
+@router.get("/{job_id}", name="Status of a job")
+async def get_job(job_id: str, who: AuthenticatedUser = Depends(check_authentication_header)):
+    """
+    ## Get the status, progress and result of a job.
+
+    `status` is one of `queued`, `running`, `done` or `failed`, `progress`
+    goes from 0 to 1. Once done, `result` contains the response the endpoint
+    would have returned without `background=true`; if the job failed, `error`
+    contains the reason.
+
+    ### Access
+    - all users (own jobs)
+    - global-administrators (all jobs)
+
+    \f
+    :param job_id: Id of the job, returned by the endpoint which started it
+    :type job_id: basestring
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: Job details
+    :rtype: dict
+    """
+
+
+    return await _get_job_or_404(job_id, who)
+
+@router.get("/{job_id}/file", name="Download the file produced by a job")
+async def get_job_file(job_id: str, who: AuthenticatedUser = Depends(check_authentication_header)):
+    """
+    ## Download the file produced by a job, e.g. by print-passwords.
+
+    ### Access
+    - all users (own jobs)
+    - global-administrators (all jobs)
+
+    \f
+    :param job_id: Id of the job, returned by the endpoint which started it
+    :type job_id: basestring
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: The file
+    :rtype: FileResponse
+    """
+
+
+    job = await _get_job_or_404(job_id, who)
+
+    if job['status'] != 'done':
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job['status']}")
+
+    result = job['result']
+    file = result.get('file', None) if isinstance(result, dict) else None
+    # Only the name of the file is given to the client, it's kept with the job
+    path = os.path.join(job_queue.store.files_dir(job_id), os.path.basename(file['filename'])) if file else None
+    if path is None or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail=f"Job {job_id} did not produce any file")
+
+    return FileResponse(path=path, filename=file['filename'], media_type=file['media_type'])
@@ -4,7 +4,8 @@ from fastapi import APIRouter, Depends, HTTPException
 
 from security import RoleChecker, UserListChecker, AuthenticatedUser
 from .body_schemas import UserList
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr, LMNLdapWriter as lw
+from utils.executors import run_ldap
+from utils.ldap import lr, lw
 
 
 router = APIRouter(
@@ -14,7 +15,7 @@ router = APIRouter(
 )
 
 @router.get("/", name="List all samba management groups")
-def get_management_groups_list(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_management_groups_list(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## List all available samba management groups.
 
@@ -35,10 +36,10 @@ def get_management_groups_list(who: AuthenticatedUser = Depends(RoleChecker("GST
     """
 
 
-    return lr.getval('/managementgroups', 'cn', school=who.school)
+    return await run_ldap(lr.getval, '/managementgroups', 'cn', school=who.school)
 
 @router.get("/{group}", name="Get details of a specific management group")
-def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## List all informations of a specific samba management group.
 
@@ -59,15 +60,28 @@ def get_group_details(group: str, who: AuthenticatedUser = Depends(RoleChecker("
     """
 
 
-    group_details = lr.get(f'/managementgroups/{group}', school=who.school)
+    group_details = await run_ldap(lr.get, f'/managementgroups/{group}', school=who.school)
 
     if group_details:
         return group_details
 
     raise HTTPException(status_code=404, detail=f"Management group {group} not found.")
 
+def _remove_members(group, members):
+    for member in members:
+        dn = lr.getval(f'/users/{member}', 'dn')
+        if dn:
+            try:
+                lw.delattr_managementgroup(group, data={'member': dn})
+            except ldap.UNWILLING_TO_PERFORM as e:
+                if 'Attribute member already deleted for target' in str(e):
+                    # User already deleted from the group, ignoring
+                    pass
+        else:
+            logging.warning(f"User {member} not found, will not delete from management group {group}")
+
 @router.delete("/{group}/members", status_code=204, name="Remove users from a specific management group")
-def remove_user_from_group(group: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def remove_user_from_group(group: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Remove members from a specific management group.
 
@@ -93,27 +107,30 @@ def remove_user_from_group(group: str, userlist: UserList, who: AuthenticatedUse
         # Nothing to do
         raise HTTPException(status_code=400, detail=f"Missing userlist of members to delete")
 
-    group_details = lr.get(f'/managementgroups/{group}', school=who.school)
+    group_details = await run_ldap(lr.get, f'/managementgroups/{group}', school=who.school)
 
     if not group_details:
         raise HTTPException(status_code=404, detail=f"Management group {group} not found.")
 
-    for member in userlist.users:
+    await run_ldap(_remove_members, group, userlist.users)
+
+    return
+
+def _add_members(group, members):
+    for member in members:
         dn = lr.getval(f'/users/{member}', 'dn')
         if dn:
             try:
-                lw.delattr_managementgroup(group, data={'member': dn})
-            except ldap.UNWILLING_TO_PERFORM as e:
-                if 'Attribute member already deleted for target' in str(e):
+                lw.setattr_managementgroup(group, data={'member': dn}, add=True)
+            except ldap.ALREADY_EXISTS as e:
+                if 'Attribute member already exists for target' in str(e):
                     # User already deleted from the group, ignoring
                     pass
         else:
-            logging.warning(f"User {member} not found, will not delete from management group {group}")
-
-    return
+            logging.warning(f"User {member} not found, will not add it to management group {group}")
 
 @router.post("/{group}/members", name="Add users to a specific management group")
-def add_user_to_group(group: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def add_user_to_group(group: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Add members to a specific management group.
 
@@ -139,21 +156,11 @@ def add_user_to_group(group: str, userlist: UserList, who: AuthenticatedUser = D
         # Nothing to do
         raise HTTPException(status_code=400, detail=f"Missing userlist of members to add")
 
-    group_details = lr.get(f'/managementgroups/{group}', school=who.school)
+    group_details = await run_ldap(lr.get, f'/managementgroups/{group}', school=who.school)
 
     if not group_details:
         raise HTTPException(status_code=404, detail=f"Management group {group} not found.")
 
-    for member in userlist.users:
-        dn = lr.getval(f'/users/{member}', 'dn')
-        if dn:
-            try:
-                lw.setattr_managementgroup(group, data={'member': dn}, add=True)
-            except ldap.ALREADY_EXISTS as e:
-                if 'Attribute member already exists for target' in str(e):
-                    # User already deleted from the group, ignoring
-                    pass
-        else:
-            logging.warning(f"User {member} not found, will not add it to management group {group}")
+    await run_ldap(_add_members, group, userlist.users)
 
     return
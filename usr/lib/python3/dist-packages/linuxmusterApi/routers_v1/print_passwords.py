@@ -1,9 +1,20 @@
+import contextlib
+import fcntl
+import os
+import shutil
 import subprocess
+import tempfile
+from time import time
 from fastapi.responses import FileResponse
 from fastapi import APIRouter, Depends, HTTPException, Request
+from starlette.background import BackgroundTask
 
 from security import RoleChecker, AuthenticatedUser, check_print_permissions
 from utils.checks import get_schoolclass_or_404, get_project_or_404
+from utils.executors import run_ldap, run_sophomorix
+from utils.jobs import job_file_path, run_or_submit
+from utils.metrics import observe_sophomorix
+from utils.tracing import span
 from .body_schemas import PrintPasswordsSchoolclassesParameter, PrintPasswordsUsersParameter, PrintPasswordsProjectsParameter
 
 
@@ -13,6 +24,8 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+PRINT_DATA_DIR = '/var/lib/sophomorix/print-data'
+
 def sophomorixprint_cmd(who, config, schoolclasses=[], users=[]):
     """
     Run sophomorix-print with the given configuration and users.
@@ -57,14 +70,83 @@ def sophomorixprint_cmd(who, config, schoolclasses=[], users=[]):
     if config.one_per_page:
         cmd.extend(['--one-per-page'])
 
+    start = time()
     try:
         shell_env = {'TERM': 'xterm', 'SHELL': '/bin/bash',  'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',  'HOME': '/root', '_': '/usr/bin/python3'}
-        subprocess.check_call(cmd, shell=False, env=shell_env)
+        with span('sophomorix', 'sophomorix-print'):
+            subprocess.check_call(cmd, shell=False, env=shell_env)
+        observe_sophomorix(cmd, 0, time() - start)
     except subprocess.CalledProcessError as e:
+        observe_sophomorix(cmd, e.returncode, time() - start)
         raise HTTPException(status_code=500, detail=str(e))
 
+@contextlib.contextmanager
+def print_lock(file_path):
+    """
+    Exclusive lock on a file written by sophomorix-print, also between the
+    workers. The lock file is removed when released.
+    """
+
+    lock_path = f'{file_path}.lock'
+    while True:
+        lock = open(lock_path, 'w')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            # Else the lock file was removed by the previous holder while waiting
+            if os.fstat(lock.fileno()).st_ino == os.stat(lock_path).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+    try:
+        yield
+    finally:
+        os.remove(lock_path)
+        lock.close()
+
+def print_to(target, who, config, filename, **users):
+    """
+    Run sophomorix-print and move the generated file to target.
+
+    sophomorix-print always writes the same file for a caller and a group:
+    the runs writing the same file wait for each other, also in the other
+    workers, so that each one gets its own file.
+    """
+
+    file_path = f'{PRINT_DATA_DIR}/{filename}'
+    with print_lock(file_path):
+        sophomorixprint_cmd(who, config, **users)
+        shutil.move(file_path, target)
+
+async def print_response(background, who, config, mtype, filename, **users):
+    """
+    Run sophomorix-print and return the generated file, or queue it as a job
+    if background is set. The file of a job is kept with the job, and
+    downloaded on /v1/jobs/{id}/file.
+    """
+
+    async def print_file():
+        path = job_file_path(filename)
+        await run_sophomorix(print_to, path, who, config, filename, **users)
+        return {'file': {'filename': filename, 'media_type': mtype}}
+
+    if background:
+        return await run_or_submit(background, who, 'print-passwords', print_file)
+
+    # Removed once sent
+    fd, path = tempfile.mkstemp(prefix='lmnapi-', suffix=f'-{filename}', dir=PRINT_DATA_DIR)
+    os.close(fd)
+    try:
+        await run_sophomorix(print_to, path, who, config, filename, **users)
+    except BaseException:
+        os.remove(path)
+        raise
+
+    return FileResponse(path=path, filename=filename, media_type=mtype, background=BackgroundTask(os.remove, path))
+
 @router.post("/schoolclasses", name="Print passwords from schoolclasses")
-def print_passwords_schoolclasses(config: PrintPasswordsSchoolclassesParameter, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def print_passwords_schoolclasses(config: PrintPasswordsSchoolclassesParameter, background: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Print passwords from multiple schoolclasses.
 
@@ -85,7 +167,13 @@ def print_passwords_schoolclasses(config: PrintPasswordsSchoolclassesParameter,
     Unfortunately it's possible that the tex compilation failed, and in this case
     we don't get any error message from the backend.
 
+    With the query parameter `background=true`, the file is generated by a
+    job: the response is a `202` with the id of the job, and the file can be
+    downloaded on `/v1/jobs/{id}/file` once done.
+
     \f
+    :param background: Generate the file in a job
+    :type background: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of all schoolclasses details (dict)
@@ -101,9 +189,7 @@ def print_passwords_schoolclasses(config: PrintPasswordsSchoolclassesParameter,
         raise HTTPException(status_code=400, detail=f"{config.format} is a wrong format")
 
     for schoolclass in config.schoolclasses:
-        get_schoolclass_or_404(schoolclass, who.school)
-
-    sophomorixprint_cmd(who, config, schoolclasses=schoolclass)
+        await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
 
     if len(config.schoolclasses) == 1:
         prefix = 'add'
@@ -113,12 +199,11 @@ def print_passwords_schoolclasses(config: PrintPasswordsSchoolclassesParameter,
         prefix = 'multiclass'
 
     filename = f'{prefix}-{who.user}.{config.format}'
-    file_path = f'/var/lib/sophomorix/print-data/{filename}'
 
-    return FileResponse(path=file_path, filename=filename, media_type=mtype)
+    return await print_response(background, who, config, mtype, filename, schoolclasses=schoolclass)
 
 @router.post("/projects", name="Print passwords from projects")
-def print_passwords_projects(config: PrintPasswordsProjectsParameter, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def print_passwords_projects(config: PrintPasswordsProjectsParameter, background: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Print passwords from the users multiple projects.
 
@@ -143,7 +228,13 @@ def print_passwords_projects(config: PrintPasswordsProjectsParameter, who: Authe
     Unfortunately it's possible that the tex compilation failed, and in this case
     we don't get any error message from the backend.
 
+    With the query parameter `background=true`, the file is generated by a
+    job: the response is a `202` with the id of the job, and the file can be
+    downloaded on `/v1/jobs/{id}/file` once done.
+
     \f
+    :param background: Generate the file in a job
+    :type background: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of all schoolclasses details (dict)
@@ -162,22 +253,19 @@ def print_passwords_projects(config: PrintPasswordsProjectsParameter, who: Authe
         raise HTTPException(status_code=400, detail=f"{config.format} is a wrong format")
 
     for project in config.projects:
-        details = get_project_or_404(project, who.school)
-        details.get_all_members()
+        details = await run_ldap(get_project_or_404, project, who.school)
+        await run_ldap(details.get_all_members)
         users_to_print = users_to_print.union(set(details.all_members))
 
-    users_to_print = check_print_permissions(who, users_to_print)
-
-    sophomorixprint_cmd(who, config, users=users_to_print)
+    users_to_print = await run_ldap(check_print_permissions, who, users_to_print)
 
     filename = f'user-{who.user}.{config.format}'
-    file_path = f'/var/lib/sophomorix/print-data/{filename}'
 
-    return FileResponse(path=file_path, filename=filename, media_type=mtype)
+    return await print_response(background, who, config, mtype, filename, users=users_to_print)
 
 
 @router.post("/users", name="Print passwords of users")
-def print_passwords_users(config: PrintPasswordsUsersParameter, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def print_passwords_users(config: PrintPasswordsUsersParameter, background: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Print passwords of some users.
 
@@ -202,7 +290,13 @@ def print_passwords_users(config: PrintPasswordsUsersParameter, who: Authenticat
     Unfortunately it's possible that the tex compilation failed, and in this case
     we don't get any error message from the backend.
 
+    With the query parameter `background=true`, the file is generated by a
+    job: the response is a `202` with the id of the job, and the file can be
+    downloaded on `/v1/jobs/{id}/file` once done.
+
     \f
+    :param background: Generate the file in a job
+    :type background: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of all schoolclasses details (dict)
@@ -220,13 +314,10 @@ def print_passwords_users(config: PrintPasswordsUsersParameter, who: Authenticat
     else:
         raise HTTPException(status_code=400, detail=f"{config.format} is a wrong format")
 
-    users_to_print = check_print_permissions(who, users_to_print)
-
-    sophomorixprint_cmd(who, config, users=users_to_print)
+    users_to_print = await run_ldap(check_print_permissions, who, users_to_print)
 
     filename = f'user-{who.user}.{config.format}'
-    file_path = f'/var/lib/sophomorix/print-data/{filename}'
 
-    return FileResponse(path=file_path, filename=filename, media_type=mtype)
+    return await print_response(background, who, config, mtype, filename, users=users_to_print)
 
 
@@ -1,9 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 
 from security import RoleChecker, AuthenticatedUser
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr, LMNLdapWriter as lw
 from utils.checks import get_printer_or_404
-from utils.sophomorix import lmn_getSophomorixValue
+from utils.executors import run_ldap
+from utils.ldap import get_users, lr, lw
+from utils.responses import cached_response, response_cache
+from utils.snapshot import directory_snapshot
+from utils.sophomorix import lmn_getSophomorixValueAsync
 from .body_schemas import Printer
 
 
@@ -14,11 +17,13 @@ router = APIRouter(
 )
 
 @router.get("/", name="List all printers")
-def get_all_printers(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_all_printers(request: Request, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## List all printers with all available informations.
 
     Output informations are e.g. cn, dn, members, etc...
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
 
     ### Access
     - global-administrators
@@ -33,10 +38,23 @@ def get_all_printers(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
 
 
-    return lr.get('/printers', school=who.school)
+    return await cached_response(request, 'printers', (who.school,), lambda: lr.get('/printers', school=who.school))
+
+def _printer_details(printer, school, all_members):
+    printer_details = get_printer_or_404(printer, school)
+
+    if all_members:
+        printer_details.get_all_members()
+
+    printer_details = printer_details.asdict()
+
+    if all_members:
+        printer_details['members'] = get_users(printer_details['all_members'])
+
+    return printer_details
 
 @router.get("/{printer}", name="Get details of a specific printer")
-def get_printer(printer: str, all_members: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_printer(printer: str, all_members: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## List all available informations of a specific schooclass.
 
@@ -60,15 +78,7 @@ def get_printer(printer: str, all_members: bool = False, who: AuthenticatedUser
 
 
     # TODO: Check group membership
-    printer_details = get_printer_or_404(printer, who.school)
-
-    if all_members:
-        printer_details.get_all_members()
-
-    printer_details = printer_details.asdict()
-
-    if all_members:
-        printer_details['members'] = [lr.get(f'/users/{member}') for member in printer_details['all_members']]
+    printer_details = await run_ldap(_printer_details, printer, who.school, all_members)
 
     if who.role in ["schooladministrator", "globaladministrator"]:
         # No filter
@@ -83,7 +93,7 @@ def get_printer(printer: str, all_members: bool = False, who: AuthenticatedUser
         raise HTTPException(status_code=403, detail=f"Forbidden")
 
 @router.patch("/{printer}", status_code=204, name="Patch printer")
-def patch_printer(printer: str, printer_details: Printer, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def patch_printer(printer: str, printer_details: Printer, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Update the parameters of a specific printer
 
@@ -102,7 +112,13 @@ def patch_printer(printer: str, printer_details: Printer, who: AuthenticatedUser
     """
 
 
-    printer_exists = get_printer_or_404(printer, who.school)
+    await run_ldap(_patch_printer, printer, printer_details, who.school)
+    response_cache.invalidate('printers')
+
+    return
+
+def _patch_printer(printer, printer_details, school):
+    printer_exists = get_printer_or_404(printer, school)
 
     printer_member = printer_exists.member
     members_changed = False
@@ -157,10 +173,8 @@ def patch_printer(printer: str, printer_details: Printer, who: AuthenticatedUser
 
     lw.setattr_printer(printer.lower(), data=to_change)
 
-    return
-
 @router.post("/{printer}/join", name="Join an existing printer group")
-def join_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
+async def join_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
     """
     ## Join an existing printer group
 
@@ -179,10 +193,13 @@ def join_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T")
     :type who: AuthenticatedUser
     """
 
-    get_printer_or_404(printer, who.school)
+    await run_ldap(get_printer_or_404, printer, who.school)
 
     cmd = ['sophomorix-group',  '--addmembers', who.user, '--group', printer.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+
+    response_cache.invalidate('printers')
+    await run_ldap(directory_snapshot.refresh, 'printer', printer.lower())
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
@@ -191,7 +208,7 @@ def join_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T")
     return result
 
 @router.post("/{printer}/quit", name="Quit an existing printer group")
-def quit_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
+async def quit_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
     """
     ## Quit an existing printer group
 
@@ -210,10 +227,13 @@ def quit_printer(printer: str, who: AuthenticatedUser = Depends(RoleChecker("T")
     :type who: AuthenticatedUser
     """
 
-    get_printer_or_404(printer, who.school)
+    await run_ldap(get_printer_or_404, printer, who.school)
 
     cmd = ['sophomorix-group',  '--removemembers', who.user, '--group', printer.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+
+    response_cache.invalidate('printers')
+    await run_ldap(directory_snapshot.refresh, 'printer', printer.lower())
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
@@ -1,11 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 
-from security import RoleChecker, UserListChecker, AuthenticatedUser
+from security import RoleChecker, UserListChecker, AuthenticatedUser, filter_readable_users
 from .body_schemas import Project
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr, LMNLdapWriter as lw
 from linuxmusterTools.common import Validator, STRING_RULES
-from utils.sophomorix import lmn_getSophomorixValue
+from utils.sophomorix import lmn_getSophomorixValueAsync
 from utils.checks import get_project_or_404
+from utils.executors import run_ldap
+from utils.jobs import run_or_submit, set_progress
+from utils.ldap import get_users, lr, lw
+from utils.quotas import quota_collector
+from utils.responses import cached_response, response_cache
+from utils.snapshot import directory_snapshot
 
 
 router = APIRouter(
@@ -14,14 +19,40 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+def _visible_projects(who):
+    """
+    List the projects the authenticated user can see.
+    """
+
+    # School specific request. For global-admins, it will return all projects from all schools
+    projects = lr.get('/projects', school=who.school)
+
+    if who.role in ["schooladministrator", "globaladministrator"]:
+        # No filter
+        return projects
+
+    elif who.role == "teacher":
+        # Only the teacher's project or not hidden projects or project in which the teacher is member of
+        # TODO: read sophomorixMemberGroups and sophomorixAdminGroups too
+        response =  []
+        for project in projects:
+            if who.user in project['sophomorixAdmins'] or who.user in project['sophomorixMembers']:
+                response.append(project)
+            elif not project['sophomorixHidden']:
+                response.append(project)
+        return response
+
 @router.get("/", name="List all projects the authenticated user can see")
-def get_projects_list(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_projects_list(request: Request, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## List all details of all projects.
 
     The authenticated user can only see projects he's a member of, or not hidden.
     For global-administrators, the search will be done in all schools.
 
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -35,26 +66,29 @@ def get_projects_list(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
 
 
-    # School specific request. For global-admins, it will return all projects from all schools
-    projects = lr.get('/projects', school=who.school)
+    # Teachers get a filtered list, so one variant per teacher
+    role_filter = who.user if who.role == "teacher" else who.role
 
-    if who.role in ["schooladministrator", "globaladministrator"]:
-        # No filter
-        return projects
+    return await cached_response(request, 'projects', (who.school, role_filter), lambda: _visible_projects(who))
 
-    elif who.role == "teacher":
-        # Only the teacher's project or not hidden projects or project in which the teacher is member of
-        # TODO: read sophomorixMemberGroups and sophomorixAdminGroups too
-        response =  []
-        for project in projects:
-            if who.user in project['sophomorixAdmins'] or who.user in project['sophomorixMembers']:
-                response.append(project)
-            elif not project['sophomorixHidden']:
-                response.append(project)
-        return response
+def _project_details(project, school, all_members):
+    project_details = get_project_or_404(project, school)
+
+    if all_members:
+        project_details.get_all_members()
+
+    project_details = project_details.asdict()
+
+    if all_members:
+        all_users = list(set(project_details['all_members']) | set(project_details['all_admins']))
+        users_details = dict(zip(all_users, get_users(all_users)))
+        project_details['members'] = [users_details[member] for member in project_details['all_members']]
+        project_details['admins'] = [users_details[member] for member in project_details['all_admins']]
+
+    return project_details
 
 @router.get("/{project}", name="Get all details from a specific project")
-def get_project_details(project: str, all_members: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_project_details(project: str, all_members: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Get all details of a specific project.
 
@@ -78,16 +112,7 @@ def get_project_details(project: str, all_members: bool = False, who: Authentica
     """
 
 
-    project_details = get_project_or_404(project, who.school)
-    
-    if all_members:
-        project_details.get_all_members()
-    
-    project_details = project_details.asdict()
-
-    if all_members:
-        project_details['members'] = [lr.get(f'/users/{member}') for member in project_details['all_members']]
-        project_details['admins'] = [lr.get(f'/users/{member}') for member in project_details['all_admins']]
+    project_details = await run_ldap(_project_details, project, who.school, all_members)
 
     if who.role in ["schooladministrator", "globaladministrator"]:
         # No filter
@@ -102,14 +127,70 @@ def get_project_details(project: str, all_members: bool = False, who: Authentica
             return project_details
         raise HTTPException(status_code=403, detail=f"Forbidden")
 
+def _project_members(project, school):
+    project_details = get_project_or_404(project, school)
+    project_details.get_all_members()
+    return project_details.asdict()
+
+@router.get("/{project}/quotas", name="Quotas of all members of a specific project")
+async def get_project_quotas(project: str, fresh: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+    """
+    ## Get the quotas of all members of a specific project.
+
+    The members are searched recursively in all nested groups. The quotas of
+    each member are served from memory if they were collected less than
+    `quotas.ttl` seconds ago, else collected again (with the query parameter
+    `fresh=true`, always). `updated` is the timestamp of the collection, and
+    `error` is set instead of `quotas` if the collection failed.
+
+    The authenticated user can only see projects he's a member of, or not hidden.
+
+    Only the members whose quotas the authenticated user can see on
+    `/users/{user}/quotas` are listed.
+
+    ### Access
+    - global-administrators
+    - school-administrators
+    - teachers (own data and students)
+
+    \f
+    :param project: cn of the project
+    :type project: basestring
+    :param fresh: Collect the quotas again
+    :type fresh: bool
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: Quotas details by member (dict)
+    :rtype: dict
+    """
+
+
+    project_details = await run_ldap(_project_members, project, who.school)
+
+    if who.role == "teacher":
+        # TODO: read sophomorixMemberGroups and sophomorixAdminGroups too
+        if (who.user not in project_details['sophomorixAdmins']
+                and who.user not in project_details['sophomorixMembers']
+                and project_details['sophomorixHidden']):
+            raise HTTPException(status_code=403, detail="Forbidden")
+
+    # Other teachers and the administrators are only visible to the administrators
+    members = await run_ldap(filter_readable_users, who, project_details['all_members'])
+
+    return await quota_collector.get_many(members, fresh=fresh)
+
 @router.delete("/{project}", status_code=204, name="Delete a specific project")
-def delete_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def delete_project(project: str, background: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Delete a specific project
 
     The authenticated user can only delete a project if he's a admin of, or if
     he's an admin.
 
+    With the query parameter `background=true`, the command runs as a job:
+    the response is a `202` with the id of the job, whose status and result
+    are available on `/v1/jobs/{id}`.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -120,6 +201,8 @@ def delete_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("G
     \f
     :param project: cn of the project to delete
     :type project: basestring
+    :param background: Run the command as a job
+    :type background: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of all projects details (dict)
@@ -127,29 +210,39 @@ def delete_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("G
     """
 
 
-    project_details = get_project_or_404(project, who.school)
+    project_details = await run_ldap(get_project_or_404, project, who.school)
 
     cmd = ['sophomorix-project', '--kill', '-p', project, '--school', who.school, '-jj']
 
+    async def kill():
+        result = await lmn_getSophomorixValueAsync(cmd, '')
+        response_cache.invalidate('projects')
+        await run_ldap(directory_snapshot.refresh, 'project', project_details.cn)
+        return result
+
     if who.role in ["schooladministrator", "globaladministrator"]:
         # No filter
-        return lmn_getSophomorixValue(cmd, '')
+        return await run_or_submit(background, who, 'project-delete', kill)
 
     elif who.role == "teacher":
         # Only if the teacher is admin of the project
         # TODO: read sophomorixAdminGroups too
         if who.user in project_details.sophomorixAdmins:
-            return lmn_getSophomorixValue(cmd, '')
+            return await run_or_submit(background, who, 'project-delete', kill)
         raise HTTPException(status_code=403, detail=f"Forbidden")
 
 @router.post("/{project}", name="Create a new project")
-def create_project(project: str, project_details: Project, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def create_project(project: str, project_details: Project, background: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Create a new project
 
     *project_details* are the attribute of the project, like *description*,
     *join* if the project should be joinable, *hide*, etc ...
 
+    With the query parameter `background=true`, the command runs as a job:
+    the response is a `202` with the id of the job, whose status and result
+    are available on `/v1/jobs/{id}`.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -162,6 +255,8 @@ def create_project(project: str, project_details: Project, who: AuthenticatedUse
     :type project: basestring
     :param project_details: Parameter of the project, see Project attributes
     :type project_details: Project
+    :param background: Run the command as a job
+    :type background: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of all projects details (dict)
@@ -173,7 +268,7 @@ def create_project(project: str, project_details: Project, who: AuthenticatedUse
         raise HTTPException(status_code=422, detail=f"{project} is not a valid name. Valid chars are {STRING_RULES['project']}")
 
     # School specific request. For global-admins, it will return all projects from all schools
-    projects = lr.get('/projects', attributes=['cn'], school=who.school)
+    projects = await run_ldap(lr.get, '/projects', attributes=['cn'], school=who.school)
     if {'cn': project} in projects or {'cn': f"p_{project}"} in projects:
         raise HTTPException(status_code=400, detail=f"Project {project} already exists on this server.")
 
@@ -223,24 +318,32 @@ def create_project(project: str, project_details: Project, who: AuthenticatedUse
         options.extend(['--school', project_details.school])
 
     cmd = ['sophomorix-project',  *options, '--create', '-p', project.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
 
-    output = result.get("OUTPUT", [{}])[0]
-    if output.get("TYPE", "") == "ERROR":
-        raise HTTPException(status_code=400, detail=output["MESSAGE_EN"])
+    async def create():
+        result = await lmn_getSophomorixValueAsync(cmd, '')
+        response_cache.invalidate('projects')
 
-    if project_details.proxyAddresses:
-        lw.setattr_project(f"p_{project.lower()}", data={'proxyAddresses': project_details.proxyAddresses})
+        output = result.get("OUTPUT", [{}])[0]
+        if output.get("TYPE", "") == "ERROR":
+            raise HTTPException(status_code=400, detail=output["MESSAGE_EN"])
 
-    if project_details.displayName:
-        lw.setattr_project(f"p_{project.lower()}", data={'displayName': project_details.displayName})
-    else:
-        lw.setattr_project(f"p_{project.lower()}", data={'displayName': project})
+        # Project created, only the LDAP attributes are missing
+        await set_progress(0.8)
 
-    return result
+        if project_details.proxyAddresses:
+            await run_ldap(lw.setattr_project, f"p_{project.lower()}", data={'proxyAddresses': project_details.proxyAddresses})
+
+        if project_details.displayName:
+            await run_ldap(lw.setattr_project, f"p_{project.lower()}", data={'displayName': project_details.displayName})
+        else:
+            await run_ldap(lw.setattr_project, f"p_{project.lower()}", data={'displayName': project})
+
+        return result
+
+    return await run_or_submit(background, who, 'project-create', create)
 
 @router.patch("/{project}", name="Update the parameters of a specific project")
-def modify_project(project: str, project_details: Project, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def modify_project(project: str, project_details: Project, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Update the parameters of a specific project
 
@@ -265,7 +368,7 @@ def modify_project(project: str, project_details: Project, who: AuthenticatedUse
     """
 
 
-    project_exists = get_project_or_404(project, who.school)
+    project_exists = await run_ldap(get_project_or_404, project, who.school)
 
     if who.role == "teacher":
         # Only teacher admins of the group should be able to modify the project
@@ -316,22 +419,24 @@ def modify_project(project: str, project_details: Project, who: AuthenticatedUse
         options.extend(['--school', project_details.school])
 
     cmd = ['sophomorix-project',  *options, '-p', project.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+    response_cache.invalidate('projects')
+    await run_ldap(directory_snapshot.refresh, 'project', f"p_{project.lower()}")
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
         raise HTTPException(status_code=400, detail=output["MESSAGE_EN"])
 
     if project_details.proxyAddresses:
-        lw.setattr_project(f"p_{project.lower()}", data={'proxyAddresses': project_details.proxyAddresses})
+        await run_ldap(lw.setattr_project, f"p_{project.lower()}", data={'proxyAddresses': project_details.proxyAddresses})
 
     if project_details.displayName:
-        lw.setattr_project(f"p_{project.lower()}", data={'displayName': project_details.displayName})
+        await run_ldap(lw.setattr_project, f"p_{project.lower()}", data={'displayName': project_details.displayName})
 
     return result
 
 @router.post("/{project}/join", name="Join an existing project")
-def join_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def join_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Join an existing project
 
@@ -353,7 +458,7 @@ def join_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST
     """
 
 
-    project_details = get_project_or_404(project, who.school)
+    project_details = await run_ldap(get_project_or_404, project, who.school)
 
     if who.role == "teacher":
         # Teacher can only join a project if the project is joinable and visible
@@ -361,7 +466,9 @@ def join_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST
             raise HTTPException(status_code=403, detail=f"Forbidden")
 
     cmd = ['sophomorix-project',  '--addmembers', who.user, '-p', project.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+    response_cache.invalidate('projects')
+    await run_ldap(directory_snapshot.refresh, 'project', project_details.cn)
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
@@ -370,7 +477,7 @@ def join_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST
     return result
 
 @router.post("/{project}/quit", name="Quit an existing project")
-def quit_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def quit_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Quit an existing project
 
@@ -391,10 +498,12 @@ def quit_project(project: str, who: AuthenticatedUser = Depends(RoleChecker("GST
     """
 
 
-    get_project_or_404(project, who.school)
+    project_details = await run_ldap(get_project_or_404, project, who.school)
 
     cmd = ['sophomorix-project',  '--removemembers', who.user, '-p', project.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+    response_cache.invalidate('projects')
+    await run_ldap(directory_snapshot.refresh, 'project', project_details.cn)
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
@@ -1,7 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 
 from security import RoleChecker, AuthenticatedUser
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.executors import run_ldap
+from utils.ldap import iter_search_keyword, lr
+from utils.responses import streaming_json_response
 
 
 router = APIRouter(
@@ -11,7 +13,7 @@ router = APIRouter(
 )
 
 @router.get("/{school}/{keyword}", name="Search for an object in a specific school")
-def query_user(school: str='default-school', keyword: str='', who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def query_user(request: Request, school: str='default-school', keyword: str='', stream: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Get basic informations of a specific user.
 
@@ -19,6 +21,10 @@ def query_user(school: str='default-school', keyword: str='', who: Authenticated
     If an user is found, the response provide some basic details like dn,
     sophomorixRole, cn, sophomorixSchoolName, samaccountname, etc ...
 
+    With the query parameter `stream=true`, the results are sent while they are
+    read from LDAP, as a JSON array, or as NDJSON (one object per line) if the
+    header `Accept: application/x-ndjson` is set.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -29,6 +35,8 @@ def query_user(school: str='default-school', keyword: str='', who: Authenticated
     :type school: basestring
     :param keyword: String to search for in the cn/displayName fields
     :type keyword: basestring
+    :param stream: Send the results while reading them from LDAP
+    :type stream: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of user's basic details (not complete, as dict)
@@ -36,7 +44,11 @@ def query_user(school: str='default-school', keyword: str='', who: Authenticated
     """
 
 
+    if stream:
+        results = iter_search_keyword(keyword, school=None if school == 'global' else school)
+        return streaming_json_response(request, results)
+
     if school == 'global':
-        return lr.get(f'/search/{keyword}')
+        return await run_ldap(lr.get, f'/search/{keyword}')
 
-    return lr.get(f'/search/{keyword}', school=school)
+    return await run_ldap(lr.get, f'/search/{keyword}', school=school)
@@ -1,7 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
 
 from security import RoleChecker, AuthenticatedUser
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.executors import run_ldap
+from utils.ldap import get_users_page, iter_users, lr, split_attributes
+from utils.responses import cached_response, streaming_json_response
 
 
 router = APIRouter(
@@ -11,10 +13,13 @@ router = APIRouter(
 )
 
 @router.get("/", name="List all existing roles")
-def get_all_roles(who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def get_all_roles(request: Request, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## List all existing roles
 
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -27,14 +32,51 @@ def get_all_roles(who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
 
 
-    return set([k['sophomorixRole'] for k in lr.get('/search/', attributes=['sophomorixRole']) if k['sophomorixRole']])
+    return await cached_response(
+        request,
+        'roles',
+        ('all',),
+        lambda: set([k['sophomorixRole'] for k in lr.get('/search/', attributes=['sophomorixRole']) if k['sophomorixRole']])
+    )
 
 @router.get("/{role}", name="List all members with a specific role")
-def get_role_users(role: str, school: str | None = 'default-school', who: AuthenticatedUser = Depends(RoleChecker(["GS"]))):
+async def get_role_users(
+        request: Request,
+        response: Response,
+        role: str,
+        school: str | None = 'default-school',
+        limit: int | None = Query(default=None, ge=1, le=1000),
+        cursor: str | None = None,
+        attributes: str | None = None,
+        adminclass: str | None = None,
+        stream: bool = False,
+        who: AuthenticatedUser = Depends(RoleChecker(["GS"]))
+    ):
     """
     ## List all users (and all their details) having a specific role
 
     The given role can be teacher, student, globaladministrator, etc ...
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
+
+    With one of the optional query parameters, the list is paginated:
+    - `limit`: max number of users per page (default 100, max 1000),
+    - `cursor`: value of the header `X-Next-Cursor` of the previous page, to get the next page,
+    - `attributes`: comma separated list of attributes to return (default all),
+    - `adminclass`: only return users from this adminclass.
+
+    The header `X-Next-Cursor` is missing on the last page. The pages are sorted by
+    cn, and the cursor is the last cn of the page: it stays valid if the request is
+    sent to another worker, or if users are created or deleted in between.
+
+    With the query parameter `stream=true`, the users are sent while they are read
+    from LDAP, as a JSON array, or as NDJSON (one user per line) if the header
+    `Accept: application/x-ndjson` is set.
+
+    Without any of these parameters, the whole list is built in memory as before
+    (and then cached, see the ETag above). On large directories, clients should
+    prefer the pagination or `stream=true`, whose memory use does not grow with the
+    number of users.
 
     ### Access
     - global-administrators
@@ -45,6 +87,16 @@ def get_role_users(role: str, school: str | None = 'default-school', who: Authen
     :type role: basestring
     :param school: The school where to get the users
     :type school: basestring
+    :param limit: Max number of users per page
+    :type limit: int
+    :param cursor: Cursor to get the next page
+    :type cursor: basestring
+    :param attributes: Comma separated list of attributes to return
+    :type attributes: basestring
+    :param adminclass: Filter on sophomorixAdminClass
+    :type adminclass: basestring
+    :param stream: Send the users while reading them from LDAP
+    :type stream: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List with all informations of all users with this role (as dict)
@@ -52,8 +104,35 @@ def get_role_users(role: str, school: str | None = 'default-school', who: Authen
     """
 
 
+    if stream:
+        users = iter_users(
+            split_attributes(attributes),
+            role=role,
+            adminclass=adminclass,
+            school=None if 'global' in role else school,
+        )
+        return streaming_json_response(request, users)
+
+    if any(param is not None for param in [limit, cursor, attributes, adminclass]):
+        try:
+            users, next_cursor = await run_ldap(
+                get_users_page,
+                split_attributes(attributes),
+                limit=limit or 100,
+                cursor=cursor,
+                role=role,
+                adminclass=adminclass,
+                school=None if 'global' in role else school,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return users
+
     if 'global' in role:
-        return lr.get(f'/roles/{role}')
+        return await cached_response(request, 'roles', (role,), lambda: lr.get(f'/roles/{role}'))
 
-    return lr.get(f'/roles/{role}', school=school)
+    return await cached_response(request, 'roles', (role, school), lambda: lr.get(f'/roles/{role}', school=school))
 
@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException
 
 from security import RoleChecker, UserListChecker, AuthenticatedUser
-from utils.sophomorix import lmn_getSophomorixValue
+from utils.rooms import room_index
+from utils.sophomorix import lmn_getSophomorixValueAsync
 
 
 router = APIRouter(
@@ -10,27 +11,7 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
-@router.get("/userInRoom/{username}", name="List users connected in the same room.")
-def get_groups_list(username: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
-    """
-    ## Search for users connected in the same room as the given username.
-
-    ### Access
-    - global-administrators
-    - school-administrators
-    - teachers
-
-    ### This endpoint uses Sophomorix.
-
-    \f
-    :param who: User requesting the data, read from API Token
-    :type who: AuthenticatedUser
-    :return: Dict containing usernames and objects
-    :rtype: dict
-    """
-
-    school = who.school
-
+async def _user_in_room_sophomorix(username, school):
     try:
         sophomorixCommand = [
             'sophomorix-query', '-jj', '--smbstatus',
@@ -38,7 +19,7 @@ def get_groups_list(username: str, who: AuthenticatedUser = Depends(RoleChecker(
             '--query-user', username
         ]
 
-        response = lmn_getSophomorixValue(sophomorixCommand, '')
+        response = await lmn_getSophomorixValueAsync(sophomorixCommand, '')
         # remove our own
         room = response[username]['ROOM']
         response.pop(username, None)
@@ -56,5 +37,69 @@ def get_groups_list(username: str, who: AuthenticatedUser = Depends(RoleChecker(
             "objects": {},
         }
 
+def _rooms_school(who):
+    # Global administrators see the rooms of all schools
+    return None if who.role == "globaladministrator" else who.school
+
+@router.get("/userInRoom/{username}", name="List users connected in the same room.")
+async def get_groups_list(username: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+    """
+    ## Search for users connected in the same room as the given username.
+
+    The answer comes from the last smbstatus snapshot (see `rooms.interval`
+    in config.yml), or from sophomorix if the snapshot is not available. Only
+    the rooms of the school of the requesting user are searched, except for
+    global-administrators.
+
+    ### Access
+    - global-administrators
+    - school-administrators
+    - teachers
+
+    ### This endpoint may use Sophomorix.
+
+    \f
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: Dict containing usernames and objects
+    :rtype: dict
+    """
+
+    in_room = room_index.user_in_room(username, school=_rooms_school(who))
+    if in_room is None:
+        return await _user_in_room_sophomorix(username, who.school)
+
+    room, others = in_room
+    return {
+        "usersList": list(others.keys()),
+        "name": room,
+        "objects": others,
+    }
+
+@router.get("/rooms", name="List the users connected in each room.")
+async def get_rooms(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+    """
+    ## List all occupied rooms of the school, with the users connected in them.
+
+    global-administrators get the rooms of all schools.
+
+    The answer comes from the last smbstatus snapshot, taken every
+    `rooms.interval` seconds (see config.yml).
+
+    ### Access
+    - global-administrators
+    - school-administrators
+    - teachers
+
+    \f
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: List of school, room and users (dict)
+    :rtype: list
+    """
 
+    rooms = room_index.list_rooms(school=_rooms_school(who))
+    if rooms is None:
+        raise HTTPException(status_code=503, detail="The users in rooms are not collected yet, or the collection is disabled")
 
+    return rooms
@@ -1,9 +1,13 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 
-from security import RoleChecker, AuthenticatedUser
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from security import RoleChecker, AuthenticatedUser, filter_readable_users
 from utils.checks import get_schoolclass_or_404
-from utils.sophomorix import lmn_getSophomorixValue
+from utils.executors import run_ldap
+from utils.ldap import get_users, lr
+from utils.quotas import quota_collector
+from utils.responses import cached_response, response_cache
+from utils.snapshot import directory_snapshot
+from utils.sophomorix import lmn_getSophomorixValueAsync
 
 
 router = APIRouter(
@@ -13,11 +17,13 @@ router = APIRouter(
 )
 
 @router.get("/", name="List all schoolclasses")
-def get_all_schoolclasses(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_all_schoolclasses(request: Request, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## List all schoolclasses with all available informations.
 
     Output informations are e.g. cn, dn, members, etc...
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
 
     ### Access
     - global-administrators
@@ -32,10 +38,10 @@ def get_all_schoolclasses(who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
 
 
-    return lr.get('/schoolclasses', school=who.school)
+    return await cached_response(request, 'schoolclasses', (who.school,), lambda: lr.get('/schoolclasses', school=who.school))
 
 @router.get("/{schoolclass}", name="Get details of a specific schoolclass")
-def get_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## List all available informations of a specific schooclass.
 
@@ -57,13 +63,14 @@ def get_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleCheck
 
 
     # TODO: Check group membership
-    schoolclass = get_schoolclass_or_404(schoolclass, who.school)
-    schoolclass['members'] = [lr.get(f'/users/{member}') for member in schoolclass['sophomorixMembers']]
+    await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
+    schoolclass_details = await run_ldap(lr.get, f'/schoolclasses/{schoolclass}', school=who.school)
+    schoolclass_details['members'] = await run_ldap(get_users, schoolclass_details['sophomorixMembers'])
 
-    return schoolclass
+    return schoolclass_details
 
 @router.get("/{schoolclass}/first_passwords", name="Get all first passwords of the members of a specific schoolclass")
-def get_schoolclass_passwords(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_schoolclass_passwords(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Get the first passwords of all members of a specific schooclass.
 
@@ -90,12 +97,13 @@ def get_schoolclass_passwords(schoolclass: str, who: AuthenticatedUser = Depends
 
 
     # TODO: Check group membership
-    get_schoolclass_or_404(schoolclass, who.school)
+    await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
 
-    return lr.get(f'/schoolclasses/{schoolclass}', dict=False).get_first_passwords()
+    schoolclass_details = await run_ldap(lr.get, f'/schoolclasses/{schoolclass}', dict=False)
+    return await run_ldap(schoolclass_details.get_first_passwords)
 
 @router.get("/{schoolclass}/students", name="Details of students of a specific schoolclass")
-def get_schoolclass_passwords(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+async def get_schoolclass_passwords(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
     """
     ## Get all details of all members of a specific schooclass.
 
@@ -115,12 +123,51 @@ def get_schoolclass_passwords(schoolclass: str, who: AuthenticatedUser = Depends
 
 
     # TODO: Check group membership
-    get_schoolclass_or_404(schoolclass, who.school)
+    await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
 
-    return lr.get(f'/schoolclasses/{schoolclass}/students')
+    return await run_ldap(lr.get, f'/schoolclasses/{schoolclass}/students')
+
+@router.get("/{schoolclass}/quotas", name="Quotas of all members of a specific schoolclass")
+async def get_schoolclass_quotas(schoolclass: str, fresh: bool = False, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+    """
+    ## Get the quotas of all members of a specific schoolclass.
+
+    The quotas of each member are served from memory if they were collected
+    less than `quotas.ttl` seconds ago, else collected again (with the query
+    parameter `fresh=true`, always). `updated` is the timestamp of the
+    collection, and `error` is set instead of `quotas` if the collection failed.
+
+    Only the members whose quotas the authenticated user can see on
+    `/users/{user}/quotas` are listed.
+
+    ### Access
+    - global-administrators
+    - school-administrators
+    - teachers (own data and students)
+
+    \f
+    :param schoolclass: cn of the requested schoolclass
+    :type schoolclass: basestring
+    :param fresh: Collect the quotas again
+    :type fresh: bool
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: Quotas details by member (dict)
+    :rtype: dict
+    """
+
+
+    # TODO: Check group membership
+    await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
+    schoolclass_details = await run_ldap(lr.get, f'/schoolclasses/{schoolclass}', school=who.school)
+
+    # Other teachers and the administrators are only visible to the administrators
+    members = await run_ldap(filter_readable_users, who, schoolclass_details['sophomorixMembers'])
+
+    return await quota_collector.get_many(members, fresh=fresh)
 
 @router.post("/{schoolclass}/join", name="Join an existing schoolclass")
-def join_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
+async def join_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
     """
     ## Join an existing schoolclass
 
@@ -139,10 +186,13 @@ def join_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChec
     :type who: AuthenticatedUser
     """
 
-    get_schoolclass_or_404(schoolclass, who.school)
+    await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
 
     cmd = ['sophomorix-class',  '--addmembers', who.user, '-c', schoolclass.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+
+    response_cache.invalidate('schoolclasses')
+    await run_ldap(directory_snapshot.refresh, 'schoolclass', schoolclass.lower())
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
@@ -151,7 +201,7 @@ def join_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChec
     return result
 
 @router.post("/{schoolclass}/quit", name="Quit an existing schoolclass")
-def quit_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
+async def quit_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChecker("T"))):
     """
     ## Quit an existing schoolclass
 
@@ -170,10 +220,13 @@ def quit_schoolclass(schoolclass: str, who: AuthenticatedUser = Depends(RoleChec
     :type who: AuthenticatedUser
     """
 
-    get_schoolclass_or_404(schoolclass, who.school)
+    await run_ldap(get_schoolclass_or_404, schoolclass, who.school)
 
     cmd = ['sophomorix-class',  '--removemembers', who.user, '-c', schoolclass.lower(), '-jj']
-    result =  lmn_getSophomorixValue(cmd, '')
+    result = await lmn_getSophomorixValueAsync(cmd, '')
+
+    response_cache.invalidate('schoolclasses')
+    await run_ldap(directory_snapshot.refresh, 'schoolclass', schoolclass.lower())
 
     output = result.get("OUTPUT", [{}])[0]
     if output.get("TYPE", "") == "ERROR":
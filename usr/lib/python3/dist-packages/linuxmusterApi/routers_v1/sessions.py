@@ -1,10 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, Response, status
 from datetime import datetime
+from typing import Literal
 
 from security import UserChecker, UserListChecker, AuthenticatedUser
-from utils.checks import get_user_or_404
+from utils.executors import run_ldap
+from utils.ldap import decode_entry, get_users, search_users
+from utils.sessions import Session, session_store
 from .body_schemas import UserList
-from linuxmusterTools.ldapconnector import LMNLdapWriter as lw, LMNLdapReader as lr
 from linuxmusterTools.common import Validator, STRING_RULES
 
 
@@ -14,12 +16,36 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+SESSION_MEMBERS_ATTRIBUTES = ['displayName', 'givenName', 'sn', 'sophomorixRole', 'sophomorixAdminClass', 'sophomorixSchoolname']
+
+def _members_summary(cns):
+    """
+    Display attributes of the members of sessions, with one search for all.
+    """
+
+    entries = search_users(cns, attributes=SESSION_MEMBERS_ATTRIBUTES)
+    summary = {}
+    for cn in cns:
+        entry = entries.get(cn.lower(), None)
+        if entry is None:
+            summary[cn] = {}
+            continue
+        details = decode_entry(*entry)
+        del details['dn']
+        summary[cn] = details
+    return summary
 
 @router.get("/{user}", name="Get all sessions of a specific user")
-def session_user(user: str, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def session_user(user: str, members: Literal['none', 'names', 'summary', 'full'] = 'full', who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Get all sessions details of a specific user and return a list of sessions.
 
+    The query parameter `members` sets how the members of the sessions are returned:
+    - `none`: empty list, only their count,
+    - `names`: list of their samaccountnames,
+    - `summary`: list of dicts with the display attributes cn, displayName, givenName, sn, sophomorixRole, sophomorixAdminClass and sophomorixSchoolname,
+    - `full` (default): list of all their details.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -28,6 +54,8 @@ def session_user(user: str, who: AuthenticatedUser = Depends(UserChecker("GST"))
     \f
     :param user: Valid LDAP samaccountname
     :type user: basestring
+    :param members: How to return the members: none, names, summary or full
+    :type members: basestring
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of sessions details (details as dict)
@@ -35,22 +63,34 @@ def session_user(user: str, who: AuthenticatedUser = Depends(UserChecker("GST"))
     """
 
 
-    user_details = get_user_or_404(user, who.school)
-    sessions = user_details.lmnsessions
+    dn, user_school, sessions = await run_ldap(session_store.get, user, who.school)
+
+    # Resolve the members of all sessions at once
+    all_members = list({member for session in sessions for member in session.members})
+    members_details = {}
+    if members == 'summary':
+        members_details = await run_ldap(_members_summary, all_members)
+    elif members == 'full':
+        members_details = dict(zip(all_members, await run_ldap(get_users, all_members)))
+
     sessionsList = []
     for session in sessions:
-        members = [lr.get(f'/users/{member}') for member in session.members]
         s = {
             'sid': session.sid,
             'name': session.name,
             'membersCount': session.membersCount,
-            'members': members,
         }
+        if members == 'none':
+            s['members'] = []
+        elif members == 'names':
+            s['members'] = list(session.members)
+        else:
+            s['members'] = [members_details[member] for member in session.members]
         sessionsList.append(s)
     return sessionsList
 
 @router.get("/{user}/{sessionsid}", name="Get all details from a specific session sid of a specific user")
-def get_session_sessionname(user:str, sessionsid: str, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def get_session_sessionname(user:str, sessionsid: str, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Get all details from a specific session of a specific user.
 
@@ -71,21 +111,17 @@ def get_session_sessionname(user:str, sessionsid: str, who: AuthenticatedUser =
     """
 
 
-    user_details = get_user_or_404(user, who.school)
-    sessions = user_details.lmnsessions
-    for session in sessions:
-        if sessionsid == session.sid:
-            members = [lr.get(f'/users/{member}') for member in session.members]
-            return {
-                'sid': session.sid,
-                'name': session.name,
-                'membersCount': session.membersCount,
-                'members': members,
-            }
-    raise HTTPException(status_code=404, detail=f"Session {sessionsid} not found by {user}")
+    session = await run_ldap(session_store.find, user, who.school, sessionsid)
+    members = await run_ldap(get_users, list(session.members))
+    return {
+        'sid': session.sid,
+        'name': session.name,
+        'membersCount': session.membersCount,
+        'members': members,
+    }
 
 @router.delete("/{user}/{sessionsid}", status_code=204, name="Delete a specific session from a specific user")
-def delete_session(user:str, sessionsid: str, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def delete_session(user:str, sessionsid: str, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Delete a specific session of a specific user.
 
@@ -104,18 +140,10 @@ def delete_session(user:str, sessionsid: str, who: AuthenticatedUser = Depends(U
     """
 
 
-    user_details = get_user_or_404(user, who.school)
-    sessions = user_details.lmnsessions
-    for index, session in enumerate(sessions):
-        if sessionsid == session.sid:
-            old_session = f"{session.sid};{session.name};{','.join(session.members)};"
-            lw.delattr_user(user, data={'sophomorixSessions': old_session})
-            return
-    else:
-       raise HTTPException(status_code=404, detail=f"Session {sessionsid} not found by {user}")
+    await run_ldap(session_store.remove, user, who.school, sessionsid)
 
 @router.post("/{user}/{sessionname}", name="Create a new session for a specific user")
-def session_create(user: str, sessionname: str, userlist: UserList | None = None, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def session_create(user: str, sessionname: str, userlist: UserList | None = None, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Create a new session for a specific user.
 
@@ -142,21 +170,15 @@ def session_create(user: str, sessionname: str, userlist: UserList | None = None
 
     sid = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
 
-    members = ""
+    members = ()
     if userlist:
         if userlist.users:
-            members = ",".join(set(userlist.users))
-
-    new_session = f"{sid};{sessionname};{members};"
+            members = tuple(set(userlist.users))
 
-    try:
-        lw.setattr_user(user, data={'sophomorixSessions': new_session}, add=True)
-        return
-    except Exception as e:
-       raise HTTPException(status_code=404, detail=str(e))
+    await run_ldap(session_store.add, user, who.school, Session(sid, sessionname, members))
 
 @router.delete("/{user}/{sessionsid}/members", status_code=204, name="Remove members from a specific session of a specific user")
-def remove_user_from_session(user:str, sessionsid: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def remove_user_from_session(user:str, sessionsid: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Remove members from a specific session of a specific user.
 
@@ -181,28 +203,10 @@ def remove_user_from_session(user:str, sessionsid: str, userlist: UserList, who:
         # Nothing to do
         raise HTTPException(status_code=400, detail=f"Missing userlist of members to delete")
 
-    user_details = get_user_or_404(user, who.school)
-    sessions = user_details.lmnsessions
-
-    for index, session in enumerate(sessions):
-        if sessionsid == session.sid:
-            old_session = f"{session.sid};{session.name};{','.join(session.members)};"
-            lw.delattr_user(user, data={'sophomorixSessions': old_session})
-
-            to_delete = set(userlist.users)
-            members_set = set(session.members)
-            members_set.difference_update(to_delete)
-            session.members = list(members_set)
-
-            new_session = f"{session.sid};{session.name};{','.join(session.members)};"
-            lw.setattr_user(user, data={'sophomorixSessions': new_session}, add=True)
-
-            return
-    else:
-       raise HTTPException(status_code=404, detail=f"Session {sessionsid} not found by {user}")
+    await run_ldap(session_store.update_members, user, who.school, sessionsid, remove=userlist.users)
 
 @router.post("/{user}/{sessionsid}/members", name="Add members to a specific session of a specific user")
-def add_user_to_session(user: str, sessionsid: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def add_user_to_session(user: str, sessionsid: str, userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Add members to a specific session of a specific user.
 
@@ -227,20 +231,4 @@ def add_user_to_session(user: str, sessionsid: str, userlist: UserList, who: Aut
         # Nothing to do
         raise HTTPException(status_code=400, detail=f"Missing userlist of members to add")
 
-    user_details = get_user_or_404(user, who.school)
-    sessions = user_details.lmnsessions
-
-    for index, session in enumerate(sessions):
-        if sessionsid == session.sid:
-            old_session = f"{session.sid};{session.name};{','.join(session.members)};"
-            lw.delattr_user(user, data={'sophomorixSessions': old_session})
-
-            session.members += userlist.users
-            session.members = list(set(session.members))
-
-            new_session = f"{session.sid};{session.name};{','.join(session.members)};"
-            lw.setattr_user(user, data={'sophomorixSessions': new_session}, add=True)
-
-            return
-    else:
-       raise HTTPException(status_code=404, detail=f"Session {sessionsid} not found by {user}")
\ No newline at end of file
+    await run_ldap(session_store.update_members, user, who.school, sessionsid, add=userlist.users)
\ No newline at end of file
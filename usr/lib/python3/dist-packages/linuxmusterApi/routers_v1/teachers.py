@@ -1,8 +1,10 @@
 from fastapi import APIRouter, Depends, HTTPException, Request
 
 from security import RoleChecker, AuthenticatedUser
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.ldap import lr
 from utils.checks import get_teacher_or_404
+from utils.executors import run_ldap
+from utils.responses import cached_response
 
 
 router = APIRouter(
@@ -12,10 +14,13 @@ router = APIRouter(
 )
 
 @router.get("/", name='List all teachers')
-def get_all_teachers(who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def get_all_teachers(request: Request, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Get all informations from all teachers.
 
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
+
     ### Access
     - global-administrators
     - school-administrators
@@ -28,10 +33,10 @@ def get_all_teachers(who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
 
 
-    return lr.get('/roles/teacher')
+    return await cached_response(request, 'teachers', ('all',), lambda: lr.get('/roles/teacher'))
 
 @router.get("/{teacher}", name="Get informations of a specific teacher")
-def get_teacher(teacher: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
+async def get_teacher(teacher: str, who: AuthenticatedUser = Depends(RoleChecker("GS"))):
     """
     ## Get all informations of a specific teacher.
 
@@ -48,7 +53,7 @@ def get_teacher(teacher: str, who: AuthenticatedUser = Depends(RoleChecker("GS")
     :rtype: list
     """
 
-    get_teacher_or_404(teacher, who.school)
+    await run_ldap(get_teacher_or_404, teacher, who.school)
 
-    return lr.get(f'/users/{teacher}')
+    return await run_ldap(lr.get, f'/users/{teacher}')
 
@@ -1,11 +1,19 @@
-from fastapi import APIRouter, Depends, HTTPException, Request
-
-from security import RoleChecker, UserChecker, AuthenticatedUser, UserListChecker
-from .body_schemas import SetFirstPassword, SetCurrentPassword, UserList, User
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
-from linuxmusterTools.ldapconnector import LMNLdapWriter as lw
+import asyncio
+import csv
+import io
+import secrets
+import string
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+
+from security import RoleChecker, UserChecker, AuthenticatedUser, UserListChecker, invalidate_authenticated_user
+from .body_schemas import BulkPasswords, SetFirstPassword, SetCurrentPassword, UserList, User
 from linuxmusterTools.samba_util import UserManager
-import linuxmusterTools.quotas
+from utils.checks import get_project_or_404, get_schoolclass_or_404
+from utils.config import api_config
+from utils.executors import run_ldap
+from utils.ldap import get_roles, get_users, get_users_page, iter_users, lr, lw, split_attributes
+from utils.quotas import quota_collector
+from utils.responses import cached_response, response_cache, streaming_json_response
 
 
 user_manager = UserManager()
@@ -16,17 +24,65 @@ router = APIRouter(
     responses={404: {"description": "Not found"}},
 )
 
+USERS_LIST_ATTRIBUTES = ['sn', 'givenName', 'sophomorixRole', 'sophomorixAdminClass']
+
 @router.get("/", name="List all users")
-def get_all_users(who: AuthenticatedUser = Depends(RoleChecker("G"))):
+async def get_all_users(
+        request: Request,
+        response: Response,
+        limit: int | None = Query(default=None, ge=1, le=1000),
+        cursor: str | None = None,
+        attributes: str | None = None,
+        role: str | None = None,
+        adminclass: str | None = None,
+        school: str | None = None,
+        stream: bool = False,
+        who: AuthenticatedUser = Depends(RoleChecker("G"))
+    ):
     """
     ## Get basic informations from all users.
 
     Output informations are sn, givenName, sophomorixRole, sophomorixAdminClass.
+    The response contains an ETag header: send it back in a If-None-Match header
+    to get an empty 304 response if the list did not change.
+
+    With one of the optional query parameters, the list is paginated:
+    - `limit`: max number of users per page (default 100, max 1000),
+    - `cursor`: value of the header `X-Next-Cursor` of the previous page, to get the next page,
+    - `attributes`: comma separated list of attributes to return, e.g. `cn,sn,givenName`,
+    - `role`, `adminclass`, `school`: only return users with this role, adminclass or school.
+
+    The header `X-Next-Cursor` is missing on the last page. The pages are sorted by
+    cn, and the cursor is the last cn of the page: it stays valid if the request is
+    sent to another worker, or if users are created or deleted in between.
+
+    With the query parameter `stream=true`, the users are sent while they are read
+    from LDAP, as a JSON array, or as NDJSON (one user per line) if the header
+    `Accept: application/x-ndjson` is set.
+
+    Without any of these parameters, the whole list is built in memory as before
+    (and then cached, see the ETag above). On large directories, clients should
+    prefer the pagination or `stream=true`, whose memory use does not grow with the
+    number of users.
 
     ### Access
     - global-administrators
 
     \f
+    :param limit: Max number of users per page
+    :type limit: int
+    :param cursor: Cursor to get the next page
+    :type cursor: basestring
+    :param attributes: Comma separated list of attributes to return
+    :type attributes: basestring
+    :param role: Filter on sophomorixRole
+    :type role: basestring
+    :param adminclass: Filter on sophomorixAdminClass
+    :type adminclass: basestring
+    :param school: Filter on sophomorixSchoolname
+    :type school: basestring
+    :param stream: Send the users while reading them from LDAP
+    :type stream: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: List of all users details (dict)
@@ -34,10 +90,37 @@ def get_all_users(who: AuthenticatedUser = Depends(RoleChecker("G"))):
     """
 
 
-    return lr.get('/users', attributes=['sn', 'givenName', 'sophomorixRole', 'sophomorixAdminClass'])
+    if stream:
+        users = iter_users(split_attributes(attributes) or USERS_LIST_ATTRIBUTES, role=role, adminclass=adminclass, school=school)
+        return streaming_json_response(request, users)
+
+    if any(param is not None for param in [limit, cursor, attributes, role, adminclass, school]):
+        try:
+            users, next_cursor = await run_ldap(
+                get_users_page,
+                split_attributes(attributes) or USERS_LIST_ATTRIBUTES,
+                limit=limit or 100,
+                cursor=cursor,
+                role=role,
+                adminclass=adminclass,
+                school=school,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        if next_cursor:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return users
+
+    return await cached_response(
+        request,
+        'users',
+        ('all',),
+        lambda: lr.get('/users', attributes=USERS_LIST_ATTRIBUTES)
+    )
 
 @router.get("/{user}", name="User details")
-def get_user(user: str, check_first_pw: bool = False, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def get_user(user: str, check_first_pw: bool = False, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Get all informations of a specific user.
     The optional query parameter `check_first_pw` is a boolean. If set to true, the endpoint will check if the first
@@ -60,16 +143,16 @@ def get_user(user: str, check_first_pw: bool = False, who: AuthenticatedUser = D
 
 
     if check_first_pw:
-        user_details = lr.get(f'/users/{user}', dict=False)
-        first_pw_set = user_details.test_first_password()
+        user_details = await run_ldap(lr.get, f'/users/{user}', dict=False)
+        first_pw_set = await run_ldap(user_details.test_first_password)
         user_dict = user_details.asdict()
         user_dict['FirstPasswordSet'] = first_pw_set
         return user_dict
     else:
-        return lr.get(f'/users/{user}')
+        return await run_ldap(lr.get, f'/users/{user}')
 
 @router.post("/{user}", name="Update user's data")
-def post_user_data(user: str, user_details: User, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def post_user_data(user: str, user_details: User, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Update the data of a specific user
 
@@ -94,11 +177,13 @@ def post_user_data(user: str, user_details: User, who: AuthenticatedUser = Depen
 
     data = {k:v for k, v in user_details.__dict__.items() if v}
 
-    lw.setattr_user(f"{user.lower()}", data=data)
+    await run_ldap(lw.setattr_user, f"{user.lower()}", data=data)
+    invalidate_authenticated_user(user)
+    response_cache.invalidate('users', 'teachers', 'roles')
 
 
 @router.post("/get_users_from_cn", name="User details")
-def get_users_from_cn(userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
+async def get_users_from_cn(userlist: UserList, who: AuthenticatedUser = Depends(UserListChecker("GST"))):
     """
     ## Get all informations of a specific user.
 
@@ -116,15 +201,12 @@ def get_users_from_cn(userlist: UserList, who: AuthenticatedUser = Depends(UserL
     :rtype: dict
     """
 
-    response = {}
-    for user in userlist.users:
-        if user not in response:
-            response[user] = lr.get(f'/users/{user}')
+    users = list(dict.fromkeys(userlist.users or []))
 
-    return response
+    return dict(zip(users, await run_ldap(get_users, users)))
 
 @router.post("/{user}/set-first-password", name="Set user's first password")
-def set_first_user_password(user: str, password: SetFirstPassword, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def set_first_user_password(user: str, password: SetFirstPassword, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Set the first password of the user.
 
@@ -150,15 +232,15 @@ def set_first_user_password(user: str, password: SetFirstPassword, who: Authenti
 
 
     # TODO : paswword constraints ?
-    lw.setattr_user(user, data={'sophomorixFirstPassword': password.password})
+    await run_ldap(lw.setattr_user, user, data={'sophomorixFirstPassword': password.password})
     if password.set_current:
         try:
-            user_manager.set_password(user, password.password)
+            await run_ldap(user_manager.set_password, user, password.password)
         except Exception as e:
             raise HTTPException(status_code=400, detail=f"Cannot set current password: {str(e)}")
 
 @router.post("/{user}/set-current-password", name="Set user's current password")
-def set_current_user_password(user: str, password: SetCurrentPassword, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def set_current_user_password(user: str, password: SetCurrentPassword, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Set the current password of the user.
 
@@ -190,20 +272,162 @@ def set_current_user_password(user: str, password: SetCurrentPassword, who: Auth
 
 
     try:
-        user_manager.set_password(user, password.password)
+        await run_ldap(user_manager.set_password, user, password.password)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     if password.set_first:
-        lw.setattr_user(user, data={'sophomorixFirstPassword': password.password})
+        await run_ldap(lw.setattr_user, user, data={'sophomorixFirstPassword': password.password})
+
+
+# Checker used for each user of a bulk password request
+bulk_password_checker = UserChecker("GST")
+
+def _random_password(length):
+    """
+    Random password with at least one lowercase letter, one uppercase letter
+    and one digit, to match the Samba password complexity.
+    """
+
+    alphabet = string.ascii_letters + string.digits
+    while True:
+        password = ''.join(secrets.choice(alphabet) for _ in range(length))
+        if (any(c.islower() for c in password)
+                and any(c.isupper() for c in password)
+                and any(c.isdigit() for c in password)):
+            return password
+
+def _bulk_password_targets(config, who):
+    """
+    Resolve all users of a bulk password request, and their roles with one
+    LDAP request.
+
+    :return: Ordered list of users, and roles by user
+    :rtype: tuple
+    """
+
+    users = []
+
+    for schoolclass in config.schoolclasses:
+        get_schoolclass_or_404(schoolclass, who.school)
+        users.extend(lr.get(f'/schoolclasses/{schoolclass}', school=who.school).get('sophomorixMembers', []))
+
+    for project in config.projects:
+        details = get_project_or_404(project, who.school)
+        details.get_all_members()
+        users.extend(details.all_members)
+
+    users.extend(config.users)
+    if config.policy == 'per_user':
+        users.extend(config.passwords)
+
+    users = list(dict.fromkeys(user for user in users if user))
+
+    return users, get_roles(users)
+
+def _set_passwords(user, password, set_first, set_current):
+    if set_first:
+        lw.setattr_user(user, data={'sophomorixFirstPassword': password})
+    if set_current:
+        user_manager.set_password(user, password)
+
+@router.post("/bulk/passwords", name="Set the passwords of many users")
+async def set_bulk_passwords(config: BulkPasswords, who: AuthenticatedUser = Depends(RoleChecker("GST"))):
+    """
+    ## Set the first and/or current passwords of many users at once.
+
+    The users are all members of the given `schoolclasses` and `projects`,
+    and the given `users`. The `policy` may be:
+    - `fixed`: the same `password` for all users,
+    - `random`: one random password of `length` chars per user, returned in the results,
+    - `per_user`: `passwords` is a dict user -> password.
 
+    The flags `set_first` and `set_current` (default both true) indicate which
+    passwords are overwritten. The permissions are checked per user like for
+    the single user endpoints (e.g. teachers can only change the passwords of
+    students): users which can not be modified get the status `forbidden`,
+    unknown users the status `not_found`.
+
+    With `format` set to `csv`, the results are returned as a CSV file.
+
+    ### Access
+    - global-administrators
+    - school-administrators
+    - teachers (own data and students)
+
+    \f
+    :param config: Users and password policy
+    :type config: BulkPasswords
+    :param who: User requesting the data, read from API Token
+    :type who: AuthenticatedUser
+    :return: Result per user (user, status, password for random policy, detail)
+    :rtype: list
+    """
+
+
+    if config.policy == 'fixed' and not config.password:
+        raise HTTPException(status_code=422, detail="The fixed policy needs a password")
+
+    if not config.set_first and not config.set_current:
+        raise HTTPException(status_code=400, detail="Nothing to do, set_first and set_current are both false")
+
+    users, users_roles = await run_ldap(_bulk_password_targets, config, who)
+
+    # Don't use all LDAP threads for one bulk request
+    semaphore = asyncio.Semaphore(api_config.section('bulk').get('workers', 4))
+
+    async def apply(user):
+        result = {'user': user, 'status': 'ok', 'password': '', 'detail': ''}
+
+        if users_roles.get(user, None) is None:
+            return {**result, 'status': 'not_found'}
+
+        if not bulk_password_checker._check_role_permissions(who, user, users_roles=users_roles):
+            return {**result, 'status': 'forbidden'}
+
+        if config.policy == 'fixed':
+            password = config.password
+        elif config.policy == 'random':
+            password = _random_password(config.length)
+            result['password'] = password
+        else:
+            password = config.passwords.get(user, None)
+            if not password:
+                return {**result, 'status': 'error', 'detail': 'No password given for this user'}
+
+        async with semaphore:
+            try:
+                await run_ldap(_set_passwords, user, password, config.set_first, config.set_current)
+            except Exception as e:
+                return {**result, 'status': 'error', 'detail': str(e)}
+
+        return result
+
+    results = await asyncio.gather(*[apply(user) for user in users])
+
+    if config.format == 'csv':
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=['user', 'status', 'password', 'detail'])
+        writer.writeheader()
+        writer.writerows(results)
+        return Response(
+            content=output.getvalue(),
+            media_type='text/csv',
+            headers={'Content-Disposition': f'attachment; filename="passwords-{who.user}.csv"'},
+        )
+
+    return results
 
 @router.get("/{user}/quotas", name='Get the quotas of a specific user')
-def get_user_quotas(user: str, who: AuthenticatedUser = Depends(UserChecker("GST"))):
+async def get_user_quotas(user: str, response: Response, fresh: bool = False, who: AuthenticatedUser = Depends(UserChecker("GST"))):
     """
     ## Get the actual quotas of a specific user.
 
     Given informations per share are: used quota, soft limit and hard limit.
+    The quotas are served from memory if they were collected less than
+    `quotas.ttl` seconds ago (see config.yml), the header `X-Quotas-Updated`
+    contains the timestamp of the collection. With the query parameter
+    `fresh=true`, the quotas are always collected again.
 
     ### Access
     - global-administrators
@@ -213,6 +437,8 @@ def get_user_quotas(user: str, who: AuthenticatedUser = Depends(UserChecker("GST
     \f
     :param user: samaccountname of the user to check
     :type user: basestring
+    :param fresh: Collect the quotas again
+    :type fresh: bool
     :param who: User requesting the data, read from API Token
     :type who: AuthenticatedUser
     :return: All available per share quota informations
@@ -221,6 +447,9 @@ def get_user_quotas(user: str, who: AuthenticatedUser = Depends(UserChecker("GST
 
 
     try:
-       return linuxmusterTools.quotas.get_user_quotas(user)
+        updated, quotas = await quota_collector.get(user, fresh=fresh)
     except Exception as e:
-        raise HTTPException(status_code=404, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=404, detail=str(e))
+
+    response.headers['X-Quotas-Updated'] = str(updated)
+    return quotas
@@ -0,0 +1,86 @@
+#! /usr/bin/env python3
+
+"""
+Micro-benchmark of the parser of sophomorix outputs.
+
+Compare the old parser (string replacements + ast.literal_eval) with
+parse_sophomorix_json on recorded outputs, e.g.:
+
+    sophomorix-query --schoolbase default-school --student --user-full -jj 2> query.out
+    lmnapi-bench-sophomorix-parser.py query.out
+
+Without file, a synthetic output of 5000 users is used.
+"""
+
+import ast
+import json
+import os
+import re
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sophomorix import parse_sophomorix_json, orjson
+
+
+def legacy_parser(stderr):
+    output = stderr.decode("utf8").replace(':null', ":\"null\"")
+    output = output.replace(':null}', ":\"null\"}")
+    output = output.replace(':null]', ":\"null\"]")
+    output = output.replace('\n', '').split('# JSON-end')[0]
+    output = output.split('# JSON-begin')[1]
+    output = re.sub('# JSON-begin', '', output)
+    if output:
+        return ast.literal_eval(output)
+    return {}
+
+def synthetic_output(users=5000):
+    data = {'USERS': {}, 'COMMENT_EN': 'Synthetic output', 'OUTPUT': []}
+    for i in range(users):
+        data['USERS'][f'user{i}'] = {
+            'sophomorixRole': 'student',
+            'sophomorixAdminClass': f'{i % 13}a',
+            'givenName': f'Given{i}',
+            'sn': f'Name{i}',
+            'mail': None,
+            'memberOf': [f'CN={i % 13}a,OU=Students,OU=default-school,OU=SCHOOLS' for _ in range(5)],
+            'sophomorixQuota': ['default-school:---:', 'linuxmuster-global:---:'],
+        }
+    return b'# JSON-begin\n' + json.dumps(data, separators=(',', ':')).encode('utf8') + b'\n# JSON-end\n'
+
+def measure(name, parser, output, number):
+    seconds = min(timeit.repeat(lambda: parser(output), number=number, repeat=3)) / number
+
+    tracemalloc.start()
+    parser(output)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    print(f'  {name:<28} {seconds * 1000:10.2f} ms   peak {peak / 2**20:8.2f} MiB')
+
+def main():
+    if len(sys.argv) > 1:
+        samples = []
+        for path in sys.argv[1:]:
+            with open(path, 'rb') as f:
+                samples.append((path, f.read()))
+    else:
+        samples = [('synthetic (5000 users)', synthetic_output())]
+
+    print(f"orjson backend: {'available' if orjson is not None else 'not installed'}")
+
+    for name, output in samples:
+        number = max(1, int(20 * 2**20 / max(len(output), 1)))
+        print(f'\n{name} ({len(output) / 2**20:.2f} MiB, {number} runs)')
+
+        if legacy_parser(output) != parse_sophomorix_json(output):
+            print('  WARNING: both parsers give different results')
+
+        measure('ast.literal_eval (old)', legacy_parser, output, number)
+        measure('parse_sophomorix_json', parse_sophomorix_json, output, number)
+        measure('parse_sophomorix_json raw', lambda o: parse_sophomorix_json(o, null_as_string=False), output, number)
+
+if __name__ == '__main__':
+    main()
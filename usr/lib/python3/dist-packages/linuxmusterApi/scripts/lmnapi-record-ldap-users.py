@@ -0,0 +1,61 @@
+#! /usr/bin/env python3
+
+"""
+Record LDAP users for the equivalence test of utils.ldap.to_model.
+
+For each user, the raw LDAP entry and the output of linuxmusterTools'
+LMNLdapReader.get('/users/<cn>') are written in one JSON file, e.g.:
+
+    lmnapi-record-ldap-users.py /tmp/recordings teacher1 student1 student2
+
+The test tests/test_ldap_models.py checks that to_model gives the same
+result as the library for each recording (set LMNAPI_LDAP_RECORDINGS to the
+directory). Only record test accounts: the files contain all the readable
+attributes of the users.
+"""
+
+import base64
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder
+from linuxmusterTools.ldapconnector import LMNLdapReader
+
+from utils.ldap import search_users
+
+
+def main():
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    directory, cns = sys.argv[1], sys.argv[2:]
+    os.makedirs(directory, exist_ok=True)
+
+    entries = search_users(cns)
+    for cn in cns:
+        entry = entries.get(cn.lower(), None)
+        if entry is None:
+            print(f'{cn}: not found')
+            continue
+
+        dn, attributes = entry
+        recording = {
+            'dn': dn,
+            'attributes': {
+                key: [base64.b64encode(value).decode() for value in values]
+                for key, values in attributes.items()
+            },
+            'expected': jsonable_encoder(LMNLdapReader.get(f'/users/{cn}')),
+        }
+
+        path = os.path.join(directory, f'{cn.lower()}.json')
+        with open(path, 'w') as f:
+            json.dump(recording, f, indent=2, sort_keys=True)
+        print(f'{cn}: {path}')
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,11 @@ from fastapi import Depends, HTTPException
 from fastapi.security import APIKeyHeader, HTTPBasic, HTTPBasicCredentials
 from starlette import status
 import jwt
-import base64
-import yaml
 from typing_extensions import Annotated
 
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.ldap import lr
+from utils.config import api_config
+from utils.executors import run_ldap
 
 
 X_API_KEY = APIKeyHeader(name='X-API-Key')
@@ -27,33 +27,23 @@ def generate_jwt(user):
         # User not found in ldap tree, discarding request
         return ''
 
-    with open('/etc/linuxmuster/api/config.yml', 'r') as config_file:
-        config = yaml.load(config_file, Loader=yaml.SafeLoader)
-
-    secret = base64.b64decode(config['secret'])
-
     payload  = {
         'user': user,
         'role': user_details['sophomorixRole'],
         'school': user_details['sophomorixSchoolname']
     }
 
-    token = jwt.encode(payload, secret, algorithm="HS512")
-
-    # No memory leak
-    secret = ''
-
-    return token
+    return jwt.encode(payload, api_config.secret, algorithm="HS512")
 
 class BasicAuthChecker:
     """
     Check username and password from basic auth.
     """
 
-    def __call__(self, credentials: Annotated[HTTPBasicCredentials, Depends(BASIC_AUTH)]) -> str:
-        user = lr.get(f'/users/{credentials.username}', dict=False)
-        if user.test_password(password=credentials.password):
-            return generate_jwt(user.cn)
+    async def __call__(self, credentials: Annotated[HTTPBasicCredentials, Depends(BASIC_AUTH)]) -> str:
+        user = await run_ldap(lr.get, f'/users/{credentials.username}', dict=False)
+        if await run_ldap(user.test_password, password=credentials.password):
+            return await run_ldap(generate_jwt, user.cn)
 
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,12 +1,15 @@
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Request
 from fastapi.security import APIKeyHeader
 from starlette import status
 import jwt
-import base64
-import yaml
 from pydantic import BaseModel
 
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.ldap import lr
+from utils.tracing import span
+from utils.cache import TTLCache
+from utils.changes import change_bus
+from utils.config import api_config
+from utils.executors import run_ldap
 
 
 class AuthenticatedUser(BaseModel):
@@ -17,18 +20,60 @@ class AuthenticatedUser(BaseModel):
 
 X_API_KEY = APIKeyHeader(name='X-API-Key')
 
-def check_authentication_header(x_api_key: str = Depends(X_API_KEY)) -> AuthenticatedUser:
+# Verified users, to avoid a LDAP request for each API call
+authenticated_users = TTLCache(namespace='auth')
+
+def configure_authentication_cache(config):
+    auth_config = config.section('auth')
+    authenticated_users.configure(
+        maxsize=auth_config.get('cache_size', 1024),
+        ttl=auth_config.get('cache_ttl', 30),
+    )
+
+configure_authentication_cache(api_config)
+api_config.on_reload(configure_authentication_cache)
+
+def invalidate_authenticated_user(user=None):
     """
-    Return role associated with the api key.
+    Remove a user from the authentication cache, e.g. when its role changed.
+    Without user, the whole cache is cleared.
+
+    :param user: cn of the user
+    :type user: basestring
     """
 
-    with open('/etc/linuxmuster/api/config.yml', 'r') as config_file:
-        config = yaml.load(config_file, Loader=yaml.SafeLoader)
+    if user is None:
+        authenticated_users.clear()
+    else:
+        authenticated_users.pop(user.lower())
+
+def _invalidate_changed_users(events):
+    # Every worker gets the change events, nothing to publish
+    if any(event.kind == 'deleted' for event in events):
+        authenticated_users.clear(publish=False)
+        return
+
+    for event in events:
+        authenticated_users.pop(event.cn.lower(), publish=False)
 
-    secret = base64.b64decode(config['secret'])
+change_bus.subscribe(_invalidate_changed_users, kinds=['user'])
+
+# Key of the request scope holding the user already authenticated by the
+# batch endpoint, for its sub-requests. It can not be set by a client.
+AUTHENTICATED_USER_SCOPE_KEY = 'lmnapi.authenticated_user'
+
+async def check_authentication_header(request: Request, x_api_key: str = Depends(X_API_KEY)) -> AuthenticatedUser:
+    """
+    Return role associated with the api key.
+    """
+
+    authenticated_user = request.scope.get(AUTHENTICATED_USER_SCOPE_KEY, None)
+    if authenticated_user is not None:
+        return authenticated_user
 
     try:
-        payload = jwt.decode(x_api_key, secret, algorithms=["HS512", "HS256"])
+        with span('auth', 'jwt'):
+            payload = jwt.decode(x_api_key, api_config.secret, algorithms=["HS512", "HS256"])
         user = payload['user']
     except (jwt.exceptions.InvalidSignatureError, jwt.exceptions.DecodeError):
         raise HTTPException(
@@ -36,11 +81,13 @@ def check_authentication_header(x_api_key: str = Depends(X_API_KEY)) -> Authenti
             detail="Invalid API Key",
         )
 
-    # No memory leak
-    secret = ''
+    # Keyed by lowercase cn, like the change events
+    cached_user = authenticated_users.get(user.lower())
+    if cached_user is not None:
+        return cached_user
 
     # role may be eventually None
-    user_details = lr.getvalues(f'/users/{user}', ['sophomorixRole','sophomorixSchoolname'])
+    user_details = await run_ldap(lr.getvalues, f'/users/{user}', ['sophomorixRole','sophomorixSchoolname'])
 
     if user_details.get('sophomorixRole', None) is None:
         raise HTTPException(
@@ -48,9 +95,12 @@ def check_authentication_header(x_api_key: str = Depends(X_API_KEY)) -> Authenti
             detail="Invalid API Key",
         )
 
-    return AuthenticatedUser(
+    authenticated_user = AuthenticatedUser(
         user=user,
         role=user_details['sophomorixRole'],
         school=user_details.get('sophomorixSchoolname', "")
     )
+    authenticated_users.set(user.lower(), authenticated_user)
+
+    return authenticated_user
 
@@ -2,7 +2,8 @@ from fastapi import Depends, Request, HTTPException
 from starlette import status
 
 from .header import *
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.executors import run_ldap
+from utils.ldap import get_roles
 
 
 class BasicChecker:
@@ -27,7 +28,7 @@ class BasicChecker:
                 for alias in roles if alias in self.ROLES_MAPPING
             ]
 
-    def _check_role_permissions(self, who, requested_user):
+    def _check_role_permissions(self, who, requested_user, users_roles=None):
 
             if not requested_user:
                 return False
@@ -47,11 +48,10 @@ class BasicChecker:
             if identity_role == 'globaladministrator':
                 return True
 
-            # Ensure the requested user exists in LDAP
-            if requested_user.endswith('-exam'):
-                user_role = lr.getval(f'/users/exam/{requested_user}', 'sophomorixRole')
-            else:
-                user_role = lr.getval(f'/users/{requested_user}', 'sophomorixRole')
+            # Ensure the requested user exists in LDAP, if the roles were not already fetched
+            if users_roles is None:
+                users_roles = get_roles([requested_user])
+            user_role = users_roles.get(requested_user, None)
 
             # Is it really a valid user ?
             if user_role is None:
@@ -85,7 +85,7 @@ class RoleChecker(BasicChecker):
     def __init__(self, roles) -> None:
         BasicChecker.__init__(self, roles)
 
-    def __call__(self, who: AuthenticatedUser = Depends(check_authentication_header)) -> AuthenticatedUser:
+    async def __call__(self, who: AuthenticatedUser = Depends(check_authentication_header)) -> AuthenticatedUser:
 
         if who.role == 'globaladministrator':
             return who
@@ -107,7 +107,7 @@ class UserChecker(BasicChecker):
     def __init__(self, roles) -> None:
         BasicChecker.__init__(self, roles)
 
-    def __call__(self, who: AuthenticatedUser = Depends(check_authentication_header), user=None) -> AuthenticatedUser:
+    async def __call__(self, who: AuthenticatedUser = Depends(check_authentication_header), user=None) -> AuthenticatedUser:
 
         if who.role == 'globaladministrator':
             return who
@@ -115,7 +115,7 @@ class UserChecker(BasicChecker):
         if who.user == user:
             return who
 
-        if who.role in self.roles and self._check_role_permissions(who, user):
+        if who.role in self.roles and await run_ldap(self._check_role_permissions, who, user):
             return who
 
         raise HTTPException(
@@ -142,9 +142,12 @@ class UserListChecker(BasicChecker):
             return who
 
         if who.role in self.roles:
+            # Get all roles with one LDAP request
+            users_roles = await run_ldap(get_roles, [user for user in users if user])
+
             # If one user has higher level, refuse to answer
             for user in users:
-                if not self._check_role_permissions(who, user):
+                if not self._check_role_permissions(who, user, users_roles=users_roles):
                     raise HTTPException(
                         status_code=status.HTTP_401_UNAUTHORIZED,
                         detail=f'Permissions denied to request user {user}'
@@ -155,6 +158,35 @@ class UserListChecker(BasicChecker):
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail='Permissions denied')
 
+def filter_readable_users(who, users):
+    """
+    Keep only the users whose data can be read by who, with the same rules as
+    UserChecker, e.g. to list the quotas of all members of a group:
+     - global-administrators can read all users
+     - school-administrators and teachers can read their own data and the users
+    with a lower role
+
+    :param who: the user requesting the data
+    :type who: AuthenticatedUser
+    :param users: samaccountnames of the users
+    :type users: list
+    :return: accepted users, in the same order
+    :rtype: list
+    """
+
+    if who.role == 'globaladministrator':
+        return list(users)
+
+    checker = UserChecker("GST")
+
+    # Get all roles with one LDAP request
+    users_roles = get_roles(user for user in users if user and user != who.user)
+
+    return [
+        user for user in users
+        if user == who.user or checker._check_role_permissions(who, user, users_roles=users_roles)
+    ]
+
 def check_print_permissions(who, users):
     """
     Basic checks to print passwords:
@@ -174,6 +206,9 @@ def check_print_permissions(who, users):
 
     to_remove = set()
 
+    # Ensure the requested users exist in LDAP, with one request
+    users_roles = get_roles(user for user in users if user and user != who.user)
+
     for user in users:
 
         # Ignore own password
@@ -181,11 +216,7 @@ def check_print_permissions(who, users):
             to_remove.add(user)
             continue
 
-        # Ensure the requested user exists in LDAP
-        if user.endswith('-exam'):
-            user_role = lr.getval(f'/users/exam/{user}', 'sophomorixRole')
-        else:
-            user_role = lr.getval(f'/users/{user}', 'sophomorixRole')
+        user_role = users_roles.get(user, None)
 
         # Ignoring unknow users
         if user_role is None:
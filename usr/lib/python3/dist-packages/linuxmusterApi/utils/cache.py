@@ -0,0 +1,155 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+from utils.executors import store_executor
+from utils.metrics import observe_cache
+from utils.store import shared_store
+
+
+class TTLCache:
+    """
+    Thread safe LRU cache whose entries expire after ttl seconds.
+
+    When maxsize entries are stored, the least recently used one is discarded.
+    A ttl of 0 disables the cache.
+
+    With a namespace, the invalidations (pop and clear) are propagated to the
+    caches with the same namespace in the other worker processes, through the
+    shared store. The invalidations of the other workers are read at most
+    every SYNC_INTERVAL seconds, in the store executor so that a read of the
+    cache never waits for SQLite (e.g. in the event loop). An invalidation which every worker does
+    itself, e.g. on a change event or a config reload, must not be published.
+    The hit ratio of the caches with a namespace is exported in the metrics.
+    """
+
+    SYNC_INTERVAL = 1
+
+    def __init__(self, maxsize=1024, ttl=60, namespace=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.namespace = namespace
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_invalidation = None
+        self._last_sync = 0
+        self._syncing = False
+
+    def _sync(self):
+        """
+        Start reading the invalidations of the other workers in the store
+        executor, if not done since SYNC_INTERVAL seconds.
+        """
+
+        if self.namespace is None or not shared_store.enabled:
+            return
+
+        now = monotonic()
+        with self._lock:
+            if self._syncing or now - self._last_sync < self.SYNC_INTERVAL:
+                return
+            self._last_sync = now
+            self._syncing = True
+
+        try:
+            store_executor.submit(self._read_invalidations)
+        except RuntimeError:
+            # The executor is shut down, e.g. while the worker stops
+            self._syncing = False
+
+    def _read_invalidations(self):
+        """
+        Drop the entries invalidated by the other workers.
+        """
+
+        try:
+            last, keys, clear = shared_store.invalidations(self.namespace, self._last_invalidation)
+            with self._lock:
+                self._last_invalidation = last
+                if clear:
+                    self._data.clear()
+                elif keys:
+                    keys = set(keys)
+                    for key in [key for key in self._data if repr(key) in keys]:
+                        del self._data[key]
+        finally:
+            self._syncing = False
+
+    def _publish(self, key=None):
+        if self.namespace is not None:
+            shared_store.invalidate(self.namespace, None if key is None else repr(key))
+
+    def get(self, key, default=None):
+        value = self._get(key, self)
+        if self.namespace is not None:
+            observe_cache(self.namespace, value is not self)
+        return default if value is self else value
+
+    def _get(self, key, default):
+        self._sync()
+
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires < monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.ttl <= 0 or self.maxsize <= 0:
+            return
+
+        self._sync()
+
+        with self._lock:
+            self._data[key] = (monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None, publish=True):
+        """
+        Remove an entry, and from the caches of the other workers too if
+        publish is set.
+        """
+
+        with self._lock:
+            expires, value = self._data.pop(key, (0, default))
+        if publish:
+            self._publish(key)
+        return value
+
+    def clear(self, publish=True):
+        """
+        Remove all entries, and from the caches of the other workers too if
+        publish is set.
+        """
+
+        with self._lock:
+            self._data.clear()
+        if publish:
+            self._publish()
+
+    def configure(self, maxsize=None, ttl=None):
+        """
+        Change the size or the ttl of the cache, e.g. after a config reload.
+        """
+
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self._get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
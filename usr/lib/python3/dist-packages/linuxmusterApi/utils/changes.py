@@ -0,0 +1,286 @@
+import dataclasses
+import hashlib
+import logging
+import threading
+import ldap
+from ldap.controls import LDAPControl, SimplePagedResultsControl
+
+from utils.config import api_config
+from utils.ldap import get_common_name, ldap_pool, split_dn
+from utils.store import shared_store
+
+
+# LDAP_SERVER_SHOW_DELETED_OID, to see the deleted objects (tombstones)
+SHOW_DELETED_OID = '1.2.840.113556.1.4.417'
+
+PAGE_SIZE = 500
+
+# Lease of the shared store held by the worker polling the changes
+POLLER_LEASE = 'change-poller'
+
+CHANGE_ATTRIBUTES = [
+    'cn',
+    'isDeleted',
+    'sophomorixRole',
+    'sophomorixSchoolname',
+    'sophomorixSessions',
+    'sophomorixType',
+    'uSNChanged',
+]
+
+# sophomorixType of the groups
+GROUP_KINDS = {
+    'adminclass': 'schoolclass',
+    'project': 'project',
+    'printer': 'printer',
+}
+
+
+@dataclasses.dataclass
+class ChangeEvent:
+    """
+    An object of the directory which was created, modified or deleted.
+
+    kind is one of user, session (the sessions of a teacher changed), schoolclass,
+    project, printer, managementgroup, group or deleted (only the dn of
+    deleted objects is known).
+    """
+
+    kind: str
+    cn: str
+    dn: str
+    school: str | None = None
+    role: str | None = None
+
+
+class ChangeBus:
+    """
+    In-process publish/subscribe of the changes of the directory.
+
+    Subscribers are called in the poller thread with the list of all events
+    of one poll, and must be fast (e.g. invalidate a cache).
+    """
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback, kinds=None):
+        """
+        Call callback(events) on each change of the directory.
+
+        :param callback: Function getting the list of ChangeEvent
+        :type callback: callable
+        :param kinds: Only send these kinds of events (deleted is always sent), all by default
+        :type kinds: list
+        """
+
+        kinds = set(kinds) | {'deleted'} if kinds is not None else None
+        with self._lock:
+            self._subscribers.append((callback, kinds))
+
+    def publish(self, events):
+        if not events:
+            return
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+
+        for callback, kinds in subscribers:
+            selected = events if kinds is None else [event for event in events if event.kind in kinds]
+            if not selected:
+                continue
+            try:
+                callback(selected)
+            except Exception as e:
+                logging.warning(f'Change subscriber {callback.__qualname__} failed: {e}')
+
+change_bus = ChangeBus()
+
+
+def _school_from_dn(dn):
+    # OU=SCHOOLS is the parent of the school OU
+    nodes = split_dn(dn)
+    for i, node in enumerate(nodes[1:], start=1):
+        if node[-1].upper() == 'SCHOOLS':
+            return nodes[i - 1][-1]
+    return None
+
+def _value(attrs, key):
+    values = attrs.get(key, [])
+    return values[0].decode('utf8') if values else None
+
+
+class ChangePoller:
+    """
+    Follow the uSNChanged of the Samba AD, to see all changes of the directory,
+    including the ones made by sophomorix outside of the API.
+
+    The highestCommittedUSN is read at start, then every changes.interval
+    seconds all objects with a greater uSNChanged are searched and published
+    on the change bus. The deleted objects are searched too, with the show
+    deleted control.
+
+    With many workers, only the worker holding the lease of the shared store
+    searches the changes. It writes them in the shared store, from where the
+    other workers publish them on their own change bus. The last uSNChanged is
+    stored with the lease, the next holder continues from it.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._stop = threading.Event()
+        self.usn = None
+        self.leader = False
+        # Id of the last change of the shared store published on the bus
+        self._change_id = None
+        # Hash of sophomorixSessions per teacher, to publish only real session changes
+        self._sessions = {}
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        changes_config = config.section('changes')
+        self.enabled = changes_config.get('enabled', True)
+        self.interval = changes_config.get('interval', 5)
+        # Another worker takes over if the lease is not renewed for a few polls
+        self.lease_ttl = max(30, 3 * self.interval)
+
+    def _highest_usn(self, pooled):
+        results = pooled.conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['highestCommittedUSN'])
+        return int(results[0][1]['highestCommittedUSN'][0])
+
+    def _event(self, dn, attrs):
+        cn = _value(attrs, 'cn') or get_common_name(dn)
+
+        if _value(attrs, 'isDeleted') == 'TRUE':
+            # The cn of a tombstone is "<cn>\nDEL:<objectGUID>"
+            return ChangeEvent('deleted', cn.split('\n')[0], dn)
+
+        school = _value(attrs, 'sophomorixSchoolname') or _school_from_dn(dn)
+        role = _value(attrs, 'sophomorixRole')
+
+        if role is not None:
+            return ChangeEvent('user', cn, dn, school=school, role=role)
+
+        if ',OU=Management,' in dn:
+            return ChangeEvent('managementgroup', cn, dn, school=school)
+
+        kind = GROUP_KINDS.get(_value(attrs, 'sophomorixType'), 'group')
+        return ChangeEvent(kind, cn, dn, school=school)
+
+    def _session_changed(self, cn, attrs):
+        sessions = hashlib.sha256(b'\n'.join(sorted(attrs.get('sophomorixSessions', [])))).digest()
+        previous = self._sessions.get(cn, None)
+        self._sessions[cn] = sessions
+        return previous != sessions
+
+    def poll(self):
+        """
+        Search and publish the changes since the last poll.
+
+        :return: Number of published events
+        :rtype: int
+        """
+
+        events = []
+
+        with ldap_pool.connection() as pooled:
+            if self.usn is None:
+                self.usn = self._highest_usn(pooled)
+                return 0
+
+            usn = self.usn
+            ldap_filter = f'(uSNChanged>={self.usn + 1})'
+            page_control = SimplePagedResultsControl(True, size=PAGE_SIZE, cookie=b'')
+            show_deleted = LDAPControl(SHOW_DELETED_OID, True)
+
+            while True:
+                results, controls = pooled.search(ldap_filter, CHANGE_ATTRIBUTES, serverctrls=[show_deleted, page_control])
+
+                for dn, attrs in results:
+                    # Ignore referrals
+                    if dn is None:
+                        continue
+
+                    usn = max(usn, int(attrs['uSNChanged'][0]))
+                    event = self._event(dn, attrs)
+                    events.append(event)
+
+                    if event.kind == 'deleted':
+                        self._sessions.pop(event.cn, None)
+                    elif event.kind == 'user' and event.role == 'teacher' and self._session_changed(event.cn, attrs):
+                        events.append(dataclasses.replace(event, kind='session'))
+
+                page_control.cookie = b''
+                for response_control in controls:
+                    if response_control.controlType == SimplePagedResultsControl.controlType:
+                        page_control.cookie = response_control.cookie
+
+                if not page_control.cookie:
+                    break
+
+        # Only moved forward after the whole search succeeded
+        self.usn = usn
+        change_bus.publish(events)
+        shared_store.add_changes([dataclasses.astuple(event) for event in events])
+        return len(events)
+
+    def follow(self):
+        """
+        Publish the changes found by the worker holding the lease.
+
+        :return: Number of published events
+        :rtype: int
+        """
+
+        self._change_id, changes, expired = shared_store.changes(self._change_id)
+        if expired:
+            logging.warning('Some LDAP changes were removed from the shared store before being read, the caches may be outdated until they expire')
+
+        events = [ChangeEvent(*change) for change in changes]
+        change_bus.publish(events)
+        return len(events)
+
+    def _poll_if_leader(self):
+        held, usn = shared_store.acquire_lease(POLLER_LEASE, self.lease_ttl)
+        if not held:
+            self.leader = False
+            return 0
+
+        if not self.leader:
+            # Continue after the previous holder of the lease
+            self.usn = int(usn) if usn is not None else None
+            self.leader = True
+
+        count = self.poll()
+        shared_store.set_lease_value(POLLER_LEASE, str(self.usn))
+        return count
+
+    def _loop(self):
+        while True:
+            if self.enabled:
+                try:
+                    count = self.follow() + self._poll_if_leader()
+                    if count:
+                        logging.debug(f'{count} LDAP changes published, uSNChanged is now {self.usn}')
+                except Exception as e:
+                    logging.warning(f'Can not poll LDAP changes: {e}')
+
+            if self._stop.wait(self.interval):
+                break
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='ldap-changes', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+        if self.leader:
+            shared_store.release_lease(POLLER_LEASE)
+            self.leader = False
+
+change_poller = ChangePoller()
@@ -1,6 +1,155 @@
+import logging
+import threading
 from fastapi import HTTPException
+from time import monotonic
 
-from linuxmusterTools.ldapconnector import LMNLdapReader as lr
+from utils.changes import change_bus
+from utils.config import api_config
+from utils.ldap import lr
+from utils.metrics import observe_cache
+
+
+class NameIndex:
+    """
+    List of the cn of a kind of objects (schoolclasses, teachers, ...) per
+    school, to check the existence of an object without LDAP request.
+
+    An index older than ttl seconds is still used, but refreshed in a
+    background thread. A name missing in the index is confirmed with one
+    targeted lookup, since the object may have been created since the last
+    refresh. Deleted objects are removed from the index as soon as the change
+    poller sees them.
+    """
+
+    def __init__(self, url, lookup):
+        """
+        :param url: Url of the collection for LMNLdapReader, e.g. /schoolclasses
+        :type url: basestring
+        :param lookup: Function (name, school) returning True if the object exists
+        :type lookup: callable
+        """
+
+        self.url = url
+        self.lookup = lookup
+        # school -> (load time, list of names, set of names), replaced as a
+        # whole on each change, never modified
+        self._index = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return api_config.section('cache').get('names_ttl', 60)
+
+    def _load(self, school):
+        names = [s['cn'] for s in lr.get(self.url, attributes=['cn'], school=school)]
+        with self._lock:
+            self._index[school] = (monotonic(), names, set(names))
+            self._refreshing.discard(school)
+        return names
+
+    def _refresh(self, school):
+        try:
+            self._load(school)
+        except Exception as e:
+            logging.warning(f'Can not refresh index of {self.url} for {school}: {e}')
+            with self._lock:
+                self._refreshing.discard(school)
+
+    def _entry(self, school):
+        with self._lock:
+            entry = self._index.get(school, None)
+            if entry is not None and monotonic() - entry[0] > self.ttl and school not in self._refreshing:
+                self._refreshing.add(school)
+                threading.Thread(target=self._refresh, args=(school,), daemon=True).start()
+
+        if entry is None:
+            self._load(school)
+            with self._lock:
+                entry = self._index[school]
+
+        return entry
+
+    def names(self, school):
+        """
+        Return the list of all cn in a school.
+        """
+
+        return list(self._entry(school)[1])
+
+    def exists(self, name, school):
+        found = name in self._entry(school)[2]
+        observe_cache(f'names:{self.url}', found)
+        if found:
+            return True
+
+        if self.lookup(name, school):
+            with self._lock:
+                entry = self._index.get(school, None)
+                if entry is not None and name not in entry[2]:
+                    loaded, names, names_set = entry
+                    self._index[school] = (loaded, names + [name], names_set | {name})
+            return True
+
+        return False
+
+    def discard(self, names):
+        """
+        Remove names from the index of all schools, e.g. deleted objects.
+
+        :param names: cn of the objects
+        :type names: iterable
+        """
+
+        names = set(names)
+        with self._lock:
+            for school, (loaded, school_names, names_set) in list(self._index.items()):
+                if names_set & names:
+                    self._index[school] = (
+                        loaded,
+                        [name for name in school_names if name not in names],
+                        names_set - names,
+                    )
+
+    def invalidate(self, school=None):
+        with self._lock:
+            if school is None:
+                self._index.clear()
+            else:
+                self._index.pop(school, None)
+
+def _schoolclass_exists(schoolclass, school):
+    return bool(lr.get(f'/schoolclasses/{schoolclass}', attributes=['cn'], school=school))
+
+def _teacher_exists(teacher, school):
+    user = lr.get(f'/users/{teacher}', attributes=['cn', 'sophomorixRole'], school=school)
+    return bool(user) and user.get('sophomorixRole', None) == 'teacher'
+
+schoolclasses_index = NameIndex('/schoolclasses', _schoolclass_exists)
+teachers_index = NameIndex('/roles/teacher', _teacher_exists)
+
+
+def _invalidate_changed_names(events):
+    # The indexes are keyed by the school of the requesting user, which may
+    # differ from the school of the object (e.g. global administrators)
+    kinds = {event.kind for event in events}
+    teachers = any(event.kind == 'user' and event.role == 'teacher' for event in events)
+
+    # Only the names of the deleted objects are known
+    deleted = [event.cn for event in events if event.kind == 'deleted']
+    # Including the users which are not teachers (anymore)
+    not_teachers = [event.cn for event in events if event.kind == 'user' and event.role != 'teacher']
+
+    if deleted:
+        schoolclasses_index.discard(deleted)
+    if deleted or not_teachers:
+        teachers_index.discard(deleted + not_teachers)
+    if 'schoolclass' in kinds:
+        schoolclasses_index.invalidate()
+    if teachers:
+        teachers_index.invalidate()
+
+change_bus.subscribe(_invalidate_changed_names, kinds=['schoolclass', 'user'])
 
 
 def get_user_or_404(user, school):
@@ -10,16 +159,14 @@ def get_user_or_404(user, school):
     return user_details
 
 def get_schoolclass_or_404(schoolclass, school):
-    schoolclasses = [s['cn'] for s in lr.get('/schoolclasses', attributes=['cn'], school=school)]
-    if schoolclass not in schoolclasses:
+    if not schoolclasses_index.exists(schoolclass, school):
         raise HTTPException(status_code=404, detail=f"Schoolclass {schoolclass} not found")
-    return schoolclasses
+    return schoolclasses_index.names(school)
 
 def get_teacher_or_404(teacher, school):
-    teachers = [s['cn'] for s in lr.get('/roles/teacher', attributes=['cn'], school=school)]
-    if teacher not in teachers:
+    if not teachers_index.exists(teacher, school):
         raise HTTPException(status_code=404, detail=f"Teacher {teacher} not found")
-    return teachers
+    return teachers_index.names(school)
 
 def get_project_or_404(project, school):
     project_details = lr.get(f'/projects/{project}', school=school, dict=False)
@@ -0,0 +1,161 @@
+import base64
+import binascii
+import logging
+import os
+import signal
+import threading
+from time import monotonic
+
+import yaml
+
+
+CONFIG_PATH = '/etc/linuxmuster/api/config.yml'
+
+
+class ApiConfig:
+    """
+    Configuration of the API, shared by all modules.
+
+    The file config.yml is parsed once and kept in memory, with the secret key
+    already decoded. It's reloaded when its mtime changes (checked at most every
+    CHECK_INTERVAL seconds) or when the process receives a SIGHUP.
+    """
+
+    CHECK_INTERVAL = 5
+
+    def __init__(self, path=CONFIG_PATH):
+        self.path = path
+        # Reentrant: load() may be called again from a callback
+        self._lock = threading.RLock()
+        self._reload_requested = False
+        self._data = {}
+        self._secret = None
+        self._mtime = None
+        self._last_check = 0
+        self._callbacks = []
+        self.load()
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return None
+
+    def load(self):
+        """
+        (Re)read config.yml and decode the secret key. If the file can not be
+        read, or is missing after the first load (e.g. during a package
+        upgrade), the previous configuration is kept.
+        """
+
+        data = {}
+        mtime = self._stat()
+        if mtime is None and self._mtime is not None:
+            logging.warning(f'{self.path} is missing, keeping the previous configuration')
+            with self._lock:
+                # Loaded again when the file is back
+                self._mtime = None
+                self._last_check = monotonic()
+            return
+
+        if mtime is not None:
+            try:
+                with open(self.path, 'r') as config_file:
+                    data = yaml.load(config_file, Loader=yaml.SafeLoader) or {}
+            except (OSError, yaml.YAMLError) as e:
+                logging.error(f'Can not read {self.path}, keeping the previous configuration: {e}')
+                with self._lock:
+                    self._mtime = mtime
+                    self._last_check = monotonic()
+                return
+
+        secret = None
+        if data.get('secret', None):
+            try:
+                secret = base64.b64decode(data['secret'])
+            except binascii.Error as e:
+                logging.error(f'Invalid secret key in {self.path}: {e}')
+
+        with self._lock:
+            self._data = data
+            self._secret = secret
+            self._mtime = mtime
+            self._last_check = monotonic()
+
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.error(f'Error while applying new configuration: {e}')
+
+    def check(self):
+        """
+        Reload the configuration if config.yml was modified since the last read,
+        or if a SIGHUP was received.
+        """
+
+        if self._reload_requested:
+            self._reload_requested = False
+            logging.info('SIGHUP received, reloading configuration')
+            self.load()
+            return
+
+        now = monotonic()
+        if now - self._last_check < self.CHECK_INTERVAL:
+            return
+
+        self._last_check = now
+        if self._stat() != self._mtime:
+            logging.info(f'{self.path} changed, reloading configuration')
+            self.load()
+
+    @property
+    def data(self):
+        self.check()
+        return self._data
+
+    @property
+    def secret(self):
+        """
+        Decoded secret key used to sign the JWT, None if not configured.
+        """
+
+        self.check()
+        return self._secret
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def section(self, key):
+        """
+        Return a configuration section as dict, even if missing in config.yml.
+        """
+
+        return self.data.get(key, None) or {}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def on_reload(self, callback):
+        """
+        Register a callback called with this object after each reload.
+        """
+
+        self._callbacks.append(callback)
+
+    def install_sighup_handler(self):
+        """
+        Reload the configuration on SIGHUP, must be called from the main thread.
+
+        The handler interrupts arbitrary code of the main thread, possibly
+        load() itself, so it only requests the reload: it's done at the next
+        read of the configuration.
+        """
+
+        def request_reload(signum, frame):
+            self._reload_requested = True
+
+        signal.signal(signal.SIGHUP, request_reload)
+
+
+api_config = ApiConfig()
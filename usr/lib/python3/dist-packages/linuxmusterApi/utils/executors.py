@@ -0,0 +1,136 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from utils.config import api_config
+from utils.metrics import EXECUTOR_TASKS, EXECUTOR_WORKERS
+from utils.tracing import current_trace
+
+
+class BackendExecutor:
+    """
+    Thread pool dedicated to the blocking calls of one backend (LDAP, or
+    sophomorix and the other external commands), so that a saturated backend
+    can not block the requests using the other one, nor the event loop.
+
+    The size of the pool is read from the executors section of config.yml,
+    the pool is created again after a reload, only if the size changed.
+    """
+
+    def __init__(self, name, size_key, default_size):
+        self.name = name
+        self.size_key = size_key
+        self.default_size = default_size
+        self._executor = None
+        self._size = None
+        self._lock = threading.Lock()
+        api_config.on_reload(self.configure)
+
+    @property
+    def size(self):
+        return api_config.section('executors').get(self.size_key, self.default_size)
+
+    @property
+    def executor(self):
+        with self._lock:
+            return self._get_executor()
+
+    def _get_executor(self):
+        # Must be called with the lock
+        if self._executor is None:
+            self._size = self.size
+            self._executor = ThreadPoolExecutor(max_workers=self._size, thread_name_prefix=self.name)
+            EXECUTOR_WORKERS.labels(self.name).set(self._size)
+        return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the pool without waiting for its result,
+        from any thread.
+
+        :return: Future of the result
+        :rtype: concurrent.futures.Future
+        """
+
+        # The pool can not be shut down between its read and the submit
+        with self._lock:
+            return self._get_executor().submit(func, *args, **kwargs)
+
+    def configure(self, config):
+        size = config.section('executors').get(self.size_key, self.default_size)
+        with self._lock:
+            if self._executor is None or size == self._size:
+                return
+            executor, self._executor = self._executor, None
+        # Running calls end in the old pool
+        executor.shutdown(wait=False)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the pool and await its result. The context
+        variables of the caller are available in the function.
+        """
+
+        context = contextvars.copy_context()
+        queued = EXECUTOR_TASKS.labels(self.name, 'queued')
+        running = EXECUTOR_TASKS.labels(self.name, 'running')
+        # Decrement the queue exactly once, when the call starts or is cancelled
+        dequeue = threading.Lock()
+        trace = current_trace.get()
+        submitted = perf_counter()
+
+        def call():
+            if dequeue.acquire(blocking=False):
+                queued.dec()
+            if trace is not None:
+                # Time spent waiting for a free thread
+                trace.add('queue', self.name, submitted, perf_counter() - submitted)
+            running.inc()
+            try:
+                return context.run(func, *args, **kwargs)
+            finally:
+                running.dec()
+
+        queued.inc()
+        try:
+            return await asyncio.wrap_future(self.submit(call))
+        finally:
+            if dequeue.acquire(blocking=False):
+                queued.dec()
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+ldap_executor = BackendExecutor('ldap', 'ldap_workers', 16)
+sophomorix_executor = BackendExecutor('sophomorix', 'sophomorix_workers', 4)
+store_executor = BackendExecutor('store', 'store_workers', 2)
+
+
+async def run_ldap(func, *args, **kwargs):
+    """
+    Run a blocking LDAP call (LMNLdapReader, LMNLdapWriter, utils.ldap, ...)
+    in the LDAP pool.
+    """
+
+    return await ldap_executor.run(func, *args, **kwargs)
+
+async def run_sophomorix(func, *args, **kwargs):
+    """
+    Run a blocking sophomorix call, another external command (e.g. quotas),
+    or the parsing of a sophomorix output, in the sophomorix pool.
+    """
+
+    return await sophomorix_executor.run(func, *args, **kwargs)
+
+async def run_store(func, *args, **kwargs):
+    """
+    Run a blocking call to a local SQLite database (e.g. the job store) in
+    the store pool.
+    """
+
+    return await store_executor.run(func, *args, **kwargs)
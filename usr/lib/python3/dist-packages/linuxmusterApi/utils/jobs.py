@@ -0,0 +1,323 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+from time import time
+from uuid import uuid4
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from utils.config import api_config
+from utils.executors import run_store
+from utils.tracing import current_trace
+
+
+JOBS_PATH = '/var/lib/linuxmuster-api/jobs.db'
+
+# Set in the task of a running job, see set_progress
+current_job = contextvars.ContextVar('current_job', default=None)
+
+
+def worker_id(pid=None):
+    """
+    Identity of a worker process: its pid and start time, which stay unique
+    if the pid is reused later.
+
+    :param pid: Pid of the process, default the current process
+    :type pid: int
+    :return: e.g. 1234:567890, None if the process does not exist
+    :rtype: basestring
+    """
+
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            stat = f.read()
+    except OSError:
+        return None
+
+    # The command name between parentheses may contain spaces, the start
+    # time is the 22nd field
+    return f'{pid}:{stat.rsplit(")", 1)[1].split()[19]}'
+
+def _worker_alive(worker):
+    if worker is None:
+        return False
+    pid = worker.split(':')[0]
+    return pid.isdigit() and worker_id(int(pid)) == worker
+
+
+class JobStore:
+    """
+    SQLite table of the jobs, kept on disk so that the status and result of a
+    job can be read from any worker, and after a restart.
+
+    Each job records the worker running it, so that the jobs of the workers
+    which are gone can be told apart from the ones still running in the
+    other workers. The files produced by a job are kept in a directory of
+    the job, next to the database.
+
+    All methods block, call them through utils.executors.run_store.
+    """
+
+    COLUMNS = ['id', 'owner', 'kind', 'status', 'progress', 'created', 'started', 'finished', 'result', 'error']
+
+    def __init__(self):
+        self._local = threading.local()
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        jobs_config = config.section('jobs')
+        self.path = jobs_config.get('path', JOBS_PATH)
+        self.retention = jobs_config.get('retention', 86400)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'path', None) != self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS jobs ('
+                'id TEXT PRIMARY KEY, owner TEXT NOT NULL, kind TEXT NOT NULL, status TEXT NOT NULL, '
+                'progress REAL NOT NULL, created REAL NOT NULL, started REAL, finished REAL, result TEXT, error TEXT)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created)')
+            if 'worker' not in [column[1] for column in conn.execute('PRAGMA table_info(jobs)')]:
+                # Databases created before the jobs recorded their worker
+                conn.execute('ALTER TABLE jobs ADD COLUMN worker TEXT')
+            self._local.conn = conn
+            self._local.path = self.path
+        return conn
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = dict(zip(self.COLUMNS, row))
+        job['result'] = json.loads(job['result']) if job['result'] is not None else None
+        return job
+
+    def create(self, owner, kind):
+        job_id = uuid4().hex
+        self.conn.execute(
+            'INSERT INTO jobs (id, owner, kind, status, progress, created, worker) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (job_id, owner, kind, 'queued', 0, time(), worker_id())
+        )
+        return job_id
+
+    def update(self, job_id, **values):
+        if 'result' in values:
+            values['result'] = json.dumps(jsonable_encoder(values['result']))
+        columns = ', '.join(f'{column} = ?' for column in values)
+        self.conn.execute(f'UPDATE jobs SET {columns} WHERE id = ?', (*values.values(), job_id))
+
+    def get(self, job_id):
+        row = self.conn.execute(f'SELECT {", ".join(self.COLUMNS)} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return self._job(row)
+
+    def list(self, owner=None):
+        query = f'SELECT {", ".join(self.COLUMNS)} FROM jobs'
+        params = ()
+        if owner is not None:
+            query += ' WHERE owner = ?'
+            params = (owner,)
+        rows = self.conn.execute(f'{query} ORDER BY created DESC', params).fetchall()
+        return [self._job(row) for row in rows]
+
+    def files_dir(self, job_id):
+        return os.path.join(os.path.dirname(self.path), 'files', job_id)
+
+    def file_path(self, job_id, filename):
+        """
+        Path of a file produced by a job, removed with the job.
+        """
+
+        directory = self.files_dir(job_id)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, os.path.basename(filename))
+
+    def purge(self):
+        """
+        Remove the finished jobs older than jobs.retention seconds, and their
+        files.
+        """
+
+        expired = time() - self.retention
+        rows = self.conn.execute('SELECT id FROM jobs WHERE finished IS NOT NULL AND finished < ?', (expired,)).fetchall()
+        self.conn.execute('DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?', (expired,))
+        for job_id, in rows:
+            shutil.rmtree(self.files_dir(job_id), ignore_errors=True)
+
+    def interrupt(self):
+        """
+        Mark the queued or running jobs of the workers which are gone (e.g.
+        before a restart) as failed: sophomorix commands can not be safely run
+        twice. The jobs of the running workers are kept.
+
+        :return: Number of interrupted jobs
+        :rtype: int
+        """
+
+        rows = self.conn.execute("SELECT id, worker FROM jobs WHERE status IN ('queued', 'running')").fetchall()
+        interrupted = [job_id for job_id, worker in rows if not _worker_alive(worker)]
+        now = time()
+        self.conn.executemany(
+            "UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ? AND status IN ('queued', 'running')",
+            [('Interrupted by a restart of the API', now, job_id) for job_id in interrupted]
+        )
+        return len(interrupted)
+
+
+class JobQueue:
+    """
+    Run long sophomorix operations in the background, with at most
+    jobs.workers jobs at the same time, and record their status, progress and
+    result in the job store.
+    """
+
+    def __init__(self):
+        self.store = JobStore()
+        self.workers = None
+        self._semaphore = None
+        self._tasks = set()
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        workers = max(config.section('jobs').get('workers', 2), 1)
+        if workers != self.workers:
+            # Created again in the running event loop at next use. Only when
+            # the limit changed: the jobs waiting on the old semaphore are not
+            # limited by the new one.
+            self.workers = workers
+            self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        return self._semaphore
+
+    async def start(self):
+        """
+        Clean up the store at startup: the jobs of the workers which are gone
+        are marked as failed. Each worker does it when it starts, e.g. when
+        uvicorn replaces a dead worker, the jobs of the running workers are
+        not touched.
+        """
+
+        try:
+            interrupted = await run_store(self.store.interrupt)
+            await run_store(self.store.purge)
+        except sqlite3.Error as e:
+            logging.warning(f'Can not clean up the job store {self.store.path}: {e}')
+            return
+
+        if interrupted:
+            logging.warning(f'{interrupted} jobs interrupted by a restart of the API')
+
+    def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+
+    async def submit(self, owner, kind, func):
+        """
+        Queue a job.
+
+        :param owner: cn of the user starting the job
+        :type owner: basestring
+        :param kind: Description of the job, e.g. exam-start
+        :type kind: basestring
+        :param func: Coroutine function without argument doing the work
+        :type func: callable
+        :return: Id of the job
+        :rtype: basestring
+        """
+
+        await run_store(self.store.purge)
+        job_id = await run_store(self.store.create, owner, kind)
+        task = asyncio.ensure_future(self._run(job_id, func))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job_id
+
+    async def _run(self, job_id, func):
+        # Don't add the spans of the job to the trace of the submitting request
+        current_trace.set(None)
+        current_job.set(job_id)
+
+        async with self.semaphore:
+            await run_store(self.store.update, job_id, status='running', started=time())
+            try:
+                result = await func()
+            except HTTPException as e:
+                await run_store(self.store.update, job_id, status='failed', error=str(e.detail), finished=time())
+            except asyncio.CancelledError:
+                # On shutdown: written at once, the executors are stopping too
+                self.store.update(job_id, status='failed', error='Interrupted by a restart of the API', finished=time())
+                raise
+            except Exception as e:
+                logging.error(f'Job {job_id} failed: {e}')
+                await run_store(self.store.update, job_id, status='failed', error=str(e), finished=time())
+            else:
+                await run_store(self.store.update, job_id, status='done', progress=1, result=result, finished=time())
+
+job_queue = JobQueue()
+
+
+async def set_progress(progress):
+    """
+    Update the progress (between 0 and 1) of the running job, if any.
+    """
+
+    job_id = current_job.get()
+    if job_id is not None:
+        await run_store(job_queue.store.update, job_id, progress=progress)
+
+def job_file_path(filename):
+    """
+    Path where the running job stores a file it produces, see
+    JobStore.file_path.
+
+    :param filename: Name of the file
+    :type filename: basestring
+    :return: Path of the file, None outside of a job
+    :rtype: basestring
+    """
+
+    job_id = current_job.get()
+    if job_id is None:
+        return None
+    return job_queue.store.file_path(job_id, filename)
+
+async def run_or_submit(background, who, kind, func):
+    """
+    Run func now and return its result, or queue it as a job if background is
+    set and return a 202 response with the id of the job.
+
+    :param background: Run the job in the background
+    :type background: bool
+    :param who: User requesting the operation
+    :type who: AuthenticatedUser
+    :param kind: Description of the job, e.g. exam-start
+    :type kind: basestring
+    :param func: Coroutine function without argument doing the work
+    :type func: callable
+    """
+
+    if not background:
+        return await func()
+
+    job_id = await job_queue.submit(who.user, kind, func)
+    return JSONResponse(
+        status_code=202,
+        content={'id': job_id, 'status': 'queued', 'url': f'/v1/jobs/{job_id}'},
+        headers={'Location': f'/v1/jobs/{job_id}'},
+    )
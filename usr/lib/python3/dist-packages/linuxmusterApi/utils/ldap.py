@@ -1,4 +1,37 @@
+import base64
+import binascii
+import contextvars
+import copy
+import dataclasses
+import functools
+import logging
+import os
+import re
+import threading
+import ldap
+import ldap.filter
+import yaml
+from ldap.controls import SimplePagedResultsControl
+from ldap.controls.sss import SSSRequestControl
+from collections import deque
+from concurrent.futures import Future
+from contextlib import contextmanager
+from time import monotonic, sleep
 
+from linuxmusterTools.ldapconnector import LMNLdapReader, LMNLdapWriter
+from linuxmusterTools.ldapconnector.models import LMNUser
+from utils.config import api_config
+from utils.metrics import observe_ldap, path_pattern
+from utils.tracing import span
+
+
+WEBUI_CONFIG_PATH = '/etc/linuxmuster/webui/config.yml'
+
+# CA of the self-signed certificates created by linuxmuster-setup
+LINUXMUSTER_CA_FILE = '/etc/linuxmuster/ssl/cacert.pem'
+
+# Max number of cn in one OR filter
+BATCH_SIZE = 200
 
 
 def split_dn(dn):
@@ -11,4 +44,830 @@ def get_common_name(dn):
         # [['CN', '11c'], ['OU', '11c'], ['OU', 'Students'],...]
         return split_dn(dn)[0][1]
     except KeyError:
-        return ''
\ No newline at end of file
+        return ''
+
+def get_ldap_config():
+    """
+    Connection parameters (host, binddn, bindpw, searchdn) from the ldap
+    section of config.yml. Missing parameters are read from the webui config,
+    like linuxmusterTools does.
+    """
+
+    ldap_config = dict(api_config.section('ldap'))
+
+    if not all(ldap_config.get(key) for key in ['host', 'binddn', 'bindpw', 'searchdn']):
+        try:
+            with open(WEBUI_CONFIG_PATH, 'r') as config_file:
+                webui_config = yaml.load(config_file, Loader=yaml.SafeLoader) or {}
+            for key, value in webui_config.get('linuxmuster', {}).get('ldap', {}).items():
+                ldap_config.setdefault(key, value)
+        except OSError as e:
+            logging.error(f'Can not read LDAP parameters from {WEBUI_CONFIG_PATH}: {e}')
+
+    return ldap_config
+
+
+def connect():
+    """
+    Open a new bound connection to the Samba AD.
+
+    :return: Connection and base dn for searches
+    :rtype: tuple
+    """
+
+    config = get_ldap_config()
+    host = config['host']
+    uri = host if '://' in host else f'ldaps://{host}'
+    conn = ldap.initialize(uri)
+    conn.set_option(ldap.OPT_REFERRALS, 0)
+
+    # The bind password must only be sent to the real server
+    if config.get('tls_verify', True):
+        conn.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_DEMAND)
+    else:
+        conn.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+    ca_file = config.get('ca_file', None)
+    if not ca_file and os.path.isfile(LINUXMUSTER_CA_FILE):
+        ca_file = LINUXMUSTER_CA_FILE
+    if ca_file:
+        conn.set_option(ldap.OPT_X_TLS_CACERTFILE, ca_file)
+    # Apply the TLS options above, must be set last
+    conn.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
+    conn.simple_bind_s(config['binddn'], config['bindpw'])
+    return conn, config['searchdn']
+
+
+class PooledConnection:
+    """
+    Bound connection of the pool, with the time of its last use.
+    """
+
+    def __init__(self):
+        self.conn, self.searchdn = connect()
+        self.last_used = monotonic()
+
+    def search(self, ldap_filter, attributes=None, base=None, serverctrls=None, first_page=False):
+        msgid = self.conn.search_ext(base or self.searchdn, ldap.SCOPE_SUBTREE, ldap_filter, attributes, serverctrls=serverctrls)
+        rtype, results, rmsgid, controls = self.conn.result3(msgid)
+        if first_page:
+            self._abandon_paging(ldap_filter, base, serverctrls, controls)
+        return results, controls
+
+    def _abandon_paging(self, ldap_filter, base, serverctrls, controls):
+        """
+        Release the state kept by the server for a paged search, when the
+        next pages are not read: the same search is sent again with the cookie
+        and a page size of 0.
+        """
+
+        cookie = b''
+        for response_control in controls:
+            if response_control.controlType == SimplePagedResultsControl.controlType:
+                cookie = response_control.cookie
+        if not cookie:
+            return
+
+        serverctrls = [
+            SimplePagedResultsControl(control.criticality, size=0, cookie=cookie)
+            if isinstance(control, SimplePagedResultsControl) else control
+            for control in serverctrls
+        ]
+        msgid = self.conn.search_ext(base or self.searchdn, ldap.SCOPE_SUBTREE, ldap_filter, ['1.1'], serverctrls=serverctrls)
+        self.conn.result3(msgid)
+
+    def ping(self):
+        """
+        Keepalive probe, raises an ldap.LDAPError if the connection is dead.
+        """
+
+        self.conn.whoami_s()
+
+    def close(self):
+        try:
+            self.conn.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+class LdapPool:
+    """
+    Pool of bound connections to the Samba AD, to avoid the TCP, TLS and bind
+    costs on each request.
+
+    A connection is checked out for one search, and returned to the pool
+    afterwards. The pool opens at most pool_max_size connections, and keeps at
+    least pool_min_size of them open. A background thread probes the idle
+    connections every keepalive_interval seconds, and closes the connections
+    above pool_min_size which were not used for pool_idle_timeout seconds.
+    A connection raising SERVER_DOWN is dropped, and the search is retried
+    once on a new connection.
+    """
+
+    def __init__(self):
+        self._idle = deque()
+        self._opened = 0
+        self._cond = threading.Condition()
+        self._keepalive = None
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        ldap_config = config.section('ldap')
+        self.min_size = ldap_config.get('pool_min_size', 2)
+        self.max_size = max(ldap_config.get('pool_max_size', 16), 1)
+        self.checkout_timeout = ldap_config.get('pool_timeout', 10)
+        self.keepalive_interval = ldap_config.get('keepalive_interval', 60)
+        self.idle_timeout = ldap_config.get('pool_idle_timeout', 300)
+        # The connection parameters may have changed
+        self.clear()
+
+    def _start_keepalive(self):
+        if self._keepalive is None:
+            self._keepalive = threading.Thread(target=self._keepalive_loop, name='ldap-keepalive', daemon=True)
+            self._keepalive.start()
+
+    def _keepalive_loop(self):
+        while True:
+            sleep(self.keepalive_interval)
+            try:
+                self._check_idle()
+            except Exception as e:
+                logging.warning(f'LDAP pool keepalive failed: {e}')
+
+    def _check_idle(self):
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+
+        now = monotonic()
+        alive = []
+        for pooled in idle:
+            if len(alive) >= self.min_size and now - pooled.last_used > self.idle_timeout:
+                pooled.close()
+                continue
+            try:
+                pooled.ping()
+                alive.append(pooled)
+            except ldap.LDAPError:
+                pooled.close()
+
+        with self._cond:
+            self._opened -= len(idle) - len(alive)
+            self._idle.extend(alive)
+            missing = max(self.min_size - self._opened, 0)
+            self._opened += missing
+            self._cond.notify_all()
+
+        for _ in range(missing):
+            try:
+                pooled = PooledConnection()
+            except ldap.LDAPError as e:
+                logging.warning(f'Can not open LDAP connection: {e}')
+                self._discard(None)
+                continue
+            self.release(pooled)
+
+    def acquire(self):
+        """
+        Check out an idle connection, or open a new one if the pool is not
+        full. Waits up to pool_timeout seconds for a free connection.
+
+        :return: Bound connection
+        :rtype: PooledConnection
+        """
+
+        self._start_keepalive()
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._idle or self._opened < self.max_size, timeout=self.checkout_timeout):
+                raise ldap.TIMEOUT({'desc': 'No free connection in the LDAP pool'})
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+
+        try:
+            return PooledConnection()
+        except Exception:
+            self._discard(None)
+            raise
+
+    def release(self, pooled):
+        pooled.last_used = monotonic()
+        with self._cond:
+            self._idle.append(pooled)
+            self._cond.notify()
+
+    def _discard(self, pooled):
+        if pooled is not None:
+            pooled.close()
+        with self._cond:
+            self._opened -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """
+        Context manager checking out a connection for the duration of a block.
+        """
+
+        pooled = self.acquire()
+        try:
+            yield pooled
+        except ldap.SERVER_DOWN:
+            self._discard(pooled)
+            raise
+        except BaseException:
+            self.release(pooled)
+            raise
+        else:
+            self.release(pooled)
+
+    def clear(self):
+        """
+        Close all idle connections, e.g. after the server restarted.
+        """
+
+        with self._cond:
+            idle, self._idle = list(self._idle), deque()
+            self._opened -= len(idle)
+            self._cond.notify_all()
+        for pooled in idle:
+            pooled.close()
+
+    def search(self, ldap_filter, attributes=None, base=None, serverctrls=None, first_page=False):
+        """
+        Search in the whole tree with a pooled connection.
+
+        :param ldap_filter: Valid LDAP filter
+        :type ldap_filter: basestring
+        :param attributes: Attributes to get, all by default
+        :type attributes: list
+        :param base: Base dn of the search, searchdn by default
+        :type base: basestring
+        :param serverctrls: LDAP controls, e.g. for sorting
+        :type serverctrls: list
+        :param first_page: Only read the first page of a paged search, and
+        release the paging state on the server
+        :type first_page: bool
+        :return: List of (dn, attributes) tuples, and response controls
+        :rtype: tuple
+        """
+
+        with observe_ldap('search', 'pool'), span('ldap', f'search {ldap_filter}'):
+            try:
+                with self.connection() as pooled:
+                    results, controls = pooled.search(ldap_filter, attributes, base, serverctrls, first_page)
+            except ldap.SERVER_DOWN:
+                # The other idle connections are most likely dead too
+                self.clear()
+                with self.connection() as pooled:
+                    results, controls = pooled.search(ldap_filter, attributes, base, serverctrls, first_page)
+
+        # Ignore referrals
+        return [(dn, attrs) for dn, attrs in results if dn is not None], controls
+
+ldap_pool = LdapPool()
+
+
+def paged_search(ldap_filter, attributes=None, limit=100, cursor=None):
+    """
+    Get one page of results, sorted by cn.
+
+    The cursor is the last cn of the previous page (base64 encoded), and the
+    next page is searched with an additional filter on cn. No state is kept
+    on the server between two pages: the AD binds the paging cookies to a
+    connection, which would not work with many workers.
+
+    :param ldap_filter: Valid LDAP filter
+    :type ldap_filter: basestring
+    :param attributes: Attributes to get, all by default
+    :type attributes: list
+    :param limit: Max number of entries in the page
+    :type limit: int
+    :param cursor: Cursor returned with the previous page, None for the first page
+    :type cursor: basestring
+    :return: List of (dn, attributes) tuples and cursor of the next page (None after the last page)
+    :rtype: tuple
+    """
+
+    if cursor is not None:
+        try:
+            last_cn = base64.urlsafe_b64decode(cursor.encode()).decode('utf8')
+        except (binascii.Error, UnicodeDecodeError):
+            raise ValueError('Invalid cursor')
+        last_cn = ldap.filter.escape_filter_chars(last_cn)
+        ldap_filter = f'(&{ldap_filter}(cn>={last_cn})(!(cn={last_cn})))'
+
+    if attributes is not None and 'cn' not in attributes:
+        attributes = ['cn', *attributes]
+
+    # Ask one more entry to know if there's a next page
+    sort_control = SSSRequestControl(criticality=True, ordering_rules=['cn'])
+    page_control = SimplePagedResultsControl(True, size=limit + 1, cookie=b'')
+    results, controls = ldap_pool.search(ldap_filter, attributes, serverctrls=[sort_control, page_control], first_page=True)
+
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        last_cn = results[-1][1]['cn'][0]
+        next_cursor = base64.urlsafe_b64encode(last_cn).decode()
+
+    return results, next_cursor
+
+
+def iter_search(ldap_filter, attributes=None, page_size=500):
+    """
+    Iterate over the results of a search, fetched page by page on a dedicated
+    connection, so that only one page is in memory at a time. The connection
+    is not taken from the pool, since a slow client could hold it for a long
+    time.
+
+    :param ldap_filter: Valid LDAP filter
+    :type ldap_filter: basestring
+    :param attributes: Attributes to get, all by default
+    :type attributes: list
+    :param page_size: Number of entries fetched per request
+    :type page_size: int
+    :return: Generator of (dn, attributes) tuples
+    :rtype: generator
+    """
+
+    conn, searchdn = connect()
+    try:
+        control = SimplePagedResultsControl(True, size=page_size, cookie=b'')
+        while True:
+            msgid = conn.search_ext(searchdn, ldap.SCOPE_SUBTREE, ldap_filter, attributes, serverctrls=[control])
+            rtype, results, rmsgid, controls = conn.result3(msgid)
+
+            for dn, attrs in results:
+                # Ignore referrals
+                if dn is not None:
+                    yield dn, attrs
+
+            control.cookie = b''
+            for response_control in controls:
+                if response_control.controlType == SimplePagedResultsControl.controlType:
+                    control.cookie = response_control.cookie
+
+            if not control.cookie:
+                break
+    finally:
+        conn.unbind_s()
+
+
+def _field_value(field_type, values):
+    type_name = getattr(field_type, '__name__', str(field_type)).lower()
+    if type_name.startswith('list'):
+        return values
+    if not values:
+        return {'bool': False, 'int': 0}.get(type_name, '')
+    if type_name == 'bool':
+        return values[0].upper() == 'TRUE'
+    if type_name == 'int':
+        try:
+            return int(values[0])
+        except ValueError:
+            return 0
+    return values[0]
+
+def to_model(model, dn, attributes):
+    """
+    Convert a raw LDAP entry into a linuxmusterTools model (e.g. LMNUser), in
+    order to get the same fields as LMNLdapReader.
+
+    :param model: Dataclass from linuxmusterTools.ldapconnector.models
+    :type model: dataclass
+    :param dn: Distinguished name of the entry
+    :type dn: basestring
+    :param attributes: Raw attributes of the entry
+    :type attributes: dict
+    """
+
+    attributes = {key.lower(): values for key, values in attributes.items()}
+    data = {}
+    for field in dataclasses.fields(model):
+        if not field.init:
+            continue
+        values = [value.decode('utf8', errors='replace') for value in attributes.get(field.name.lower(), [])]
+        data[field.name] = _field_value(field.type, values)
+
+    if 'dn' in data:
+        data['dn'] = dn
+    if 'distinguishedName' in data:
+        data['distinguishedName'] = dn
+
+    return model(**data)
+
+def decode_entry(dn, attributes):
+    """
+    Convert a raw LDAP entry into a dict, with lists only for multi-valued
+    attributes.
+    """
+
+    entry = {'dn': dn}
+    for key, values in attributes.items():
+        values = [value.decode('utf8', errors='replace') for value in values]
+        entry[key] = values[0] if len(values) == 1 else values
+    return entry
+
+def search_users(cns, attributes=None):
+    """
+    Search users by cn with OR filters, in chunks of BATCH_SIZE cns.
+
+    :param cns: cns of the users
+    :type cns: iterable
+    :param attributes: Attributes to get, all by default
+    :type attributes: list
+    :return: Raw results by lowercase cn
+    :rtype: dict
+    """
+
+    entries = {}
+    cns = list(dict.fromkeys(cn.lower() for cn in cns if cn))
+
+    if attributes is not None and 'cn' not in attributes:
+        attributes = ['cn', *attributes]
+
+    for i in range(0, len(cns), BATCH_SIZE):
+        chunk = cns[i:i + BATCH_SIZE]
+        cn_filter = ''.join(f'(cn={ldap.filter.escape_filter_chars(cn)})' for cn in chunk)
+        ldap_filter = f'(&(objectClass=user)(sophomorixRole=*)(|{cn_filter}))'
+
+        results, controls = ldap_pool.search(ldap_filter, attributes=attributes)
+        for dn, attrs in results:
+            cn = attrs.get('cn', [b''])[0].decode('utf8').lower()
+            entries[cn] = (dn, attrs)
+
+    return entries
+
+def split_attributes(attributes):
+    """
+    Convert a comma separated list of attributes (e.g. from a query parameter)
+    into a list, None stays None.
+    """
+
+    if attributes is None:
+        return None
+    return [attribute.strip() for attribute in attributes.split(',') if attribute.strip()]
+
+def users_filter(role=None, adminclass=None, school=None):
+    """
+    LDAP filter to search users, optionally with a specific role, adminclass
+    or school.
+    """
+
+    ldap_filter = '(objectClass=user)(sophomorixRole=*)'
+    for attribute, value in [('sophomorixRole', role), ('sophomorixAdminClass', adminclass), ('sophomorixSchoolname', school)]:
+        if value:
+            ldap_filter += f'({attribute}={ldap.filter.escape_filter_chars(value)})'
+    return f'(&{ldap_filter})'
+
+def _user_dict(dn, attrs, attributes=None):
+    user = to_model(LMNUser, dn, attrs).asdict()
+    if attributes is not None:
+        wanted = {attribute.lower() for attribute in attributes}
+        user = {key: value for key, value in user.items() if key.lower() in wanted}
+    return user
+
+def get_users_page(attributes, limit=100, cursor=None, role=None, adminclass=None, school=None):
+    """
+    Get one page of users, without loading all users in memory.
+
+    :param attributes: Attributes to return (cn is always returned), all if None
+    :type attributes: list
+    :param limit: Max number of users in the page
+    :type limit: int
+    :param cursor: Cursor returned with the previous page, None for the first page
+    :type cursor: basestring
+    :param role: Only users with this sophomorixRole
+    :type role: basestring
+    :param adminclass: Only users with this sophomorixAdminClass
+    :type adminclass: basestring
+    :param school: Only users from this school
+    :type school: basestring
+    :return: List of users details (dict) and cursor of the next page
+    :rtype: tuple
+    """
+
+    if attributes is not None:
+        attributes = list(dict.fromkeys(['cn', *attributes]))
+    ldap_filter = users_filter(role=role, adminclass=adminclass, school=school)
+    results, next_cursor = paged_search(ldap_filter, attributes=attributes, limit=limit, cursor=cursor)
+
+    users = [_user_dict(dn, attrs, attributes) for dn, attrs in results]
+
+    return users, next_cursor
+
+def iter_users(attributes, role=None, adminclass=None, school=None):
+    """
+    Iterate over users, fetched page by page from LDAP.
+    See get_users_page for the parameters.
+
+    :return: Generator of users details (dict)
+    :rtype: generator
+    """
+
+    if attributes is not None:
+        attributes = list(dict.fromkeys(['cn', *attributes]))
+    ldap_filter = users_filter(role=role, adminclass=adminclass, school=school)
+
+    for dn, attrs in iter_search(ldap_filter, attributes=attributes):
+        yield _user_dict(dn, attrs, attributes)
+
+SEARCH_ATTRIBUTES = [
+    'cn',
+    'displayName',
+    'distinguishedName',
+    'sAMAccountName',
+    'sophomorixAdminClass',
+    'sophomorixRole',
+    'sophomorixSchoolname',
+]
+
+def iter_search_keyword(keyword, school=None):
+    """
+    Iterate over users and groups whose cn, displayName or sAMAccountName
+    contain keyword, fetched page by page from LDAP.
+
+    :param keyword: String to search for
+    :type keyword: basestring
+    :param school: Only search in this school, all schools if None
+    :type school: basestring
+    :return: Generator of basic details of the objects (dict)
+    :rtype: generator
+    """
+
+    keyword = ldap.filter.escape_filter_chars(keyword)
+    ldap_filter = f'(|(cn=*{keyword}*)(displayName=*{keyword}*)(sAMAccountName=*{keyword}*))'
+    ldap_filter = f'(&(|(objectClass=user)(objectClass=group))(sophomorixRole=*){ldap_filter}'
+    if school:
+        ldap_filter += f'(sophomorixSchoolname={ldap.filter.escape_filter_chars(school)})'
+    ldap_filter += ')'
+
+    for dn, attrs in iter_search(ldap_filter, attributes=SEARCH_ATTRIBUTES):
+        yield decode_entry(dn, attrs)
+
+def get_roles(cns):
+    """
+    Get the sophomorixRole of many users at once, exam accounts (ending with
+    -exam) included.
+
+    :param cns: cns of the users
+    :type cns: iterable
+    :return: Role by cn, None for unknown users
+    :rtype: dict
+    """
+
+    cns = list(cns)
+    entries = search_users(cns, attributes=['sophomorixRole'])
+
+    roles = {}
+    for cn in cns:
+        dn, attrs = entries.get(cn.lower(), (None, {}))
+        role = attrs.get('sophomorixRole', [None])[0]
+        roles[cn] = role.decode('utf8') if role is not None else None
+
+    return roles
+
+def get_users(cns, dict=True):
+    """
+    Get the details of many users at once, with one LDAP search (or a few for
+    large lists) instead of one lr.get per user.
+
+    :param cns: cns of the users
+    :type cns: list
+    :param dict: Return dicts like lr.get, or LMNUser objects
+    :type dict: bool
+    :return: Details of the users, in the order of cns ({} for unknown users)
+    :rtype: list
+    """
+
+    entries = search_users(cns)
+    users = []
+
+    for cn in cns:
+        entry = entries.get(cn.lower(), None)
+        if entry is None:
+            users.append({} if dict else None)
+            continue
+        user = to_model(LMNUser, *entry)
+        users.append(user.asdict() if dict else user)
+
+    return users
+
+
+class ReadMemo:
+    """
+    Results of the LDAP reads shared by the requests of a batch: identical
+    reads, even running at the same time in different threads, are done only
+    once. Each caller gets its own copy of the result, since the endpoints
+    modify them.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            future = self._futures.get(key, None)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                future.set_exception(e)
+
+        return copy.deepcopy(future.result())
+
+# Set by the batch endpoint for its sub-requests
+read_memo = contextvars.ContextVar('read_memo', default=None)
+
+def _memoized(name, func, *args, **kwargs):
+    memo = read_memo.get()
+    if memo is None:
+        return func(*args, **kwargs)
+    key = (name, repr(args), repr(sorted(kwargs.items())))
+    return memo.get(key, lambda: func(*args, **kwargs))
+
+def _observed(target, name, memoize=False):
+    """
+    Attribute of a linuxmusterTools reader or writer, with its calls measured
+    in the metrics if it's a method. The calls of the reader methods are
+    shared through the read memo, if any.
+    """
+
+    attribute = getattr(target, name)
+    if not callable(attribute):
+        return attribute
+
+    def call(*args, **kwargs):
+        # Reader methods get an url, writer methods the name of an object
+        path = path_pattern(args[0]) if args and isinstance(args[0], str) and args[0].startswith('/') else '{}'
+        with observe_ldap(name, path), span('ldap', f'{name} {args[0] if args else ""}'):
+            return attribute(*args, **kwargs)
+
+    @functools.wraps(attribute)
+    def wrapper(*args, **kwargs):
+        if memoize:
+            return _memoized(name, call, *args, **kwargs)
+        return call(*args, **kwargs)
+
+    return wrapper
+
+
+# Returned by the directory snapshot for the reads it can not answer
+MISSING = object()
+
+
+class LdapReader:
+    """
+    Wrapper around linuxmusterTools' LMNLdapReader, used by the whole API for
+    the LDAP reads.
+
+    If the directory snapshot is enabled (see utils.snapshot), the reads it
+    knows are answered from memory. The single user reads (/users/<cn>, e.g.
+    for the authentication or the permission checks) are the most frequent
+    ones, and are done with a pooled connection. Unknown users and all other
+    paths are delegated to linuxmusterTools, which keeps the exact same
+    outputs.
+    """
+
+    USER_PATH = re.compile(r'^/users/([^/]+)$')
+
+    snapshot = None
+
+    def use_snapshot(self, snapshot):
+        self.snapshot = snapshot
+
+    def _from_snapshot(self, url, **kwargs):
+        if self.snapshot is None:
+            return MISSING
+        return self.snapshot.get(url, **kwargs)
+
+    def _user_entry(self, url, kwargs):
+        """
+        Raw entry of a single user from the pool, or None if the request must
+        be delegated to linuxmusterTools.
+        """
+
+        match = self.USER_PATH.match(url)
+        if match is None or not set(kwargs) <= {'attributes', 'school', 'dict'}:
+            return None
+
+        ldap_filter = f'(objectClass=user)(sophomorixRole=*)(cn={ldap.filter.escape_filter_chars(match.group(1))})'
+        school = kwargs.get('school', None)
+        if school and school != 'global':
+            ldap_filter += f'(sophomorixSchoolname={ldap.filter.escape_filter_chars(school)})'
+
+        attributes = kwargs.get('attributes', None) or None
+        if attributes is not None:
+            attributes = list(dict.fromkeys(['cn', *attributes]))
+
+        results, controls = ldap_pool.search(f'(&{ldap_filter})', attributes=attributes)
+        return results[0] if results else None
+
+    @staticmethod
+    def _known_fields(attributes):
+        fields = {field.name for field in dataclasses.fields(LMNUser)}
+        return all(attribute in fields for attribute in attributes)
+
+    def get(self, url, **kwargs):
+        return _memoized('get', self._get, url, **kwargs)
+
+    def getval(self, url, attribute, **kwargs):
+        return _memoized('getval', self._getval, url, attribute, **kwargs)
+
+    def getvalues(self, url, attributes, **kwargs):
+        return _memoized('getvalues', self._getvalues, url, attributes, **kwargs)
+
+    def _get(self, url, **kwargs):
+        result = self._from_snapshot(url, **kwargs)
+        if result is not MISSING:
+            return result
+
+        with observe_ldap('get', path_pattern(url)), span('ldap', f'get {url}'):
+            entry = self._user_entry(url, kwargs)
+            if entry is None:
+                return LMNLdapReader.get(url, **kwargs)
+
+            if not kwargs.get('dict', True):
+                return to_model(LMNUser, *entry)
+            return _user_dict(*entry, kwargs.get('attributes', None) or None)
+
+    def _getval(self, url, attribute, **kwargs):
+        if self._known_fields([attribute]) and self.USER_PATH.match(url):
+            user = self._from_snapshot(url, **kwargs)
+            if user is not MISSING:
+                return user[attribute]
+
+        with observe_ldap('getval', path_pattern(url)), span('ldap', f'getval {url}'):
+            if not self._known_fields([attribute]):
+                return LMNLdapReader.getval(url, attribute, **kwargs)
+
+            entry = self._user_entry(url, {**kwargs, 'attributes': [attribute]})
+            if entry is None:
+                return LMNLdapReader.getval(url, attribute, **kwargs)
+
+            return to_model(LMNUser, *entry).asdict()[attribute]
+
+    def _getvalues(self, url, attributes, **kwargs):
+        if self._known_fields(attributes) and self.USER_PATH.match(url):
+            user = self._from_snapshot(url, **kwargs)
+            if user is not MISSING:
+                return {attribute: user[attribute] for attribute in attributes}
+
+        with observe_ldap('getvalues', path_pattern(url)), span('ldap', f'getvalues {url}'):
+            if not self._known_fields(attributes):
+                return LMNLdapReader.getvalues(url, attributes, **kwargs)
+
+            entry = self._user_entry(url, {**kwargs, 'attributes': attributes})
+            if entry is None:
+                return LMNLdapReader.getvalues(url, attributes, **kwargs)
+
+            user = to_model(LMNUser, *entry).asdict()
+            return {attribute: user[attribute] for attribute in attributes}
+
+    def __getattr__(self, name):
+        return _observed(LMNLdapReader, name, memoize=True)
+
+
+class LdapWriter:
+    """
+    Wrapper around linuxmusterTools' LMNLdapWriter, used by the whole API for
+    the LDAP writes. The writes are delegated as is, this is the place to
+    observe them. They are not pooled: LMNLdapWriter manages its own
+    connections.
+
+    If the directory snapshot is enabled, the written object is read again
+    in it after each write.
+    """
+
+    # e.g. setattr_user or delattr_managementgroup
+    WRITE_METHOD = re.compile(r'^(?:set|del)attr_(\w+)$')
+
+    snapshot = None
+
+    def use_snapshot(self, snapshot):
+        self.snapshot = snapshot
+
+    def __getattr__(self, name):
+        method = _observed(LMNLdapWriter, name)
+        match = self.WRITE_METHOD.match(name)
+        if match is None or not callable(method):
+            return method
+
+        @functools.wraps(method)
+        def write(cn, *args, **kwargs):
+            result = method(cn, *args, **kwargs)
+            if self.snapshot is not None:
+                members = (kwargs.get('data', None) or {}).get('member', [])
+                self.snapshot.refresh(match.group(1), cn, [members] if isinstance(members, str) else members)
+            return result
+
+        return write
+
+lr = LdapReader()
+lw = LdapWriter()
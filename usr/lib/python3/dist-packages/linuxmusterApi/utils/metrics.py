@@ -0,0 +1,199 @@
+import glob
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from time import perf_counter
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+    multiprocess,
+)
+
+
+# Set by main.py when uvicorn runs many workers, each worker then writes its
+# values in this directory
+MULTIPROC_DIR_ENV = 'PROMETHEUS_MULTIPROC_DIR'
+
+# Files of the livesum gauges of a worker, e.g. gauge_livesum_1234.db
+LIVE_GAUGE_FILE = re.compile(r'gauge_live\w+_(\d+)\.db$')
+
+BACKEND_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+SOPHOMORIX_BUCKETS = (.1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+REQUESTS = Counter(
+    'lmnapi_requests_total',
+    'HTTP requests per route and status code',
+    ['method', 'route', 'status'],
+)
+REQUEST_DURATION = Histogram(
+    'lmnapi_request_duration_seconds',
+    'HTTP request duration per route',
+    ['method', 'route'],
+)
+LDAP_DURATION = Histogram(
+    'lmnapi_ldap_duration_seconds',
+    'LDAP call duration per operation and path pattern',
+    ['operation', 'path'],
+    buckets=BACKEND_BUCKETS,
+)
+LDAP_ERRORS = Counter(
+    'lmnapi_ldap_errors_total',
+    'LDAP calls raising an exception, per operation and path pattern',
+    ['operation', 'path'],
+)
+SOPHOMORIX_DURATION = Histogram(
+    'lmnapi_sophomorix_duration_seconds',
+    'Sophomorix command duration per binary',
+    ['command'],
+    buckets=SOPHOMORIX_BUCKETS,
+)
+SOPHOMORIX_EXITS = Counter(
+    'lmnapi_sophomorix_exits_total',
+    'Sophomorix commands per binary and exit code ("timeout" or "cancelled" if killed)',
+    ['command', 'returncode'],
+)
+EXECUTOR_TASKS = Gauge(
+    'lmnapi_executor_tasks',
+    'Calls submitted to an executor, per state (queued or running)',
+    ['executor', 'state'],
+    multiprocess_mode='livesum',
+)
+EXECUTOR_WORKERS = Gauge(
+    'lmnapi_executor_workers',
+    'Max number of threads of an executor',
+    ['executor'],
+    multiprocess_mode='livesum',
+)
+CACHE_REQUESTS = Counter(
+    'lmnapi_cache_requests_total',
+    'Cache lookups per cache and result (hit or miss)',
+    ['cache', 'result'],
+)
+
+
+def path_pattern(url):
+    """
+    Replace the object name in a LMNLdapReader url by {}, to get a bounded
+    number of label values, e.g. /schoolclasses/10a/students becomes
+    /schoolclasses/{}/students.
+    """
+
+    parts = url.strip('/').split('/')
+    if len(parts) > 1:
+        parts[1] = '{}'
+    return '/' + '/'.join(parts)
+
+@contextmanager
+def observe_ldap(operation, path):
+    """
+    Measure the duration of a LDAP call.
+
+    :param operation: Called method, e.g. get or setattr_user
+    :type operation: basestring
+    :param path: Path pattern, see path_pattern
+    :type path: basestring
+    """
+
+    start = perf_counter()
+    try:
+        yield
+    except Exception:
+        LDAP_ERRORS.labels(operation, path).inc()
+        raise
+    finally:
+        LDAP_DURATION.labels(operation, path).observe(perf_counter() - start)
+
+def observe_sophomorix(command, returncode, duration):
+    """
+    Record a sophomorix run.
+
+    :param command: Command with options which was run
+    :type command: list
+    :param returncode: Exit code, "timeout" or "cancelled"
+    :type returncode: int or basestring
+    :param duration: Runtime in seconds
+    :type duration: float
+    """
+
+    binary = os.path.basename(command[0]) if command else ''
+    SOPHOMORIX_DURATION.labels(binary).observe(duration)
+    SOPHOMORIX_EXITS.labels(binary, str(returncode)).inc()
+
+def observe_cache(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+def prepare_multiprocess_dir(path):
+    """
+    Empty the directory of the metrics of the workers and let the workers
+    use it. Must be called before the workers are started: the files of the
+    previous run would be aggregated with the new values.
+
+    :param path: Directory of the metrics files
+    :type path: basestring
+    """
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+    os.environ[MULTIPROC_DIR_ENV] = path
+
+def mark_worker_dead(pid=None):
+    """
+    Remove the livesum gauges of a worker which exits, otherwise its last
+    values stay in the sums on /metrics.
+
+    :param pid: Pid of the worker, default the current process
+    :type pid: int
+    """
+
+    path = os.environ.get(MULTIPROC_DIR_ENV)
+    if path:
+        multiprocess.mark_process_dead(os.getpid() if pid is None else pid, path)
+
+def remove_dead_workers():
+    """
+    Remove the livesum gauges of the workers which did not exit cleanly (e.g.
+    killed and restarted by uvicorn), and could not call mark_worker_dead.
+    """
+
+    path = os.environ.get(MULTIPROC_DIR_ENV)
+    if not path:
+        return
+
+    for file in glob.glob(os.path.join(path, 'gauge_live*_*.db')):
+        match = LIVE_GAUGE_FILE.search(os.path.basename(file))
+        if match is None:
+            continue
+
+        pid = int(match.group(1))
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            mark_worker_dead(pid)
+        except PermissionError:
+            # Alive, but owned by another user
+            pass
+
+def render():
+    """
+    Current values of all metrics, in the Prometheus text format, aggregated
+    over all workers if necessary.
+
+    :return: Body and content type
+    :rtype: tuple
+    """
+
+    if os.environ.get(MULTIPROC_DIR_ENV):
+        remove_dead_workers()
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import threading
+from time import time
+
+import linuxmusterTools.quotas
+
+from utils.config import api_config
+from utils.executors import run_ldap, run_sophomorix, run_store
+from utils.ldap import iter_users
+from utils.store import shared_store
+
+
+# Lease of the shared store held by the worker collecting the quotas of all users
+QUOTAS_LEASE = 'quotas'
+
+# sophomorixRole of the accounts having quotas (not the computers)
+USER_ROLES = ['globaladministrator', 'schooladministrator', 'teacher', 'student']
+
+
+class QuotaCollector:
+    """
+    Collect the quotas of the users and keep them in memory with the time of
+    the collection.
+
+    Reading the quotas of one user takes a while, so the results are served
+    from memory as long as they are younger than quotas.ttl seconds. Many
+    users are collected with at most quotas.workers calls at the same time, and
+    concurrent requests for the same user share the same collection.
+
+    If quotas.refresh_interval is set, the quotas of all users are collected
+    again in the background every refresh_interval seconds. With many workers,
+    only the worker holding the lease of the shared store collects them, and
+    stores them with the lease, from where the other workers load them.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._pending = {}
+        self.workers = None
+        self._semaphore = None
+        self._task = None
+        self.leader = False
+        # Time of the last collection of all users loaded from the shared store
+        self._shared = None
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        quotas_config = config.section('quotas')
+        self.ttl = quotas_config.get('ttl', 900)
+        self.refresh_interval = quotas_config.get('refresh_interval', 0)
+        # Another worker takes over if the lease is not renewed for a few collections
+        self.lease_ttl = max(300, 3 * self.refresh_interval)
+
+        workers = max(quotas_config.get('workers', 4), 1)
+        if workers != self.workers:
+            # Created again in the running event loop at next use, only if the
+            # limit changed (the waiting collections keep the old one)
+            self.workers = workers
+            self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.workers)
+        return self._semaphore
+
+    def cached(self, user):
+        """
+        Last collected quotas of a user, if not older than ttl.
+
+        :param user: samaccountname of the user
+        :type user: basestring
+        :return: Timestamp of the collection and quotas, or None
+        :rtype: tuple
+        """
+
+        with self._lock:
+            entry = self._data.get(user, None)
+
+        if entry is None or time() - entry[0] > self.ttl:
+            return None
+        return entry
+
+    def invalidate(self, user=None):
+        with self._lock:
+            if user is None:
+                self._data.clear()
+            else:
+                self._data.pop(user, None)
+
+    async def _collect(self, user):
+        async with self.semaphore:
+            quotas = await run_sophomorix(linuxmusterTools.quotas.get_user_quotas, user)
+
+        entry = (time(), quotas)
+        with self._lock:
+            self._data[user] = entry
+        return entry
+
+    async def get(self, user, fresh=False):
+        """
+        Quotas of a user, collected if not in memory or if fresh is set.
+
+        :param user: samaccountname of the user
+        :type user: basestring
+        :param fresh: Ignore the quotas in memory
+        :type fresh: bool
+        :return: Timestamp of the collection and quotas
+        :rtype: tuple
+        """
+
+        if not fresh:
+            entry = self.cached(user)
+            if entry is not None:
+                return entry
+
+        # Another request is already collecting the quotas of this user
+        pending = self._pending.get(user, None)
+        if pending is None:
+            pending = asyncio.ensure_future(self._collect(user))
+            self._pending[user] = pending
+            pending.add_done_callback(lambda _: self._pending.pop(user, None))
+
+        # A cancelled request does not cancel the collection for the others
+        return await asyncio.shield(pending)
+
+    async def get_many(self, users, fresh=False):
+        """
+        Quotas of many users, errors are reported per user.
+
+        :param users: samaccountnames of the users
+        :type users: list
+        :param fresh: Ignore the quotas in memory
+        :type fresh: bool
+        :return: Timestamp of the collection and quotas (or error) by user
+        :rtype: dict
+        """
+
+        async def one(user):
+            try:
+                updated, quotas = await self.get(user, fresh=fresh)
+                return user, {'updated': updated, 'quotas': quotas}
+            except Exception as e:
+                return user, {'updated': None, 'error': str(e)}
+
+        return dict(await asyncio.gather(*[one(user) for user in users]))
+
+    def _all_users(self):
+        return [user['cn'] for user in iter_users(['sophomorixRole']) if user.get('sophomorixRole', None) in USER_ROLES]
+
+    async def refresh(self):
+        """
+        Collect the quotas of all users if this worker holds the lease, else
+        load the last collection of the worker holding it.
+        """
+
+        held, value = await run_store(shared_store.acquire_lease, QUOTAS_LEASE, self.lease_ttl)
+        self.leader = held
+
+        if held:
+            start = time()
+            users = await run_ldap(self._all_users)
+            collected = await self.get_many(users, fresh=True)
+            logging.info(f"Quotas of {len(users)} users collected in {time() - start:.1f}s")
+
+            value = json.dumps({
+                'updated': start,
+                'quotas': {user: [entry['updated'], entry['quotas']] for user, entry in collected.items() if 'quotas' in entry},
+            })
+            await run_store(shared_store.set_lease_value, QUOTAS_LEASE, value)
+
+        elif value is not None:
+            shared = json.loads(value)
+            if shared['updated'] != self._shared:
+                with self._lock:
+                    for user, entry in shared['quotas'].items():
+                        # Keep the quotas collected since by this worker
+                        if user not in self._data or self._data[user][0] < entry[0]:
+                            self._data[user] = tuple(entry)
+                self._shared = shared['updated']
+
+    async def _refresh_loop(self):
+        while self.refresh_interval:
+            start = time()
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.warning(f"Quotas collection failed: {e}")
+
+            # The other workers load the next collection of the leader soon after it ends
+            delay = self.refresh_interval if self.leader else min(self.refresh_interval, 60)
+            await asyncio.sleep(max(delay - (time() - start), 0))
+        self._task = None
+
+    def start(self):
+        """
+        Start the background collection if quotas.refresh_interval is set.
+        Must be called from the running event loop.
+        """
+
+        if self.refresh_interval and self._task is None:
+            self._task = asyncio.ensure_future(self._refresh_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.leader:
+            shared_store.release_lease(QUOTAS_LEASE)
+            self.leader = False
+
+quota_collector = QuotaCollector()
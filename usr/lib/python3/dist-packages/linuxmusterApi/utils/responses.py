@@ -0,0 +1,185 @@
+import hashlib
+import itertools
+import json
+import threading
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+
+from utils.cache import TTLCache
+from utils.changes import change_bus
+from utils.config import api_config
+from utils.executors import run_ldap
+
+
+class ResponseCache:
+    """
+    Serialized responses of the list endpoints, with a strong ETag computed
+    from the payload.
+
+    Entries are grouped per endpoint (e.g. "projects"), so that the write
+    endpoints of a router can invalidate all the cached lists of this router.
+    """
+
+    def __init__(self):
+        self._caches = {}
+        self._lock = threading.Lock()
+        # Every worker reloads its configuration
+        api_config.on_reload(lambda config: self.invalidate(publish=False))
+
+    def _cache(self, endpoint):
+        with self._lock:
+            if endpoint not in self._caches:
+                cache_config = api_config.section('cache')
+                self._caches[endpoint] = TTLCache(
+                    maxsize=cache_config.get('responses_size', 256),
+                    ttl=cache_config.get('responses_ttl', 30),
+                    namespace=f'responses:{endpoint}',
+                )
+            return self._caches[endpoint]
+
+    async def get(self, endpoint, key, compute):
+        """
+        Return the cached (etag, body) of a response, computing it in the LDAP
+        executor if necessary.
+
+        :param endpoint: Group of the entry, e.g. projects
+        :type endpoint: basestring
+        :param key: Variant of the response, e.g. (school, role filter)
+        :type key: tuple
+        :param compute: Function returning the data to serialize
+        :type compute: callable
+        :return: ETag and JSON body
+        :rtype: tuple
+        """
+
+        cache = self._cache(endpoint)
+        entry = cache.get(key)
+        if entry is None:
+            entry = await run_ldap(self._serialize, compute)
+            cache.set(key, entry)
+        return entry
+
+    @staticmethod
+    def _serialize(compute):
+        body = json.dumps(jsonable_encoder(compute()), separators=(',', ':')).encode('utf8')
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        return etag, body
+
+    def invalidate(self, *endpoints, publish=True):
+        """
+        Drop the cached responses of some endpoints, or of all endpoints.
+        With publish, the other workers drop them too.
+        """
+
+        with self._lock:
+            if endpoints:
+                caches = {e: self._caches.get(e, None) for e in endpoints}
+            else:
+                caches = dict(self._caches)
+
+        for endpoint, cache in caches.items():
+            if cache is not None:
+                cache.clear(publish=publish)
+            elif publish:
+                # Not used yet in this worker, but maybe in the others
+                self._cache(endpoint).clear()
+
+response_cache = ResponseCache()
+
+# Cached lists to drop when an object of this kind changes
+CHANGE_ENDPOINTS = {
+    'user': ('users', 'teachers', 'roles'),
+    'schoolclass': ('schoolclasses',),
+    'project': ('projects',),
+    'printer': ('printers',),
+    'managementgroup': ('groups',),
+    'group': ('groups',),
+}
+
+def _invalidate_changed(events):
+    # Every worker gets the change events, nothing to publish
+    if any(event.kind == 'deleted' for event in events):
+        response_cache.invalidate(publish=False)
+        return
+
+    endpoints = {endpoint for event in events for endpoint in CHANGE_ENDPOINTS.get(event.kind, ())}
+    if endpoints:
+        response_cache.invalidate(*endpoints, publish=False)
+
+change_bus.subscribe(_invalidate_changed, kinds=CHANGE_ENDPOINTS.keys())
+
+
+def _etag_matches(request, etag):
+    if_none_match = request.headers.get('if-none-match', '')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return etag in [tag.strip() for tag in if_none_match.split(',')]
+
+async def cached_response(request: Request, endpoint, key, compute):
+    """
+    Serve a JSON response from the response cache, or answer
+    304 Not Modified if the client already has the current version.
+
+    :param request: The incoming request, to read If-None-Match
+    :type request: Request
+    :param endpoint: Group of the entry, e.g. projects
+    :type endpoint: basestring
+    :param key: Variant of the response, e.g. (school, role filter)
+    :type key: tuple
+    :param compute: Function returning the data to serialize
+    :type compute: callable
+    """
+
+    etag, body = await response_cache.get(endpoint, key, compute)
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+# Number of entries read from the iterable per call in the LDAP executor
+STREAM_BATCH_SIZE = 100
+
+async def _batches(items):
+    iterator = iter(items)
+    while True:
+        batch = await run_ldap(lambda: list(itertools.islice(iterator, STREAM_BATCH_SIZE)))
+        if not batch:
+            return
+        yield batch
+
+async def _json_array(items):
+    yield b'['
+    first = True
+    async for batch in _batches(items):
+        for item in batch:
+            yield (b'' if first else b',') + json.dumps(jsonable_encoder(item), separators=(',', ':')).encode('utf8')
+            first = False
+    yield b']'
+
+async def _ndjson(items):
+    async for batch in _batches(items):
+        yield b''.join(json.dumps(jsonable_encoder(item), separators=(',', ':')).encode('utf8') + b'\n' for item in batch)
+
+def streaming_json_response(request: Request, items):
+    """
+    Send the entries of an iterable as soon as they are produced, instead of
+    serializing a whole list. The response is a JSON array sent in chunks, or
+    one JSON object per line if the client accepts application/x-ndjson.
+    The iterable is consumed in the LDAP executor, so it can block on LDAP.
+
+    :param request: The incoming request, to read the Accept header
+    :type request: Request
+    :param items: Entries to send
+    :type items: iterable
+    """
+
+    if 'application/x-ndjson' in request.headers.get('accept', ''):
+        return StreamingResponse(_ndjson(items), media_type='application/x-ndjson')
+
+    return StreamingResponse(_json_array(items), media_type='application/json')
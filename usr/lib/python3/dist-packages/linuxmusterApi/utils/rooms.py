@@ -0,0 +1,242 @@
+import asyncio
+import csv
+import glob
+import json
+import logging
+import os
+import re
+from time import time
+
+from utils.config import api_config
+from utils.executors import run_store
+from utils.sophomorix import sophomorix_runner
+from utils.store import shared_store
+
+
+SOPHOMORIX_CONFIG_DIR = '/etc/linuxmuster/sophomorix'
+
+# Lease of the shared store held by the worker running smbstatus
+ROOMS_LEASE = 'rooms'
+
+# One session line of `smbstatus -b`:
+# PID  Username  Group  Machine  Protocol Version  Encryption  Signing
+# The group may contain spaces (e.g. LINUXMUSTER\domain users), so the client
+# address is taken from the socket address of the machine, e.g.
+# "10.0.0.1 (ipv4:10.0.0.1:49710)" or "(ipv6:fe80::1:49710)".
+SESSION_LINE = re.compile(r'^\s*\d+\s+(?P<user>\S+)\s.*\((?:ipv4|ipv6):(?P<ip>[0-9a-fA-F.:]+):\d+\)')
+
+
+def parse_sessions(output):
+    """
+    Users and client addresses of the sessions listed by `smbstatus -b`.
+
+    :param output: Output of smbstatus
+    :type output: basestring
+    :return: Lowercase samaccountname and IP of each session
+    :rtype: generator of tuples
+    """
+
+    for line in output.splitlines():
+        match = SESSION_LINE.match(line)
+        if match is None:
+            continue
+
+        # DOMAIN\user or user
+        user = match.group('user').split('\\')[-1].lower()
+        ip = match.group('ip')
+        # IPv4-mapped IPv6 address, devices.csv only knows the IPv4 address
+        if ip.lower().startswith('::ffff:') and '.' in ip:
+            ip = ip[7:]
+        yield user, ip
+
+
+class RoomIndex:
+    """
+    Which users are connected from which room, built from one smbstatus
+    snapshot every rooms.interval seconds instead of one sophomorix-query per
+    request.
+
+    The client addresses of the SMB sessions are resolved to rooms with the
+    devices.csv of all schools, which are read again when they change.
+
+    With many workers, only the worker holding the lease of the shared store
+    runs smbstatus. It stores the snapshot with the lease, from where the
+    other workers load it.
+    """
+
+    def __init__(self):
+        self.updated = None
+        # (school, room) -> {user: details}
+        self.rooms = {}
+        # user -> (school, room)
+        self.users = {}
+        self._devices = {}
+        self._devices_mtimes = None
+        self._task = None
+        self.leader = False
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        rooms_config = config.section('rooms')
+        self.enabled = rooms_config.get('enabled', True)
+        self.interval = rooms_config.get('interval', 10)
+        # Another worker takes over if the lease is not renewed for a few snapshots
+        self.lease_ttl = max(30, 3 * self.interval)
+
+    @property
+    def ready(self):
+        # An old snapshot means the collection stopped working
+        return self.updated is not None and time() - self.updated < 3 * self.interval
+
+    def _devices_files(self):
+        """
+        devices.csv of each school, default-school/devices.csv for the default
+        school and <school>/<school>.devices.csv for the others.
+        """
+
+        files = {}
+        for path in glob.glob(f'{SOPHOMORIX_CONFIG_DIR}/*/*devices.csv'):
+            school = os.path.basename(os.path.dirname(path))
+            if os.path.basename(path) in ['devices.csv', f'{school}.devices.csv']:
+                files[school] = path
+        return files
+
+    def _load_devices(self):
+        files = self._devices_files()
+        mtimes = {school: os.path.getmtime(path) for school, path in files.items()}
+        if mtimes == self._devices_mtimes:
+            return
+
+        devices = {}
+        for school, path in files.items():
+            with open(path, newline='') as f:
+                for row in csv.reader(f, delimiter=';'):
+                    # room;hostname;hostgroup;mac;ip;...
+                    if len(row) < 5 or row[0].startswith('#') or not row[4]:
+                        continue
+                    devices[row[4].strip()] = (school, row[0].strip(), row[1].strip().lower())
+
+        self._devices = devices
+        self._devices_mtimes = mtimes
+
+    async def collect(self):
+        """
+        Take one smbstatus snapshot and rebuild the indexes.
+        """
+
+        self._load_devices()
+
+        returncode, stdout, stderr = await sophomorix_runner.run(['smbstatus', '-b'], timeout=30)
+        if returncode != 0:
+            raise RuntimeError(f'smbstatus failed: {stderr.decode("utf8", errors="replace").strip()}')
+
+        sessions = []
+        for user, ip in parse_sessions(stdout.decode('utf8', errors='replace')):
+            device = self._devices.get(ip, None)
+            if device is not None:
+                sessions.append((user, *device, ip))
+
+        self._load(sessions, time())
+        return sessions
+
+    def _load(self, sessions, updated):
+        """
+        Rebuild the indexes from the user, school, room, hostname and IP of
+        each session.
+        """
+
+        rooms = {}
+        users = {}
+        for user, school, room, hostname, ip in sessions:
+            rooms.setdefault((school, room), {})[user] = {'ROOM': room, 'HOSTNAME': hostname, 'IP': ip}
+            users[user] = (school, room)
+
+        # Swapped at once, readers always see a complete snapshot
+        self.rooms, self.users, self.updated = rooms, users, updated
+
+    async def update(self):
+        """
+        Take a snapshot if this worker holds the lease, else load the last
+        snapshot of the worker holding it.
+        """
+
+        held, value = await run_store(shared_store.acquire_lease, ROOMS_LEASE, self.lease_ttl)
+        self.leader = held
+        if held:
+            sessions = await self.collect()
+            value = json.dumps({'updated': self.updated, 'sessions': sessions})
+            await run_store(shared_store.set_lease_value, ROOMS_LEASE, value)
+        elif value is not None:
+            snapshot = json.loads(value)
+            if snapshot['updated'] != self.updated:
+                self._load(snapshot['sessions'], snapshot['updated'])
+
+    def user_in_room(self, username, school=None):
+        """
+        Room of a user and the other users in the same room.
+
+        :param username: samaccountname of the user
+        :type username: basestring
+        :param school: Only look in the rooms of this school, all if None or global
+        :type school: basestring
+        :return: Room name and details of the other users, None if the snapshot is not usable
+        :rtype: tuple
+        """
+
+        if not self.ready:
+            return None
+
+        rooms, location = self.rooms, self.users.get(username.lower(), None)
+        if location is None or school and school != 'global' and location[0] != school:
+            return '', {}
+
+        others = {user: dict(details) for user, details in rooms.get(location, {}).items() if user != username.lower()}
+        return location[1], others
+
+    def list_rooms(self, school=None):
+        """
+        Users connected in each room.
+
+        :param school: Only the rooms of this school, all if None or global
+        :type school: basestring
+        :return: School, room and users of each occupied room, None if the snapshot is not usable
+        :rtype: list
+        """
+
+        if not self.ready:
+            return None
+
+        return [
+            {'school': room_school, 'room': room, 'users': sorted(users)}
+            for (room_school, room), users in sorted(self.rooms.items())
+            if not school or school == 'global' or room_school == school
+        ]
+
+    async def _collect_loop(self):
+        while self.enabled:
+            try:
+                await self.update()
+            except Exception as e:
+                logging.warning(f'Can not collect the users in rooms: {e}')
+            await asyncio.sleep(self.interval)
+        self._task = None
+
+    def start(self):
+        """
+        Start the background collection if rooms.enabled is set. Must be
+        called from the running event loop.
+        """
+
+        if self.enabled and self._task is None:
+            self._task = asyncio.ensure_future(self._collect_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self.leader:
+            shared_store.release_lease(ROOMS_LEASE)
+            self.leader = False
+
+room_index = RoomIndex()
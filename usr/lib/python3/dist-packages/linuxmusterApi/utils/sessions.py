@@ -0,0 +1,285 @@
+import base64
+import dataclasses
+import logging
+import threading
+import ldap
+import ldap.filter
+from fastapi import HTTPException
+
+from utils.cache import TTLCache
+from utils.changes import change_bus
+from utils.config import api_config
+from utils.ldap import ldap_pool, lw
+from utils.metrics import observe_ldap
+from utils.tracing import span
+
+
+SESSIONS_ATTRIBUTE = 'sophomorixSessions'
+
+
+@dataclasses.dataclass(frozen=True)
+class Session:
+    """
+    One value of sophomorixSessions, e.g. 2024-01-31_10-00-00;Math;doe,smith;
+    """
+
+    sid: str
+    name: str
+    members: tuple
+
+    @property
+    def membersCount(self):
+        return len(self.members)
+
+    @property
+    def value(self):
+        return f"{self.sid};{self.name};{','.join(self.members)};"
+
+    @classmethod
+    def parse(cls, value):
+        sid, name, members, *_ = value.split(';') + ['', '']
+        return cls(sid, name, tuple(member for member in members.split(',') if member))
+
+
+class SessionConflict(Exception):
+    """
+    The sessions of the user changed between the read and the write.
+    """
+
+
+class SessionStore:
+    """
+    Read and write the sessions of the users.
+
+    The parsed sessions are cached per user, and dropped when the change
+    poller sees a modification of the user (see utils.changes).
+
+    A change of a session is written as one LDAP modify, deleting the old
+    value and adding the new one: the modify fails as a whole if the old value
+    is gone, i.e. if the sessions were modified at the same time. The sessions
+    are then read again and the change applied again, at most
+    sessions.retries times.
+
+    The modify is done on the local sam.ldb, which needs root. If
+    sessions.samdb is false or the sam.ldb can not be opened, the changes are
+    written with linuxmusterTools like before, as a delete followed by an add:
+    a conflict is still detected on the delete, but a failed add loses the
+    changed session.
+    """
+
+    def __init__(self):
+        self.cache = TTLCache(namespace='sessions')
+        self._local = threading.local()
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+        change_bus.subscribe(self._invalidate_changed, kinds=['user', 'session'])
+
+    def configure(self, config):
+        sessions_config = config.section('sessions')
+        self.retries = sessions_config.get('retries', 3)
+        self.use_samdb = sessions_config.get('samdb', True)
+        self.cache.configure(
+            maxsize=sessions_config.get('cache_size', 1024),
+            ttl=sessions_config.get('cache_ttl', 60),
+        )
+
+    def _invalidate_changed(self, events):
+        # Every worker gets the change events, nothing to publish
+        if any(event.kind == 'deleted' for event in events):
+            self.cache.clear(publish=False)
+            return
+
+        for event in events:
+            self.cache.pop(event.cn.lower(), publish=False)
+
+    @property
+    def samdb(self):
+        """
+        Connection to the local sam.ldb, one per thread: the bind user of the
+        pool may only read.
+        """
+
+        samdb = getattr(self._local, 'samdb', None)
+        if samdb is None:
+            from samba.auth import system_session
+            from samba.param import LoadParm
+            from samba.samdb import SamDB
+
+            lp = LoadParm()
+            lp.load_default()
+            samdb = SamDB(url=lp.samdb_url(), session_info=system_session(), lp=lp)
+            self._local.samdb = samdb
+        return samdb
+
+    def _read(self, user):
+        ldap_filter = f'(&(objectClass=user)(sophomorixRole=*)(cn={ldap.filter.escape_filter_chars(user)}))'
+        results, controls = ldap_pool.search(ldap_filter, attributes=['cn', 'sophomorixSchoolname', SESSIONS_ATTRIBUTE])
+        if not results:
+            return None
+
+        dn, attrs = results[0]
+        school = attrs.get('sophomorixSchoolname', [b''])[0].decode('utf8')
+        sessions = tuple(Session.parse(value.decode('utf8')) for value in attrs.get(SESSIONS_ATTRIBUTE, []))
+        return dn, school, sessions
+
+    def get(self, user, school, fresh=False):
+        """
+        Sessions of a user.
+
+        :param user: samaccountname of the user
+        :type user: basestring
+        :param school: School of the requesting user
+        :type school: basestring
+        :param fresh: Ignore the cache
+        :type fresh: bool
+        :return: dn, school and sessions of the user
+        :rtype: tuple
+        """
+
+        key = user.lower()
+        entry = None if fresh else self.cache.get(key)
+        if entry is None:
+            entry = self._read(user)
+            if entry is not None:
+                self.cache.set(key, entry)
+
+        if entry is None or (school and school != 'global' and entry[1] != school):
+            raise HTTPException(status_code=404, detail=f"User {user} not found in ldap tree.")
+
+        return entry
+
+    def find(self, user, school, sid):
+        """
+        One session of a user, or 404.
+        """
+
+        dn, user_school, sessions = self.get(user, school)
+        for session in sessions:
+            if session.sid == sid:
+                return session
+        raise HTTPException(status_code=404, detail=f"Session {sid} not found by {user}")
+
+    def _write(self, user, dn, old, new):
+        if self.use_samdb:
+            try:
+                samdb = self.samdb
+            except Exception as e:
+                # Until the next reload of the configuration
+                logging.warning(f'Can not open the local sam.ldb, the sessions are written with linuxmusterTools: {e}')
+                self.use_samdb = False
+            else:
+                self._write_samdb(samdb, dn, old, new)
+                return
+
+        self._write_ldap(user, old, new)
+
+    def _write_samdb(self, samdb, dn, old, new):
+        ldif = f'dn:: {base64.b64encode(dn.encode()).decode()}\nchangetype: modify\n'
+        if old is not None:
+            ldif += f'delete: {SESSIONS_ATTRIBUTE}\n{SESSIONS_ATTRIBUTE}:: {base64.b64encode(old.value.encode()).decode()}\n-\n'
+        if new is not None:
+            ldif += f'add: {SESSIONS_ATTRIBUTE}\n{SESSIONS_ATTRIBUTE}:: {base64.b64encode(new.value.encode()).decode()}\n-\n'
+
+        import ldb
+
+        try:
+            samdb.modify_ldif(ldif)
+        except ldb.LdbError as e:
+            if e.args[0] == ldb.ERR_NO_SUCH_ATTRIBUTE:
+                # The old value is gone
+                raise SessionConflict()
+            if e.args[0] == ldb.ERR_ATTRIBUTE_OR_VALUE_EXISTS:
+                raise HTTPException(status_code=409, detail=f"Session {new.sid} already exists")
+            raise
+
+    def _write_ldap(self, user, old, new):
+        if old is not None:
+            try:
+                lw.delattr_user(user, data={SESSIONS_ATTRIBUTE: old.value})
+            except ldap.NO_SUCH_ATTRIBUTE:
+                raise SessionConflict()
+
+        if new is not None:
+            try:
+                lw.setattr_user(user, data={SESSIONS_ATTRIBUTE: new.value}, add=True)
+            except ldap.TYPE_OR_VALUE_EXISTS:
+                raise HTTPException(status_code=409, detail=f"Session {new.sid} already exists")
+
+    def modify(self, user, school, change):
+        """
+        Apply a change to the sessions of a user with one LDAP modify.
+
+        :param user: samaccountname of the user
+        :type user: basestring
+        :param school: School of the requesting user
+        :type school: basestring
+        :param change: Function getting the current sessions, and returning the
+        session to remove and the session to add (each may be None). It may raise
+        a HTTPException, e.g. if the session does not exist.
+        :type change: callable
+        :return: The added session
+        :rtype: Session
+        """
+
+        key = user.lower()
+
+        for attempt in range(self.retries + 1):
+            # After a conflict, the cached sessions are outdated
+            dn, user_school, sessions = self.get(user, school, fresh=attempt > 0)
+            old, new = change(sessions)
+            if old == new:
+                # e.g. the added members were already in the session
+                return new
+
+            try:
+                with observe_ldap('modify_sessions', '/users/{}'), span('ldap', f'modify sessions of {user}'):
+                    self._write(user, dn, old, new)
+            except SessionConflict:
+                self.cache.pop(key)
+                continue
+
+            sessions = tuple(session for session in sessions if session != old)
+            if new is not None:
+                sessions += (new,)
+            # The other workers drop their copy, this one keeps the new sessions
+            self.cache.pop(key)
+            self.cache.set(key, (dn, user_school, sessions))
+            return new
+
+        raise HTTPException(status_code=409, detail=f"The sessions of {user} were modified at the same time, please try again")
+
+    def add(self, user, school, session):
+        def change(sessions):
+            # The sid is the creation time, to the second
+            if any(existing.sid == session.sid for existing in sessions):
+                raise HTTPException(status_code=409, detail=f"Session {session.sid} already exists, please try again")
+            return None, session
+
+        return self.modify(user, school, change)
+
+    def remove(self, user, school, sid):
+        def change(sessions):
+            for session in sessions:
+                if session.sid == sid:
+                    return session, None
+            raise HTTPException(status_code=404, detail=f"Session {sid} not found by {user}")
+
+        self.modify(user, school, change)
+
+    def update_members(self, user, school, sid, add=(), remove=()):
+        """
+        Add and remove members of a session.
+        """
+
+        def change(sessions):
+            for session in sessions:
+                if session.sid == sid:
+                    # Keep the stored order, so that an unchanged session compares equal
+                    removed = set(remove)
+                    members = tuple(m for m in dict.fromkeys((*session.members, *add)) if m not in removed)
+                    return session, dataclasses.replace(session, members=members)
+            raise HTTPException(status_code=404, detail=f"Session {sid} not found by {user}")
+
+        return self.modify(user, school, change)
+
+session_store = SessionStore()
@@ -0,0 +1,441 @@
+import dataclasses
+import logging
+import re
+import threading
+import ldap
+import ldap.filter
+from time import monotonic
+
+import linuxmusterTools.ldapconnector.models as models
+from linuxmusterTools.ldapconnector.models import LMNUser
+
+from utils.changes import GROUP_KINDS, change_bus
+from utils.config import api_config
+from utils.ldap import (
+    MISSING,
+    _user_dict,
+    get_common_name,
+    iter_search,
+    ldap_pool,
+    lr,
+    lw,
+    search_users,
+    to_model,
+    users_filter,
+)
+from utils.metrics import observe_cache
+
+
+# Collection url and linuxmusterTools model of each kind of group
+GROUP_URLS = {
+    'schoolclass': ('schoolclasses', 'LMNSchoolclass'),
+    'project': ('projects', 'LMNProject'),
+    'printer': ('printers', 'LMNPrinter'),
+}
+
+# Attributes used for the indexes
+USER_INDEX_ATTRIBUTES = ['cn', 'sophomorixRole', 'sophomorixSchoolname', 'sophomorixAdminClass']
+GROUP_INDEX_ATTRIBUTES = ['cn', 'sophomorixSchoolname', 'sophomorixType', 'member']
+
+
+def _model_attributes(model, index_attributes):
+    """
+    Attributes to keep in memory for a model: the ones read by to_model, and
+    the indexed ones.
+    """
+
+    fields = [field.name for field in dataclasses.fields(model) if field.init] if model is not None else []
+    return list(dict.fromkeys(index_attributes + fields))
+
+USER_ATTRIBUTES = _model_attributes(LMNUser, USER_INDEX_ATTRIBUTES)
+GROUP_ATTRIBUTES = {
+    kind: _model_attributes(getattr(models, model, None), GROUP_INDEX_ATTRIBUTES)
+    for kind, (url, model) in GROUP_URLS.items()
+}
+
+def _compact(attrs, attributes):
+    # Only the served attributes, e.g. not the photos or the password hashes
+    wanted = {attribute.lower() for attribute in attributes}
+    return {key: values for key, values in attrs.items() if key.lower() in wanted}
+
+
+class UserRecord:
+    __slots__ = ('cn', 'dn', 'role', 'school', 'adminclass', 'attrs')
+
+    def __init__(self, dn, attrs):
+        self.dn = dn
+        self.attrs = _compact(attrs, USER_ATTRIBUTES)
+        self.cn = _value(attrs, 'cn').lower()
+        self.role = _value(attrs, 'sophomorixRole')
+        self.school = _value(attrs, 'sophomorixSchoolname')
+        self.adminclass = _value(attrs, 'sophomorixAdminClass')
+
+
+class GroupRecord:
+    __slots__ = ('cn', 'dn', 'kind', 'school', 'members', 'attrs')
+
+    def __init__(self, kind, dn, attrs):
+        self.kind = kind
+        self.dn = dn
+        self.attrs = _compact(attrs, GROUP_ATTRIBUTES[kind])
+        self.cn = _value(attrs, 'cn').lower()
+        self.school = _value(attrs, 'sophomorixSchoolname')
+        self.members = frozenset(get_common_name(member.decode('utf8')).lower() for member in attrs.get('member', []))
+
+
+def _value(attrs, key):
+    values = attrs.get(key, [])
+    return values[0].decode('utf8') if values else None
+
+def _in_school(record, school):
+    return not school or school == 'global' or record.school == school
+
+
+class Snapshot:
+    """
+    Users, schoolclasses, projects and printers of the configured schools,
+    kept in memory and indexed by cn, role, adminclass and membership, to
+    answer the most frequent reads of LMNLdapReader without LDAP request.
+
+    Only the attributes read by the models of linuxmusterTools are kept.
+
+    The snapshot is loaded at startup in a background thread, updated with
+    the events of the change bus (see utils.changes), and fully reloaded every
+    snapshot.reload_interval seconds. Until it is loaded, and for all urls or
+    options it does not know, the reads are delegated to LDAP.
+
+    The objects written by the API are read again at once (see refresh), so
+    that the next reads of the same worker see the write without waiting for
+    the change poller.
+    """
+
+    USER = re.compile(r'^/users/([^/]+)$')
+    ROLE = re.compile(r'^/roles/([^/]+)$')
+    GROUPS = re.compile(r'^/(schoolclasses|projects|printers)$')
+    GROUP = re.compile(r'^/(schoolclasses|projects|printers)/([^/]+)$')
+    STUDENTS = re.compile(r'^/schoolclasses/([^/]+)/students$')
+
+    def __init__(self):
+        self.ready = False
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._clear()
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+        change_bus.subscribe(self._apply_changes)
+
+    def configure(self, config):
+        snapshot_config = config.section('snapshot')
+        self.enabled = snapshot_config.get('enabled', False)
+        self.schools = snapshot_config.get('schools', [])
+        self.reload_interval = snapshot_config.get('reload_interval', 3600)
+
+    def _clear(self):
+        self.users = {}
+        self.by_role = {}
+        self.by_adminclass = {}
+        self.groups = {kind: {} for kind in GROUP_URLS}
+        self.member_of = {}
+
+    @staticmethod
+    def _group_attributes():
+        return list(dict.fromkeys(attribute for attributes in GROUP_ATTRIBUTES.values() for attribute in attributes))
+
+    def _school_filter(self):
+        if not self.schools:
+            return ''
+        schools = ''.join(f'(sophomorixSchoolname={school})' for school in self.schools)
+        return f'(|{schools})'
+
+    ## Indexes
+
+    def _add_user(self, record):
+        self._remove_user(record.cn)
+        self.users[record.cn] = record
+        self.by_role.setdefault(record.role, set()).add(record.cn)
+        if record.adminclass:
+            self.by_adminclass.setdefault(record.adminclass.lower(), set()).add(record.cn)
+
+    def _remove_user(self, cn):
+        record = self.users.pop(cn, None)
+        if record is None:
+            return
+        self.by_role.get(record.role, set()).discard(cn)
+        if record.adminclass:
+            self.by_adminclass.get(record.adminclass.lower(), set()).discard(cn)
+
+    def _add_group(self, record):
+        self._remove_group(record.kind, record.cn)
+        self.groups[record.kind][record.cn] = record
+        for member in record.members:
+            self.member_of.setdefault(member, set()).add((record.kind, record.cn))
+
+    def _remove_group(self, kind, cn):
+        record = self.groups[kind].pop(cn, None)
+        if record is None:
+            return frozenset()
+        for member in record.members:
+            self.member_of.get(member, set()).discard((kind, cn))
+        return record.members
+
+    ## Loading
+
+    def load(self):
+        """
+        Load all users and groups from LDAP, and swap them with the current
+        indexes once complete.
+        """
+
+        start = monotonic()
+        school_filter = self._school_filter()
+        users = [
+            UserRecord(dn, attrs)
+            for dn, attrs in iter_search(f'(&{users_filter()}{school_filter})', attributes=USER_ATTRIBUTES)
+        ]
+
+        group_types = ''.join(f'(sophomorixType={group_type})' for group_type in GROUP_KINDS)
+        groups = [
+            GroupRecord(GROUP_KINDS[_value(attrs, 'sophomorixType')], dn, attrs)
+            for dn, attrs in iter_search(f'(&(objectClass=group)(|{group_types}){school_filter})', attributes=self._group_attributes())
+        ]
+
+        with self._lock:
+            self._clear()
+            for record in users:
+                self._add_user(record)
+            for record in groups:
+                self._add_group(record)
+            self.ready = True
+
+        logging.info(f'Directory snapshot of {len(users)} users and {len(groups)} groups loaded in {monotonic() - start:.1f}s')
+
+    def _loop(self):
+        while True:
+            try:
+                self.load()
+            except Exception as e:
+                logging.warning(f'Can not load the directory snapshot: {e}')
+
+            if self._stop.wait(self.reload_interval):
+                break
+
+    def start(self):
+        if self.enabled and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='ldap-snapshot', daemon=True)
+            self._thread.start()
+            lr.use_snapshot(self)
+            lw.use_snapshot(self)
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+        self.ready = False
+        lr.use_snapshot(None)
+        lw.use_snapshot(None)
+
+    ## Incremental updates
+
+    def _fetch(self, dn, attributes):
+        try:
+            results, controls = ldap_pool.search('(objectClass=*)', attributes=attributes, base=dn)
+        except ldap.NO_SUCH_OBJECT:
+            # Moved or deleted since the change was seen
+            return None
+        return results[0][1] if results else None
+
+    def _apply_changes(self, events):
+        if not self.ready:
+            return
+
+        for event in events:
+            if event.kind == 'deleted':
+                # The tombstone does not tell what kind of object it was
+                members = frozenset()
+                with self._lock:
+                    self._remove_user(event.cn.lower())
+                    for kind in GROUP_URLS:
+                        members |= self._remove_group(kind, event.cn.lower())
+                self._refresh_members(members)
+                continue
+
+            if self.schools and event.school not in self.schools:
+                continue
+
+            if event.kind == 'user':
+                attrs = self._fetch(event.dn, USER_ATTRIBUTES)
+                with self._lock:
+                    if attrs is None:
+                        self._remove_user(event.cn.lower())
+                    else:
+                        self._add_user(UserRecord(event.dn, attrs))
+
+            elif event.kind in GROUP_URLS:
+                attrs = self._fetch(event.dn, GROUP_ATTRIBUTES[event.kind])
+                # The memberOf of the added and removed members changed too
+                self._refresh_members(self._update_group(event.kind, event.cn, event.dn, attrs))
+
+    def _update_group(self, kind, cn, dn, attrs):
+        """
+        Replace a group with its current attributes (None if deleted).
+
+        :return: cns of the added and removed members
+        :rtype: frozenset
+        """
+
+        record = GroupRecord(kind, dn, attrs) if attrs is not None else None
+        with self._lock:
+            previous = self._remove_group(kind, cn.lower())
+            current = frozenset()
+            if record is not None and (not self.schools or record.school in self.schools):
+                self._add_group(record)
+                current = record.members
+        return previous ^ current
+
+    def refresh(self, kind, cn, members=()):
+        """
+        Read again an object written by the API, and the users added to or
+        removed from it, in the calling thread. The other workers get the
+        write from the change poller.
+
+        :param kind: user, schoolclass, project, printer or another kind of
+        group (then only the members are read again)
+        :type kind: basestring
+        :param cn: cn of the object
+        :type cn: basestring
+        :param members: dn of the users added to or removed from the object
+        :type members: list
+        """
+
+        if not self.ready:
+            return
+
+        try:
+            cns = {get_common_name(dn).lower() for dn in members}
+            if kind == 'user':
+                cns.add(cn.lower())
+            elif kind in GROUP_URLS:
+                ldap_filter = f'(&(objectClass=group)(cn={ldap.filter.escape_filter_chars(cn)}))'
+                results, controls = ldap_pool.search(ldap_filter, attributes=GROUP_ATTRIBUTES[kind])
+                dn, attrs = next(((dn, attrs) for dn, attrs in results if dn is not None), (None, None))
+                cns |= self._update_group(kind, cn, dn, attrs)
+            self._refresh_members(cns)
+        except Exception as e:
+            # The write itself succeeded, the change poller will catch up
+            logging.warning(f'Can not refresh {kind} {cn} in the directory snapshot: {e}')
+
+    def _refresh_members(self, cns):
+        if not cns:
+            return
+
+        entries = search_users(cns, attributes=USER_ATTRIBUTES)
+        with self._lock:
+            for cn in cns:
+                entry = entries.get(cn, None)
+                record = UserRecord(*entry) if entry is not None else None
+                if record is None or self.schools and record.school not in self.schools:
+                    self._remove_user(cn)
+                else:
+                    self._add_user(record)
+
+    ## Reads
+
+    @staticmethod
+    def _group_dict(model, record, attributes):
+        group = to_model(model, record.dn, record.attrs).asdict()
+        if attributes is not None:
+            wanted = {attribute.lower() for attribute in attributes}
+            group = {key: value for key, value in group.items() if key.lower() in wanted}
+        return group
+
+    def _user(self, record, attributes, as_dict):
+        if as_dict:
+            return _user_dict(record.dn, record.attrs, attributes)
+        return to_model(LMNUser, record.dn, record.attrs)
+
+    def _in_scope(self, school):
+        # Objects of the other schools are not in memory
+        return not self.schools or (school and school != 'global' and school in self.schools)
+
+    def get(self, url, **kwargs):
+        """
+        Answer a LMNLdapReader.get request from memory.
+
+        :return: Same result as LMNLdapReader, or MISSING
+        :rtype: dict, list, model or MISSING
+        """
+
+        if not self.ready or not set(kwargs) <= {'attributes', 'school', 'dict'}:
+            return MISSING
+
+        school = kwargs.get('school', None)
+        if not self._in_scope(school):
+            return MISSING
+
+        attributes = kwargs.get('attributes', None) or None
+        as_dict = kwargs.get('dict', True)
+
+        result = self._get(url, school, attributes, as_dict)
+        observe_cache('snapshot', result is not MISSING)
+        return result
+
+    def _get(self, url, school, attributes, as_dict):
+        # Only the lookups hold the lock, the records are never modified
+        if (match := self.USER.match(url)) is not None:
+            with self._lock:
+                record = self.users.get(match.group(1).lower(), None)
+            if record is None or not _in_school(record, school):
+                # Unknown here, e.g. not yet seen by the change poller
+                return MISSING
+            return self._user(record, attributes, as_dict)
+
+        if (match := self.ROLE.match(url)) is not None:
+            with self._lock:
+                records = [self.users[cn] for cn in sorted(self.by_role.get(match.group(1), ()))]
+            return [self._user(r, attributes, as_dict) for r in records if _in_school(r, school)]
+
+        if (match := self.STUDENTS.match(url)) is not None:
+            with self._lock:
+                records = [self.users[cn] for cn in sorted(self.by_adminclass.get(match.group(1).lower(), ()))]
+            return [self._user(r, attributes, as_dict) for r in records if r.role == 'student' and _in_school(r, school)]
+
+        if (match := self.GROUPS.match(url)) is not None:
+            kind, cn = self._kind(match.group(1)), None
+        elif (match := self.GROUP.match(url)) is not None:
+            kind, cn = self._kind(match.group(1)), match.group(2).lower()
+        else:
+            return MISSING
+
+        model = getattr(models, GROUP_URLS[kind][1], None)
+        if model is None or not as_dict and cn is None:
+            return MISSING
+
+        if cn is not None:
+            with self._lock:
+                record = self.groups[kind].get(cn, None)
+            if record is None or not _in_school(record, school):
+                return MISSING
+            if as_dict:
+                return self._group_dict(model, record, attributes)
+            return to_model(model, record.dn, record.attrs)
+
+        with self._lock:
+            records = sorted(self.groups[kind].values(), key=lambda r: r.cn)
+        return [self._group_dict(model, r, attributes) for r in records if _in_school(r, school)]
+
+    @staticmethod
+    def _kind(collection):
+        for kind, (url, model) in GROUP_URLS.items():
+            if url == collection:
+                return kind
+
+    def memberships(self, cn):
+        """
+        Groups (kind, cn) of which a user is a direct member.
+        """
+
+        with self._lock:
+            return set(self.member_of.get(cn.lower(), ()))
+
+directory_snapshot = Snapshot()
@@ -1,72 +1,213 @@
+import asyncio
+import copy
+import json
+import os
 import subprocess
 import dpath.util
-import re
-import threading
-import ast
 import logging
 from time import time
+from fastapi import HTTPException
 
-class SophomorixProcess(threading.Thread):
+from utils.cache import TTLCache
+from utils.config import api_config
+from utils.executors import run_sophomorix
+from utils.metrics import observe_sophomorix
+from utils.tracing import span
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+JSON_BEGIN = b'# JSON-begin'
+JSON_END = b'# JSON-end'
+
+# Commands without side effects, whose concurrent identical calls can share
+# the same subprocess and result
+READ_ONLY_COMMANDS = {'sophomorix-query'}
+
+
+class SophomorixRunner:
     """
-    Worker for processing sophomorix commands.
+    Run sophomorix commands as asyncio subprocesses, without blocking a worker
+    thread during the whole Perl runtime.
+
+    The number of commands running at the same time is limited by a semaphore,
+    and each command is killed if it exceeds its timeout or if the awaiting
+    task is cancelled.
+
+    Identical read-only commands running at the same time are only run once
+    (single-flight), and their result can be kept sophomorix.query_ttl seconds
+    to absorb polling storms.
     """
 
-    def __init__(self, command, sensitive):
-        self.stdout = None
-        self.stderr = None
-        self.command = command
-        self.sensitive = sensitive
-        threading.Thread.__init__(self)
+    def __init__(self):
+        self.max_concurrency = None
+        self._semaphore = None
+        self._pending = {}
+        self.results = TTLCache(namespace='sophomorix-query')
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        sophomorix_config = config.section('sophomorix')
+        self.timeout = sophomorix_config.get('timeout', 300)
+        self.results.configure(maxsize=256, ttl=sophomorix_config.get('query_ttl', 0))
+
+        max_concurrency = sophomorix_config.get('max_concurrency', 4)
+        if max_concurrency != self.max_concurrency:
+            # Created again in the running event loop at next use. Only when
+            # the limit changed: the commands waiting on the old semaphore are
+            # not limited by the new one.
+            self.max_concurrency = max_concurrency
+            self._semaphore = None
+
+    @property
+    def semaphore(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def run(self, command, timeout=None):
+        """
+        Run a command and wait for its output.
+
+        :param command: Command with options to run
+        :type command: list
+        :param timeout: Max runtime in seconds, default from config.yml
+        :type timeout: int
+        :return: Return code, stdout and stderr
+        :rtype: tuple
+        """
+
+        if timeout is None:
+            timeout = self.timeout
+
+        async with self.semaphore:
+            start = time()
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                with span('sophomorix', ' '.join(command[:2])):
+                    stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                observe_sophomorix(command, 'timeout', time() - start)
+                raise
+            except asyncio.CancelledError:
+                process.kill()
+                await process.wait()
+                observe_sophomorix(command, 'cancelled', time() - start)
+                raise
+
+        observe_sophomorix(command, process.returncode, time() - start)
+        return process.returncode, stdout, stderr
+
+    async def shared(self, key, compute):
+        """
+        Result of compute(), shared with the identical calls running at the
+        same time or done less than query_ttl seconds ago.
+
+        :param key: Identifies identical calls, e.g. command and parse options
+        :type key: tuple
+        :param compute: Coroutine function running the command
+        :type compute: callable
+        :return: The shared result, which must not be modified
+        """
+
+        result = self.results.get(key, self)
+        if result is not self:
+            return result
+
+        pending = self._pending.get(key, None)
+        if pending is None:
+            pending = asyncio.ensure_future(compute())
+            self._pending[key] = pending
+            pending.add_done_callback(lambda future: self._shared_done(key, future))
 
-    def run(self):
-        p = subprocess.Popen(self.command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
-        self.stdout, self.stderr = p.communicate()
+        # A cancelled caller does not kill the command for the others
+        return await asyncio.shield(pending)
 
+    def _shared_done(self, key, future):
+        self._pending.pop(key, None)
+        if not future.cancelled() and future.exception() is None:
+            self.results.set(key, future.result())
 
-def lmn_getSophomorixValue(sophomorixCommand, jsonpath, ignoreErrors=False, sensitive=False):
+sophomorix_runner = SophomorixRunner()
+
+
+def _nulls_to_string(data):
+    """
+    Replace recursively the null values of dicts with the string "null", like
+    the old parser did.
     """
-    Connector to all sophomorix commands. Run a sophomorix command with -j
-    option (output as json) through a SophomorixProcess and parse the results.
 
-    :param sophomorixCommand: Command with options to run
-    :type sophomorixCommand: list
-    :param jsonpath: Key to search in the resulted dict, e.g. /USERS/doe
-    :type jsonpath: string
-    :param ignoreErrors: Quiet mode
-    :type ignoreErrors: bool
-    :return: Whole output or key if jsonpath is defined
-    :rtype: dict or value (list, dict, integer, string)
+    if isinstance(data, dict):
+        for key, value in data.items():
+            if value is None:
+                data[key] = "null"
+            elif isinstance(value, (dict, list)):
+                _nulls_to_string(value)
+    elif isinstance(data, list):
+        for value in data:
+            if isinstance(value, (dict, list)):
+                _nulls_to_string(value)
+    return data
+
+def parse_sophomorix_json(output, null_as_string=True):
     """
+    Decode the first block between "# JSON-begin" and "# JSON-end" of the
+    output of a sophomorix command. orjson is used if installed.
 
-    # New Thread for one process to avoid conflicts
-    s = time()
-    t = SophomorixProcess(sophomorixCommand, sensitive=sensitive)
-    t.daemon = True
-    t.start()
-    t.join()
-    logging.debug(f"Sophomorix command time : {time()-s}")
+    :param output: Raw stderr of the sophomorix command
+    :type output: bytes
+    :param null_as_string: Convert null values to the string "null", like the old parser
+    :type null_as_string: bool
+    :return: Decoded data, empty dict if the block is empty
+    :rtype: dict
+    """
 
-    # Cleanup stderr output
-    # output = t.stderr.replace(':null,', ":\"null\",")
-    # TODO: Maybe sophomorix should provide the null value  in  a python usable format
-    s = time()
-    output = t.stderr.decode("utf8").replace(':null', ":\"null\"")
-    output = output.replace(':null}', ":\"null\"}")
-    output = output.replace(':null]', ":\"null\"]")
+    begin = output.find(JSON_BEGIN)
+    if begin == -1:
+        raise IndexError('No JSON block found in sophomorix output')
+
+    begin += len(JSON_BEGIN)
+    end = output.find(JSON_END, begin)
+    block = output[begin:end] if end != -1 else output[begin:]
 
+    if not block.strip():
+        return {}
+
+    data = None
+    if orjson is not None:
+        try:
+            data = orjson.loads(block)
+        except orjson.JSONDecodeError:
+            # e.g. control chars in strings, which are allowed below
+            pass
 
-    # Some commands get many dicts, we just want the first
-    output = output.replace('\n', '').split('# JSON-end')[0]
-    output = output.split('# JSON-begin')[1]
-    output = re.sub('# JSON-begin', '', output)
-    logging.debug(f"Sophomorix filter result time : {time()-s}")
+    if data is None:
+        data = json.loads(block.decode('utf8'), strict=False)
 
-    # Convert str to dict
-    jsonDict = {}
-    if output:
-        s = time()
-        jsonDict = ast.literal_eval(output)
-        logging.debug(f"Sophomorix convert to dict time : {time()-s}")
+    if null_as_string:
+        _nulls_to_string(data)
+
+    return data
+
+def _parse_sophomorix_output(stderr, jsonpath, ignoreErrors=False, null_as_string=True):
+    """
+    Extract the json part of the output of a sophomorix command.
+    See lmn_getSophomorixValue for the parameters.
+    """
+
+    s = time()
+    jsonDict = parse_sophomorix_json(stderr, null_as_string=null_as_string)
+    logging.debug(f"Sophomorix convert to dict time : {time()-s}")
 
     # Without key, simply return the dict
     if jsonpath == '':
@@ -89,3 +230,72 @@ def lmn_getSophomorixValue(sophomorixCommand, jsonpath, ignoreErrors=False, sens
         resultString = dpath.util.get(jsonDict, jsonpath)
     return resultString
 
+def lmn_getSophomorixValue(sophomorixCommand, jsonpath, ignoreErrors=False, sensitive=False, null_as_string=True):
+    """
+    Connector to all sophomorix commands. Run a sophomorix command with -j
+    option (output as json) and parse the results.
+    This call blocks the current thread, use lmn_getSophomorixValueAsync in
+    async endpoints.
+
+    :param sophomorixCommand: Command with options to run
+    :type sophomorixCommand: list
+    :param jsonpath: Key to search in the resulted dict, e.g. /USERS/doe
+    :type jsonpath: string
+    :param ignoreErrors: Quiet mode
+    :type ignoreErrors: bool
+    :param null_as_string: Convert null values to the string "null"
+    :type null_as_string: bool
+    :return: Whole output or key if jsonpath is defined
+    :rtype: dict or value (list, dict, integer, string)
+    """
+
+    s = time()
+    with span('sophomorix', ' '.join(sophomorixCommand[:2])):
+        p = subprocess.run(sophomorixCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False)
+    observe_sophomorix(sophomorixCommand, p.returncode, time() - s)
+    logging.debug(f"Sophomorix command time : {time()-s}")
+
+    return _parse_sophomorix_output(p.stderr, jsonpath, ignoreErrors=ignoreErrors, null_as_string=null_as_string)
+
+async def lmn_getSophomorixValueAsync(sophomorixCommand, jsonpath, ignoreErrors=False, sensitive=False, null_as_string=True, timeout=None):
+    """
+    Awaitable version of lmn_getSophomorixValue, running the command through
+    the shared SophomorixRunner. Concurrent identical read-only commands
+    (e.g. sophomorix-query) share one subprocess.
+
+    :param sophomorixCommand: Command with options to run
+    :type sophomorixCommand: list
+    :param jsonpath: Key to search in the resulted dict, e.g. /USERS/doe
+    :type jsonpath: string
+    :param ignoreErrors: Quiet mode
+    :type ignoreErrors: bool
+    :param null_as_string: Convert null values to the string "null"
+    :type null_as_string: bool
+    :param timeout: Max runtime in seconds, default from config.yml
+    :type timeout: int
+    :return: Whole output or key if jsonpath is defined
+    :rtype: dict or value (list, dict, integer, string)
+    """
+
+    if os.path.basename(sophomorixCommand[0]) in READ_ONLY_COMMANDS:
+        key = (tuple(sophomorixCommand), jsonpath, ignoreErrors, null_as_string)
+        result = await sophomorix_runner.shared(
+            key,
+            lambda: _getSophomorixValueAsync(sophomorixCommand, jsonpath, ignoreErrors, null_as_string, timeout),
+        )
+        # Each caller gets its own copy, the endpoints modify them
+        return copy.deepcopy(result)
+
+    return await _getSophomorixValueAsync(sophomorixCommand, jsonpath, ignoreErrors, null_as_string, timeout)
+
+async def _getSophomorixValueAsync(sophomorixCommand, jsonpath, ignoreErrors, null_as_string, timeout):
+    s = time()
+    try:
+        returncode, stdout, stderr = await sophomorix_runner.run(sophomorixCommand, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"Sophomorix command {sophomorixCommand[0]} timed out")
+    logging.debug(f"Sophomorix command time : {time()-s}")
+
+    # Large outputs take a while to parse, keep it out of the event loop
+    with span('sophomorix', 'parse output'):
+        return await run_sophomorix(_parse_sophomorix_output, stderr, jsonpath, ignoreErrors=ignoreErrors, null_as_string=null_as_string)
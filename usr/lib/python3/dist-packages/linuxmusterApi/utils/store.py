@@ -0,0 +1,256 @@
+import logging
+import os
+import sqlite3
+import threading
+from time import time
+
+from utils.config import api_config
+
+
+STORE_PATH = '/run/linuxmuster-api/state.db'
+
+
+class SharedStore:
+    """
+    Small SQLite database shared by all the worker processes of the API.
+
+    It holds a log of the invalidations of the caches: a worker dropping an
+    entry (or all entries) of one of its caches appends it to the log, and the
+    other workers drop their own copy when they read the log. Entries of the
+    log are kept RETENTION seconds.
+
+    It also holds leases, to run a background task (e.g. the change poller)
+    in one worker only, and a log of the changes of the directory found by
+    this task, read by the other workers.
+
+    The store is only used when uvicorn runs more than one worker, otherwise
+    all methods are cheap no-ops.
+    """
+
+    RETENTION = 300
+
+    def __init__(self):
+        self._local = threading.local()
+        self.configure(api_config)
+        api_config.on_reload(self.configure)
+
+    def configure(self, config):
+        self.enabled = config.section('uvicorn').get('workers', 1) > 1
+        self.path = config.section('store').get('path', STORE_PATH)
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS invalidations ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT NOT NULL, key TEXT, '
+                'origin INTEGER NOT NULL, created REAL NOT NULL)'
+            )
+            conn.execute('CREATE INDEX IF NOT EXISTS invalidations_namespace ON invalidations (namespace, id)')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS leases ('
+                'name TEXT PRIMARY KEY, owner INTEGER NOT NULL, expires REAL NOT NULL, value TEXT)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS changes ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, cn TEXT NOT NULL, dn TEXT NOT NULL, '
+                'school TEXT, role TEXT, origin INTEGER NOT NULL, created REAL NOT NULL)'
+            )
+            self._local.conn = conn
+        return conn
+
+    def invalidate(self, namespace, key=None):
+        """
+        Tell the other workers to drop an entry of their caches of a
+        namespace.
+
+        :param namespace: Namespace of the caches
+        :type namespace: basestring
+        :param key: repr of the key of the entry, None to drop all entries
+        :type key: basestring
+        """
+
+        if not self.enabled:
+            return
+
+        now = time()
+        try:
+            self.conn.execute(
+                'INSERT INTO invalidations (namespace, key, origin, created) VALUES (?, ?, ?, ?)',
+                (namespace, key, os.getpid(), now)
+            )
+            self.conn.execute('DELETE FROM invalidations WHERE created < ?', (now - self.RETENTION,))
+        except sqlite3.Error as e:
+            logging.warning(f'Can not write shared store {self.path}: {e}')
+
+    def invalidations(self, namespace, since=None):
+        """
+        Invalidations of a namespace made by the other workers.
+
+        :param namespace: Namespace of the caches
+        :type namespace: basestring
+        :param since: Id returned by the previous call, None for the first call
+        :type since: int
+        :return: Id to pass to the next call, repr of the keys to drop, and
+        whether all entries must be dropped (e.g. some invalidations were
+        already removed from the log)
+        :rtype: tuple
+        """
+
+        if not self.enabled:
+            return since, [], False
+
+        try:
+            # Last id ever given, even if removed from the log since
+            row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'invalidations'").fetchone()
+            last = row[0] if row else 0
+            if since is None:
+                return last, [], False
+
+            first = self.conn.execute('SELECT MIN(id) FROM invalidations').fetchone()[0]
+            rows = self.conn.execute(
+                'SELECT key FROM invalidations WHERE namespace = ? AND id > ? AND id <= ? AND origin != ?',
+                (namespace, since, last, os.getpid())
+            ).fetchall()
+        except sqlite3.Error as e:
+            logging.warning(f'Can not read shared store {self.path}: {e}')
+            return since, [], False
+
+        # Some invalidations after since were already removed from the log
+        expired = (first if first is not None else last + 1) > since + 1
+        keys = [key for key, in rows]
+        return max(last, since), [key for key in keys if key is not None], expired or None in keys
+
+    def acquire_lease(self, name, ttl):
+        """
+        Take or renew a lease, if it's free, expired or already held by this
+        worker. Without shared store, the lease is always held.
+
+        :param name: Name of the lease, e.g. the name of the task
+        :type name: basestring
+        :param ttl: Seconds after which the lease expires if not renewed
+        :type ttl: int
+        :return: Whether this worker holds the lease, and the value stored
+        with it by the previous holder
+        :rtype: tuple
+        """
+
+        if not self.enabled:
+            return True, None
+
+        now = time()
+        try:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT owner, expires, value FROM leases WHERE name = ?', (name,)).fetchone()
+                if row is not None and row[0] != os.getpid() and row[1] > now:
+                    self.conn.execute('COMMIT')
+                    return False, row[2]
+
+                value = row[2] if row is not None else None
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO leases (name, owner, expires, value) VALUES (?, ?, ?, ?)',
+                    (name, os.getpid(), now + ttl, value)
+                )
+                self.conn.execute('COMMIT')
+                return True, value
+            except sqlite3.Error:
+                self.conn.execute('ROLLBACK')
+                raise
+        except sqlite3.Error as e:
+            logging.warning(f'Can not write shared store {self.path}: {e}')
+            return False, None
+
+    def set_lease_value(self, name, value):
+        """
+        Store a value with a lease held by this worker, for the next holder.
+
+        :param name: Name of the lease
+        :type name: basestring
+        :param value: Value, e.g. the progress of the task
+        :type value: basestring
+        """
+
+        if not self.enabled:
+            return
+
+        try:
+            self.conn.execute('UPDATE leases SET value = ? WHERE name = ? AND owner = ?', (value, name, os.getpid()))
+        except sqlite3.Error as e:
+            logging.warning(f'Can not write shared store {self.path}: {e}')
+
+    def release_lease(self, name):
+        """
+        Let another worker take a lease held by this worker at once, e.g. on
+        shutdown. The stored value is kept.
+
+        :param name: Name of the lease
+        :type name: basestring
+        """
+
+        if not self.enabled:
+            return
+
+        try:
+            self.conn.execute('UPDATE leases SET expires = 0 WHERE name = ? AND owner = ?', (name, os.getpid()))
+        except sqlite3.Error as e:
+            logging.warning(f'Can not write shared store {self.path}: {e}')
+
+    def add_changes(self, changes):
+        """
+        Send changes of the directory to the other workers.
+
+        :param changes: kind, cn, dn, school and role of each change
+        :type changes: list of tuples
+        """
+
+        if not self.enabled or not changes:
+            return
+
+        now = time()
+        try:
+            self.conn.executemany(
+                'INSERT INTO changes (kind, cn, dn, school, role, origin, created) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                [(*change, os.getpid(), now) for change in changes]
+            )
+            self.conn.execute('DELETE FROM changes WHERE created < ?', (now - self.RETENTION,))
+        except sqlite3.Error as e:
+            logging.warning(f'Can not write shared store {self.path}: {e}')
+
+    def changes(self, since=None):
+        """
+        Changes of the directory sent by the other workers.
+
+        :param since: Id returned by the previous call, None for the first call
+        :type since: int
+        :return: Id to pass to the next call, kind, cn, dn, school and role of
+        each change, and whether some changes were already removed from the log
+        :rtype: tuple
+        """
+
+        if not self.enabled:
+            return since, [], False
+
+        try:
+            row = self.conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+            last = row[0] if row else 0
+            if since is None:
+                return last, [], False
+
+            first = self.conn.execute('SELECT MIN(id) FROM changes').fetchone()[0]
+            rows = self.conn.execute(
+                'SELECT kind, cn, dn, school, role FROM changes WHERE id > ? AND id <= ? AND origin != ? ORDER BY id',
+                (since, last, os.getpid())
+            ).fetchall()
+        except sqlite3.Error as e:
+            logging.warning(f'Can not read shared store {self.path}: {e}')
+            return since, [], False
+
+        expired = (first if first is not None else last + 1) > since + 1
+        return max(last, since), rows, expired
+
+shared_store = SharedStore()
@@ -0,0 +1,141 @@
+import contextvars
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+from uuid import uuid4
+
+from utils.config import api_config
+
+
+# Logger of the slow requests, see templates/uvicorn_log_conf.yml
+slow_logger = logging.getLogger('lmnapi.slow')
+
+# Max length of a span name, LDAP filters can be very long
+SPAN_NAME_LENGTH = 200
+
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Trace:
+    """
+    Backend calls (LDAP, sophomorix, ...) of one request, with their start
+    and duration relative to the start of the request.
+
+    The trace is carried by a context variable, which is copied into the LDAP
+    and sophomorix executors, so that spans can be added from any thread.
+    """
+
+    def __init__(self, method, path):
+        self.id = uuid4().hex[:16]
+        self.method = method
+        self.path = path
+        self.start = perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, category, name, start, duration):
+        with self._lock:
+            self.spans.append((category, name[:SPAN_NAME_LENGTH], start - self.start, duration))
+
+    def summary(self):
+        """
+        Total duration and number of spans per category.
+
+        :return: (duration, count) by category
+        :rtype: dict
+        """
+
+        summary = {}
+        with self._lock:
+            for category, name, start, duration in self.spans:
+                total, count = summary.get(category, (0, 0))
+                summary[category] = (total + duration, count + 1)
+        return summary
+
+    def server_timing(self, total):
+        """
+        Value of the Server-Timing header, e.g.
+        ldap;dur=12.5;desc="3 calls", total;dur=20.1
+        """
+
+        metrics = [
+            f'{category};dur={duration * 1000:.1f};desc="{count} calls"'
+            for category, (duration, count) in self.summary().items()
+        ]
+        metrics.append(f'total;dur={total * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def asdict(self, status, total):
+        with self._lock:
+            spans = list(self.spans)
+
+        return {
+            'trace_id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'duration_ms': round(total * 1000, 1),
+            'spans': [
+                {'category': category, 'name': name, 'start_ms': round(start * 1000, 1), 'duration_ms': round(duration * 1000, 1)}
+                for category, name, start, duration in spans
+            ],
+        }
+
+@contextmanager
+def span(category, name):
+    """
+    Record the duration of a block in the trace of the current request, if
+    any.
+
+    :param category: Backend, e.g. ldap, sophomorix or auth
+    :type category: basestring
+    :param name: Description of the call, e.g. get /users/doe
+    :type name: basestring
+    """
+
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(category, name, start, perf_counter() - start)
+
+def start_trace(method, path):
+    """
+    Create the trace of a new request and make it the current one.
+
+    :return: The trace and the token to reset the context variable
+    :rtype: tuple
+    """
+
+    trace = Trace(method, path)
+    return trace, current_trace.set(trace)
+
+def finish_trace(trace, response):
+    """
+    End the trace of a request: add the Server-Timing and X-Trace-Id headers
+    if tracing.server_timing is set, and log the trace if the request took
+    more than tracing.slow_threshold seconds.
+
+    :param trace: Trace returned by start_trace
+    :type trace: Trace
+    :param response: Response of the request
+    :type response: Response
+    """
+
+    total = perf_counter() - trace.start
+    tracing_config = api_config.section('tracing')
+
+    if tracing_config.get('server_timing', False):
+        response.headers['Server-Timing'] = trace.server_timing(total)
+        response.headers['X-Trace-Id'] = trace.id
+
+    slow_threshold = tracing_config.get('slow_threshold', 1.0)
+    if slow_threshold and total > slow_threshold:
+        slow_logger.warning(json.dumps(trace.asdict(response.status_code, total)))